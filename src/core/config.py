@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Literal, Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
@@ -12,6 +12,14 @@ class Settings(BaseSettings):
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
 
+    # bcrypt 成本；調整後舊密碼會在使用者下次登入時自動重新 hash
+    BCRYPT_ROUNDS: int = 12
+    # 專用的 hash 執行緒 / process pool，不跟其他同步路由搶 Starlette threadpool
+    HASH_EXECUTOR: Literal["thread", "process"] = "thread"
+    HASH_MAX_WORKERS: int = 4
+    # 排隊 (含執行中) 超過這個數量就直接回 503，不要讓登入尖峰無限堆積
+    HASH_MAX_PENDING: int = 64
+
     # --- 3. 資料庫設定 (Database) ---
     # Postgres
     DB_HOST: str = "localhost"
@@ -19,6 +27,12 @@ class Settings(BaseSettings):
     DB_USER: str = "postgres"
     DB_PASSWORD: str = "password"
     DB_NAME: str = "audiophile_db"
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT_SECONDS: float = 10.0
+    DB_POOL_RECYCLE_SECONDS: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    DB_ASYNC_NULL_POOL: bool = False
 
     # MongoDB
     MONGO_HOST: str = "localhost"
@@ -29,15 +43,134 @@ class Settings(BaseSettings):
     # Redis
     REDIS_HOST: str = "localhost"
     REDIS_PORT: int = 6379
-    
+    REDIS_MAX_CONNECTIONS: int = 50
+    REDIS_SOCKET_TIMEOUT: float = 5.0
+    REDIS_SOCKET_CONNECT_TIMEOUT: float = 2.0
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30
+
 
     # --- 4. 外部 API 設定 ---
     GEMINI_API_KEY: Optional[str] = None
     SPOTIFY_CLIENT_ID: Optional[str] = None
     SPOTIFY_CLIENT_SECRET: Optional[str] = None
     SPOTIFY_REDIRECT_URI: str = "http://127.0.0.1:8000/callback"
+    SPOTIFY_MARKET: str = "TW"
+    SPOTIFY_TIMEOUT_SECONDS: float = 10.0
+    SPOTIFY_MAX_CONNECTIONS: int = 20
+    SPOTIFY_MAX_KEEPALIVE_CONNECTIONS: int = 10
+    SPOTIFY_TOKEN_REFRESH_MARGIN_SECONDS: int = 60
+
+    # Gemini 呼叫限制
+    GEMINI_MODEL: str = "gemini-2.5-flash"
+    GEMINI_TIMEOUT_SECONDS: float = 20.0
+    GEMINI_MAX_RETRIES: int = 3
+    GEMINI_MAX_CONCURRENCY: int = 8
+    GEMINI_BACKOFF_BASE_SECONDS: float = 0.5
+    GEMINI_BACKOFF_MAX_SECONDS: float = 4.0
+    # 批次分析：一個 prompt 最多幾支耳機 (輸出較長，timeout 也要放寬)
+    GEMINI_BATCH_SIZE: int = 10
+    GEMINI_BATCH_TIMEOUT_SECONDS: float = 90.0
+
+    # 上游保護：連續失敗 N 次就斷路 (直接走 fallback)，過 reset 秒後放一個探測請求
+    # 併發上限採 AIMD：延遲低於 target 時慢慢加，變慢 / 失敗時減半 (上限為 *_MAX_CONCURRENCY / SPOTIFY_MAX_CONNECTIONS)
+    GEMINI_BREAKER_FAILURE_THRESHOLD: int = 5
+    GEMINI_BREAKER_RESET_SECONDS: float = 30.0
+    GEMINI_MIN_CONCURRENCY: int = 1
+    GEMINI_LATENCY_TARGET_SECONDS: float = 10.0
+    GEMINI_QUEUE_TIMEOUT_SECONDS: float = 10.0
+    SPOTIFY_BREAKER_FAILURE_THRESHOLD: int = 5
+    SPOTIFY_BREAKER_RESET_SECONDS: float = 15.0
+    SPOTIFY_MIN_CONCURRENCY: int = 2
+    SPOTIFY_LATENCY_TARGET_SECONDS: float = 1.0
+    SPOTIFY_QUEUE_TIMEOUT_SECONDS: float = 2.0
+
+    # --- 5. 快取與併發設定 (Cache & Concurrency) ---
+    # Single-flight: 同一個 cache key 同時只讓一個請求去打 Gemini/Spotify
+    # lease 在計算期間每 TTL/3 續約一次，TTL 只決定 leader 掛掉後多久會被別人接手
+    RECOMMEND_LOCK_TTL_SECONDS: int = 30
+    # 其他 replica 最多等多久；沒設定就用 RECOMMEND_MISS_BUDGET_SECONDS (一次 miss 最久可能花的時間)
+    RECOMMEND_LOCK_WAIT_SECONDS: Optional[float] = None
+    RECOMMEND_LOCK_POLL_SECONDS: float = 0.2
+
+    # 批次推薦 (/recommend/batch)
+    RECOMMEND_BATCH_MAX_ITEMS: int = 50
+    RECOMMEND_BATCH_CONCURRENCY: int = 5
+
+    # 快取預熱 (依 MongoDB logs 的熱門度)
+    WARMUP_ON_STARTUP: bool = True
+    WARMUP_STARTUP_DELAY_SECONDS: float = 10.0
+    WARMUP_TOP_N: int = 100
+    WARMUP_WINDOW_DAYS: int = 7
+    WARMUP_MAX_PER_MINUTE: int = 20
+    WARMUP_LOCK_TTL_SECONDS: int = 1800
+
+    # 耳機名稱正規化 / alias index
+    HEADPHONE_FUZZY_MATCH_ENABLED: bool = True
+    HEADPHONE_FUZZY_BRAND_CUTOFF: float = 0.85
+    HEADPHONE_FUZZY_MODEL_CUTOFF: float = 0.85
+    HEADPHONE_ALIAS_LOCAL_TTL_SECONDS: float = 300.0
+    # fuzzy 比對寫回的 alias 保留多久；比錯的話最久也只會錯這麼久 (也可以用 delete_headphone_alias 撤銷)
+    HEADPHONE_FUZZY_ALIAS_TTL_SECONDS: int = 7 * 24 * 3600
+
+    # 推薦結果快取：超過 soft TTL 先回舊資料並在背景重算；超過 hard TTL 才同步重算
+    RECOMMEND_CACHE_SOFT_TTL_SECONDS: int = 3600
+    RECOMMEND_CACHE_HARD_TTL_SECONDS: int = 24 * 3600
+    # MongoDB (L3) 裡的分析在這段時間內都直接回填 Redis，不重問 Gemini (prompt 版本變了一樣會重算)
+    RECOMMEND_STORE_FRESH_SECONDS: int = 30 * 24 * 3600
+
+    # 負快取：fallback 結果依失敗原因只保留一小段時間，避免每個請求都再去打掛掉的上游
+    NEGATIVE_CACHE_UPSTREAM_ERROR_TTL_SECONDS: int = 60
+    NEGATIVE_CACHE_NO_TRACK_TTL_SECONDS: int = 1800
+    NEGATIVE_CACHE_UNPARSEABLE_TTL_SECONDS: int = 6 * 3600
+
+    # 快取存序列化好的 JSON bytes；命中時直接回傳，不建 Pydantic model
+    RECOMMEND_FAST_RESPONSE: bool = True
+    RECOMMEND_CACHE_COMPRESSION: bool = True
+    RECOMMEND_CACHE_COMPRESS_MIN_BYTES: int = 1024
+
+    # L1 (process 內) 快取，放在 Redis 前面；跨 replica 靠 pub/sub 失效
+    L1_CACHE_MAX_ENTRIES: int = 512
+    L1_CACHE_MAX_BYTES: int = 16 * 1024 * 1024
+    L1_CACHE_TTL_SECONDS: float = 60.0
+    CACHE_INVALIDATION_CHANNEL: str = "cache:invalidate"
 
-    # --- 5. Pydantic 設定 ---
+    # MongoDB 事件 log：批次寫入
+    LOG_QUEUE_MAX_SIZE: int = 10000
+    LOG_BATCH_SIZE: int = 500
+    LOG_FLUSH_INTERVAL_SECONDS: float = 1.0
+    LOG_SHUTDOWN_TIMEOUT_SECONDS: float = 5.0
+
+    # 在回應加上 Server-Timing header (各階段耗時，瀏覽器 DevTools 看得到)；會透露內部結構，預設關閉
+    SERVER_TIMING_ENABLED: bool = False
+
+    # Spotify 搜尋結果快取 (歌曲不太會變，TTL 可以很長；查無結果只短暫記住)
+    SPOTIFY_CACHE_TTL_SECONDS: int = 7 * 24 * 3600
+    SPOTIFY_NEGATIVE_CACHE_TTL_SECONDS: int = 3600
+
+    # 已登入使用者 principal 快取 (key = JWT sub)；停用 / 改密碼時會主動失效，TTL 只是保險
+    USER_CACHE_TTL_SECONDS: int = 300
+    USER_CACHE_L1_TTL_SECONDS: float = 30.0
+    USER_CACHE_L1_MAX_ENTRIES: int = 10000
+
+    # 使用者收藏的 track_id 集合 (Redis SET)，沒有就從 MongoDB 重建
+    FAVORITE_SET_TTL_SECONDS: int = 24 * 3600
+    FAVORITE_CHECK_MAX_ITEMS: int = 200
+
+    # Rate limiting (Redis token bucket)：一般請求依 IP (匿名) / user id (登入) 分開計算；
+    # 真的打到 Gemini 的 cache miss 另外扣一個更嚴格的額度
+    RATE_LIMIT_ENABLED: bool = True
+    # 前面有 nginx / ingress 時才打開，否則 client 可以自己偽造 X-Forwarded-For
+    RATE_LIMIT_TRUST_FORWARDED_FOR: bool = False
+    RATE_LIMIT_ANON_BURST: int = 20
+    RATE_LIMIT_ANON_PER_MINUTE: float = 10
+    RATE_LIMIT_USER_BURST: int = 60
+    RATE_LIMIT_USER_PER_MINUTE: float = 30
+    GEMINI_QUOTA_ANON_BURST: int = 3
+    GEMINI_QUOTA_ANON_PER_HOUR: float = 10
+    GEMINI_QUOTA_USER_BURST: int = 10
+    GEMINI_QUOTA_USER_PER_HOUR: float = 60
+
+    # --- 6. Pydantic 設定 ---
     model_config = SettingsConfigDict(
         
         env_file=".env",
@@ -51,6 +184,21 @@ class Settings(BaseSettings):
     def SQLALCHEMY_DATABASE_URI(self) -> str:
         return f"postgresql://{self.DB_USER}:{self.DB_PASSWORD}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
 
+    @property
+    def SQLALCHEMY_ASYNC_DATABASE_URI(self) -> str:
+        return f"postgresql+asyncpg://{self.DB_USER}:{self.DB_PASSWORD}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}"
+
+    @property
+    def RECOMMEND_MISS_BUDGET_SECONDS(self) -> float:
+        """一次 cache miss 最久可能花的時間：Gemini 每次重試 (排隊 + timeout + backoff) + Spotify (token + 搜尋，401 會重試一次)。"""
+        gemini = self.GEMINI_MAX_RETRIES * (self.GEMINI_QUEUE_TIMEOUT_SECONDS + self.GEMINI_TIMEOUT_SECONDS + self.GEMINI_BACKOFF_MAX_SECONDS)
+        spotify = 2 * (self.SPOTIFY_QUEUE_TIMEOUT_SECONDS + 2 * self.SPOTIFY_TIMEOUT_SECONDS)
+        return gemini + spotify
+
+    @property
+    def RECOMMEND_LOCK_WAIT(self) -> float:
+        return self.RECOMMEND_LOCK_WAIT_SECONDS or self.RECOMMEND_MISS_BUDGET_SECONDS
+
     @property
     def MONGO_URI(self) -> str:
         return f"mongodb://{self.MONGO_USER}:{self.MONGO_PASSWORD}@{self.MONGO_HOST}:{self.MONGO_PORT}/?authSource=admin"
@@ -0,0 +1,130 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+# 所有自訂指標集中在這裡，透過 Instrumentator 的 /metrics 一起輸出
+
+# --- Single-flight (cache miss 合併) ---
+# role: leader = 真的去算的那一個; local = 同 process 等待者; remote = 等別的 replica 算完
+SINGLEFLIGHT_CALLS = Counter(
+    "audiophile_singleflight_calls_total",
+    "Recommendation cache misses grouped by single-flight role",
+    ["role"],
+)
+SINGLEFLIGHT_WAIT_TIMEOUTS = Counter(
+    "audiophile_singleflight_wait_timeouts_total",
+    "Times a waiter gave up waiting for another replica and computed itself",
+)
+
+# --- Spotify 搜尋結果快取 ---
+# result: hit / negative_hit (確定查無此歌) / miss
+SPOTIFY_CACHE_LOOKUPS = Counter(
+    "audiophile_spotify_cache_lookups_total",
+    "Spotify search cache lookups by result",
+    ["result"],
+)
+
+# --- 推薦結果的兩層快取 ---
+# tier: l1 (process 內) / l2 (Redis) / l3 (MongoDB)；result: hit / miss
+RECOMMEND_CACHE_LOOKUPS = Counter(
+    "audiophile_recommend_cache_lookups_total",
+    "Recommendation cache lookups by tier and result",
+    ["tier", "result"],
+)
+L1_CACHE_ENTRIES = Gauge("audiophile_l1_cache_entries", "Entries currently held in the in-process L1 cache")
+L1_CACHE_BYTES = Gauge("audiophile_l1_cache_bytes", "Approximate bytes held in the in-process L1 cache")
+CACHE_INVALIDATIONS_RECEIVED = Counter(
+    "audiophile_cache_invalidations_received_total",
+    "L1 invalidations received from other replicas over Redis pub/sub",
+)
+
+# --- MongoDB 事件 log buffer ---
+LOG_EVENTS_WRITTEN = Counter("audiophile_log_events_written_total", "Request log events written to MongoDB")
+LOG_EVENTS_DROPPED = Counter(
+    "audiophile_log_events_dropped_total",
+    "Request log events dropped before reaching MongoDB",
+    ["reason"],
+)
+LOG_QUEUE_DEPTH = Gauge("audiophile_log_queue_depth", "Request log events waiting to be flushed")
+
+# --- 快取預熱 ---
+# result: fresh (已經新鮮，略過) / mongo (從 MongoDB 回填) / gemini (重新計算) / failed
+WARMUP_HEADPHONES = Counter(
+    "audiophile_warmup_headphones_total",
+    "Headphones processed by the cache warm-up job",
+    ["result"],
+)
+
+# --- 耳機名稱正規化 / alias index ---
+# result: local (process 內快取) / alias (alias index 命中) / exact (規則正規化即可) / fuzzy (近似比對後寫入 alias)
+HEADPHONE_RESOLUTIONS = Counter(
+    "audiophile_headphone_resolutions_total",
+    "Headphone name resolutions by how the canonical key was found",
+    ["result"],
+)
+
+# --- 已登入使用者 principal 快取 ---
+# tier: l1 (process 內) / l2 (Redis)；兩層都 miss 才會查 PostgreSQL
+USER_CACHE_LOOKUPS = Counter(
+    "audiophile_user_cache_lookups_total",
+    "Authenticated-user principal cache lookups by tier and result",
+    ["tier", "result"],
+)
+USER_CACHE_INVALIDATIONS = Counter(
+    "audiophile_user_cache_invalidations_total",
+    "User principal cache entries invalidated after a password or status change",
+)
+
+# --- 密碼 hash pool (bcrypt) ---
+HASH_QUEUE_DEPTH = Gauge("audiophile_hash_queue_depth", "Password hashing jobs waiting for or running in the hashing pool")
+HASH_REJECTED = Counter("audiophile_hash_rejected_total", "Password hashing jobs rejected because the pool queue was full")
+PASSWORD_REHASHES = Counter("audiophile_password_rehashes_total", "Password hashes upgraded on login after a bcrypt cost change")
+
+# --- 推薦流程各階段延遲 (找 p99 是卡在哪一段) ---
+# stage: resolve / cache / mongo / gemini / spotify / cache_write / user / user_db / mongo_log
+STAGE_LATENCY = Histogram(
+    "audiophile_stage_duration_seconds",
+    "Latency of individual recommendation pipeline stages",
+    ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40),
+)
+# result: hit / stale / negative (命中降級結果) / miss (以請求為單位；各層的命中率見 RECOMMEND_CACHE_LOOKUPS)
+RECOMMEND_REQUESTS = Counter(
+    "audiophile_recommend_requests_total",
+    "Recommendation requests by endpoint and cache result",
+    ["endpoint", "result"],
+)
+# reason: upstream_error / no_track / unparseable
+RECOMMEND_DEGRADED = Counter(
+    "audiophile_recommend_degraded_total",
+    "Fallback (degraded) recommendations built, by reason",
+    ["reason"],
+)
+
+# --- 上游 (Gemini / Spotify) ---
+UPSTREAM_IN_FLIGHT = Gauge("audiophile_upstream_in_flight", "Upstream calls currently in flight", ["upstream"])
+# type: timeout / http_<status> / 例外類別名稱
+UPSTREAM_ERRORS = Counter("audiophile_upstream_errors_total", "Failed upstream calls by error type", ["upstream", "type"])
+UPSTREAM_RETRIES = Counter("audiophile_upstream_retries_total", "Upstream calls retried after a failure", ["upstream"])
+
+# --- 上游斷路器 / 自適應併發上限 ---
+# state: 0 = closed, 1 = half_open, 2 = open
+CIRCUIT_STATE = Gauge("audiophile_circuit_state", "Circuit breaker state per upstream (0 closed, 1 half-open, 2 open)", ["upstream"])
+CIRCUIT_TRANSITIONS = Counter(
+    "audiophile_circuit_transitions_total",
+    "Circuit breaker state transitions per upstream",
+    ["upstream", "state"],
+)
+# reason: circuit_open (斷路中) / overloaded (等不到併發名額)
+UPSTREAM_REJECTED = Counter(
+    "audiophile_upstream_rejected_total",
+    "Upstream calls short-circuited to the fallback without being attempted",
+    ["upstream", "reason"],
+)
+UPSTREAM_CONCURRENCY_LIMIT = Gauge("audiophile_upstream_concurrency_limit", "Current adaptive concurrency limit per upstream", ["upstream"])
+
+# --- Rate limiting ---
+# bucket: requests / gemini；result: allowed / limited / error (Redis 掛掉時 fail-open)
+RATE_LIMIT_DECISIONS = Counter(
+    "audiophile_rate_limit_decisions_total",
+    "Rate limit decisions by bucket and result",
+    ["bucket", "result"],
+)
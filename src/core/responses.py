@@ -0,0 +1,12 @@
+from typing import Any
+import orjson
+from fastapi.responses import JSONResponse
+
+
+class CachedJSONResponse(JSONResponse):
+    """已經序列化好的 JSON bytes (例如快取命中) 原封不動送出；其他內容用 orjson 序列化。"""
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            return bytes(content)
+        return orjson.dumps(content)
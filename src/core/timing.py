@@ -0,0 +1,64 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+from starlette.datastructures import MutableHeaders
+from src.core.metrics import STAGE_LATENCY, UPSTREAM_IN_FLIGHT
+
+# 目前這個請求的各階段累計耗時 (秒)；只有開啟 Server-Timing 時才會有值
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+
+
+@contextmanager
+def stage(name: str):
+    """量測一個階段：一定寫進 Prometheus histogram，有開 Server-Timing 時也記到目前請求上。"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.labels(stage=name).observe(elapsed)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed
+
+
+@contextmanager
+def upstream_call(upstream: str, stage_name: str = None):
+    """上游呼叫：階段延遲 + in-flight gauge。stage_name 預設與 upstream 相同 (例如批次 prompt 另外統計)。"""
+    with UPSTREAM_IN_FLIGHT.labels(upstream=upstream).track_inprogress(), stage(stage_name or upstream):
+        yield
+
+
+def format_server_timing(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+class ServerTimingMiddleware:
+    """純 ASGI middleware：在 response start 時把累計的階段耗時放進 Server-Timing header。
+
+    串流回應 (SSE / NDJSON) 的 header 會先送出，只會包含送出前已經完成的階段。
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        timings: Dict[str, float] = {}
+        token = _request_timings.set(timings)
+        start = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                timings["total"] = time.perf_counter() - start
+                MutableHeaders(scope=message).append("Server-Timing", format_server_timing(timings))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _request_timings.reset(token)
@@ -0,0 +1,72 @@
+import time
+from collections import OrderedDict
+from typing import Any, Optional
+from src.core.config import settings
+
+
+class TTLLRUCache:
+    """Process 內的 L1 快取：LRU 淘汰 + TTL 過期 + 總大小上限 (bytes)。
+
+    只給單一 event loop 使用，不做 thread lock。
+    size 由呼叫端估算 (通常直接用序列化後的長度)。
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires_at, _, value = entry
+        if expires_at <= time.monotonic():
+            self.delete(key)
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, size: int, ttl_seconds: float = None):
+        self.delete(key)
+        if self.max_entries <= 0 or size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + (ttl_seconds if ttl_seconds is not None else self.ttl_seconds)
+        self._data[key] = (expires_at, size, value)
+        self._bytes += size
+        while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, evicted_size, _) = self._data.popitem(last=False)
+            self._bytes -= evicted_size
+
+    def delete(self, key: str):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def clear(self):
+        self._data.clear()
+        self._bytes = 0
+
+
+# 推薦結果的 L1 (熱門的幾百支耳機幾乎都會落在這裡)
+recommendation_l1 = TTLLRUCache(
+    max_entries=settings.L1_CACHE_MAX_ENTRIES,
+    max_bytes=settings.L1_CACHE_MAX_BYTES,
+    ttl_seconds=settings.L1_CACHE_TTL_SECONDS,
+)
+
+# 已登入使用者的 principal (只放 id / email / 狀態，一筆很小，主要受筆數限制)
+user_l1 = TTLLRUCache(
+    max_entries=settings.USER_CACHE_L1_MAX_ENTRIES,
+    max_bytes=settings.USER_CACHE_L1_MAX_ENTRIES * 512,
+    ttl_seconds=settings.USER_CACHE_L1_TTL_SECONDS,
+)
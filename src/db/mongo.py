@@ -1,8 +1,13 @@
 import os
+import asyncio
+from collections import deque
 from motor.motor_asyncio import AsyncIOMotorClient
-from datetime import datetime
+from pymongo.errors import BulkWriteError
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 from src.core.config import settings
+from src.core.metrics import LOG_EVENTS_WRITTEN, LOG_EVENTS_DROPPED, LOG_QUEUE_DEPTH
+from src.core.timing import stage
 
 load_dotenv()
 
@@ -28,9 +33,33 @@ async def connect_to_mongo():
         # 測試連線是否成功
         await client.admin.command('ping')
         print("✅ MongoDB 連線成功！")
+        await ensure_indexes()
     except Exception as e:
         print(f"❌ MongoDB 連線失敗: {e}")
 
+# --- 3.1 建立索引 (create_index 是 idempotent，每次啟動呼叫沒關係) ---
+# (collection, keys, options)
+INDEXES = [
+    # L3 耳機分析：一支耳機一筆
+    ("headphones", [("brand_key", 1), ("model_key", 1)], {"unique": True}),
+    # 收藏：同一個使用者同一首歌只能一筆 (upsert 靠這個保證 idempotent)
+    ("favorites", [("user_id", 1), ("track_id", 1)], {"unique": True, "name": "user_track_unique"}),
+    # /user/favorites 的 keyset 分頁 (added_at, _id 倒序)
+    ("favorites", [("user_id", 1), ("added_at", -1), ("_id", -1)], {"name": "user_added_at"}),
+    # /user/history：依使用者 + 事件過濾，(timestamp, _id) 倒序分頁
+    ("logs", [("user_id", 1), ("event", 1), ("timestamp", -1), ("_id", -1)], {"name": "user_event_timestamp_id"}),
+    # 快取預熱：依事件 + 時間範圍統計熱門度
+    ("logs", [("event", 1), ("timestamp", -1)], {"name": "event_timestamp"}),
+]
+
+async def ensure_indexes():
+    # 一個失敗 (例如舊資料有重複) 不影響其他索引
+    for collection, keys, options in INDEXES:
+        try:
+            await db[collection].create_index(keys, **options)
+        except Exception as e:
+            print(f"❌ MongoDB 建立索引失敗 ({collection} {keys}): {e}")
+
 # --- 4. 斷線函式 (main.py 也要呼叫這個！) ---
 async def close_mongo_connection():
     global client
@@ -38,25 +67,148 @@ async def close_mongo_connection():
         client.close()
         print("🔌 MongoDB 連線已關閉")
 
-# --- 5. Log 功能 (保留你的功能，但稍微改一下) ---
-async def log_request(event_type: str, data: dict, user_id: str = None):
-    # 確保 db 已經連線才寫入，不然會噴錯
+# --- 5. Log 功能 (寫進 buffer，背景批次 insert_many，不拖慢 API 回應) ---
+class LogBuffer:
+    """有上限的 in-memory queue + 背景 flush。
+
+    - 累積到 batch_size 或每 flush_interval 秒寫一次 (insert_many, ordered=False)。
+    - Mongo 慢到 queue 滿了就丟掉新進來的 log，並記錄在 metrics 裡。
+    """
+
+    def __init__(self, max_size: int, batch_size: int, flush_interval: float):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer = deque()
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task = None
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def enqueue(self, entry: dict) -> bool:
+        if len(self._buffer) >= self.max_size:
+            LOG_EVENTS_DROPPED.labels(reason="queue_full").inc()
+            return False
+        self._buffer.append(entry)
+        LOG_QUEUE_DEPTH.set(len(self._buffer))
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+        return True
+
+    def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: float):
+        """停止背景任務並把剩下的 log 寫完 (lifespan shutdown 用)。"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(self._task, timeout=timeout)
+        except asyncio.TimeoutError:
+            LOG_EVENTS_DROPPED.labels(reason="shutdown").inc(len(self._buffer))
+            print(f"⚠️ Log flush timed out, {len(self._buffer)} logs dropped")
+        self._task = None
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+        await self.flush()
+
+    async def flush(self):
+        while self._buffer:
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+            LOG_QUEUE_DEPTH.set(len(self._buffer))
+            await self._write(batch)
+
+    async def _write(self, batch: list):
+        if db is None:
+            LOG_EVENTS_DROPPED.labels(reason="no_connection").inc(len(batch))
+            return
+        try:
+            # 背景寫入，不在請求路徑上；histogram 用來看 MongoDB 本身有沒有變慢
+            with stage("mongo_log"):
+                await db.logs.insert_many(batch, ordered=False)
+            LOG_EVENTS_WRITTEN.inc(len(batch))
+        except BulkWriteError as e:
+            written = e.details.get("nInserted", 0)
+            LOG_EVENTS_WRITTEN.inc(written)
+            LOG_EVENTS_DROPPED.labels(reason="write_error").inc(len(batch) - written)
+            print(f"❌ [Log Error] {e}")
+        except Exception as e:
+            LOG_EVENTS_DROPPED.labels(reason="write_error").inc(len(batch))
+            print(f"❌ [Log Error] {e}")
+
+
+log_buffer = LogBuffer(
+    max_size=settings.LOG_QUEUE_MAX_SIZE,
+    batch_size=settings.LOG_BATCH_SIZE,
+    flush_interval=settings.LOG_FLUSH_INTERVAL_SECONDS,
+)
+
+def log_request(event_type: str, data: dict, user_id: str = None):
+    # 只放進 buffer，真正寫入由背景任務負責
+    log_buffer.enqueue({
+        "event": event_type,
+        "timestamp": datetime.utcnow(),
+        "user_id": user_id,
+        "data": data
+    })
+
+# --- 6. 耳機分析永久儲存 (Redis 後面的 L3) ---
+# brand_key / model_key 為正規化後的 canonical key (見 services/normalizer.py)，與 Redis key 相同
+def _headphone_filter(brand_key: str, model_key: str) -> dict:
+    return {"brand_key": brand_key, "model_key": model_key}
+
+async def get_stored_recommendation(brand_key: str, model_key: str, prompt_version: str):
+    """回傳 (recommendation, updated_at epoch 秒)；沒有或 prompt 版本不同回傳 None。"""
     if db is None:
-        print("⚠️ Warning: MongoDB 尚未連線，無法寫入 Log")
-        return
+        return None
+    try:
+        doc = await db.headphones.find_one(
+            {**_headphone_filter(brand_key, model_key), "prompt_version": prompt_version},
+            {"_id": 0, "recommendation": 1, "updated_at": 1}
+        )
+    except Exception as e:
+        print(f"❌ [Headphone Store Error] {e}")
+        return None
+    if not doc:
+        return None
+    return doc["recommendation"], doc["updated_at"].replace(tzinfo=timezone.utc).timestamp()
 
+async def save_recommendation(brand_key: str, model_key: str, recommendation: dict, prompt_version: str,
+                              brand: str = None, model: str = None):
+    """brand / model 是使用者輸入的顯示名稱，只做紀錄用。"""
+    if db is None:
+        return
+    now = datetime.utcnow()
     try:
-        log_entry = {
-            "event": event_type,
-            "timestamp": datetime.utcnow(),
-            "user_id": user_id,
-            "data": data
-        }
-        # 直接使用 db.logs，不需要在最上面先定義 logs_collection
-        await db.logs.insert_one(log_entry)
-        # print(f"📝 Log saved: {event_type}") # debug 用，嫌吵可以註解掉
+        await db.headphones.update_one(
+            _headphone_filter(brand_key, model_key),
+            {
+                "$set": {
+                    "brand": brand or brand_key,
+                    "model": model or model_key,
+                    "recommendation": recommendation,
+                    "prompt_version": prompt_version,
+                    "updated_at": now,
+                },
+                "$setOnInsert": {"created_at": now},
+            },
+            upsert=True
+        )
     except Exception as e:
-        print(f"❌ [Log Error] {e}")
+        print(f"❌ [Headphone Store Error] {e}")
 
 # 讓其他檔案可以取得 db 的 helper
 def get_database():
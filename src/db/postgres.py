@@ -1,7 +1,9 @@
 import os
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 from src.core.config import settings
 
 # 1. 安全地從環境變數讀取，不設任何明碼預設值
@@ -16,14 +18,35 @@ DB_NAME = os.getenv("DB_NAME", "audiophile_db")
 SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
 # 3. 初始化 SQLAlchemy
-engine = create_engine(settings.SQLALCHEMY_DATABASE_URI)
+_pool_options = dict(
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT_SECONDS,
+    pool_recycle=settings.DB_POOL_RECYCLE_SECONDS,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+)
+
+# 同步 engine：只給 plain `def` 的路由與啟動時的 create_all 使用
+engine = create_engine(settings.SQLALCHEMY_DATABASE_URI, **_pool_options)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# 非同步 engine (asyncpg)：所有 `async def` 的路由與 dependency 都走這裡，不會卡住 event loop
+# 測試時每個 TestClient 請求可能跑在不同的 event loop，連線不能共用，所以提供 NullPool 選項
+if settings.DB_ASYNC_NULL_POOL:
+    async_engine = create_async_engine(settings.SQLALCHEMY_ASYNC_DATABASE_URI, poolclass=NullPool)
+else:
+    async_engine = create_async_engine(settings.SQLALCHEMY_ASYNC_DATABASE_URI, **_pool_options)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
 # 4. 依賴注入 (Dependency Injection)
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -1,8 +1,18 @@
 import os
 import json
-import redis
+import time
+import uuid
+import zlib
+import orjson
+import asyncio
 import logging
+import redis
+import redis.asyncio as aioredis
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
+from src.core.config import settings
+from src.core.metrics import RECOMMEND_CACHE_LOOKUPS, L1_CACHE_ENTRIES, L1_CACHE_BYTES, CACHE_INVALIDATIONS_RECEIVED
+from src.db.local_cache import recommendation_l1, user_l1
 
 load_dotenv()
 
@@ -12,30 +22,557 @@ REDIS_PORT = os.getenv("REDIS_PORT", "6379")
 REDIS_DB = os.getenv("REDIS_DB", "0")
 REDIS_URL = f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}"
 
-# 初始化連線池
+# 初始化連線池 (asyncio 版本，不會卡住 event loop)
 try:
-    pool = redis.ConnectionPool.from_url(REDIS_URL, decode_responses=True, socket_timeout=5)
-    client = redis.Redis(connection_pool=pool)
+    pool = aioredis.ConnectionPool.from_url(
+        REDIS_URL,
+        decode_responses=True,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+    client = aioredis.Redis(connection_pool=pool)
+    # 推薦快取存的是序列化好的 bytes (可能壓縮過)，要用不 decode 的 client
+    binary_pool = aioredis.ConnectionPool.from_url(
+        REDIS_URL,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
+    )
+    binary_client = aioredis.Redis(connection_pool=binary_pool)
 except Exception as e:
     logging.error(f"Redis Connection Pool Error: {e}")
 
-CACHE_EXPIRE_SECONDS = 3600
+# Redis 上的實際存活時間 = hard TTL；超過 soft TTL 的資料仍會回傳，但會在背景重算
+CACHE_EXPIRE_SECONDS = settings.RECOMMEND_CACHE_HARD_TTL_SECONDS
+
+# 每個 process 一個 ID，pub/sub 收到自己發的失效通知時直接忽略
+INSTANCE_ID = uuid.uuid4().hex
+
+# Redis 掛掉或太慢時都視為 cache miss，不中斷主程式
+_FAIL_OPEN_ERRORS = (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError)
+
+# 只有持有 token 的人才能釋放鎖，避免過期後誤刪別人的 lease
+_RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+# 續約同樣要確認 token，避免幫已經被別人接手的 lease 延長
+_EXTEND_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("expire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# Token bucket：補充 + 扣除在同一個 script 裡完成，多個 replica 同時打也不會超賣。
+# 時間用 Redis 的 TIME，不受各 replica 時鐘誤差影響；數字以字串回傳，避免 Lua number 被截成整數。
+_TOKEN_BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local t = redis.call("TIME")
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or capacity
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "ts", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return {allowed, tostring(tokens), tostring(retry_after), tostring((capacity - tokens) / rate)}
+"""
+
+# 呼叫端應傳入正規化後的 canonical brand / model (見 services/normalizer.py)
+def recommendation_key(brand: str, model: str) -> str:
+    return f"rec:{brand.lower()}:{model.lower()}"
+
+
+# 推薦快取的格式版本：TrackRecommendation 欄位或 entry 格式有改就要跳版本，舊版本視為 miss
+CACHE_SCHEMA_VERSION = 3
+
+class CachedRecommendation:
+    """body 是序列化好的 JSON bytes (命中時可以直接回給 client)；data 只有在需要 dict 時才 parse。
+    degraded 不是 None 代表這是負快取 (fallback 結果)，值為失敗原因。"""
+    __slots__ = ("cached_at", "degraded", "_data", "_body")
+
+    def __init__(self, data: dict = None, cached_at: float = 0.0, body: bytes = None, degraded: str = None):
+        self.cached_at = cached_at
+        self.degraded = degraded
+        self._data = data
+        self._body = body
+
+    @property
+    def data(self) -> dict:
+        if self._data is None:
+            self._data = orjson.loads(self._body)
+        return self._data
+
+    @property
+    def body(self) -> bytes:
+        if self._body is None:
+            self._body = orjson.dumps(self._data)
+        return self._body
+
+    @property
+    def age(self) -> float:
+        return max(time.time() - self.cached_at, 0.0)
+
+    @property
+    def is_stale(self) -> bool:
+        # 負快取不做 SWR：TTL 到了就整筆消失，下一個請求自然會重算
+        if self.degraded:
+            return False
+        return self.age >= settings.RECOMMEND_CACHE_SOFT_TTL_SECONDS
+
+
+# 負快取依失敗原因決定保留多久：上游暫時掛掉很快就該重試，解析不了的輸入短時間內重算也一樣
+def negative_ttl(reason: str) -> int:
+    return {
+        "upstream_error": settings.NEGATIVE_CACHE_UPSTREAM_ERROR_TTL_SECONDS,
+        "no_track": settings.NEGATIVE_CACHE_NO_TRACK_TTL_SECONDS,
+        "unparseable": settings.NEGATIVE_CACHE_UNPARSEABLE_TTL_SECONDS,
+    }.get(reason, settings.NEGATIVE_CACHE_UPSTREAM_ERROR_TTL_SECONDS)
+
+
+# Redis 上的格式: b"{schema 版本}:{是否壓縮 0/1}:{cached_at}:{degraded 原因，完整結果為空}:" + body
+def _new_entry(data: dict, cached_at: float = None, degraded: str = None) -> Tuple[CachedRecommendation, bytes]:
+    entry = CachedRecommendation(data=data, cached_at=cached_at or time.time(), degraded=degraded)
+    body = entry.body
+    compressed = settings.RECOMMEND_CACHE_COMPRESSION and len(body) >= settings.RECOMMEND_CACHE_COMPRESS_MIN_BYTES
+    payload = zlib.compress(body) if compressed else body
+    header = b"%d:%d:%.3f:%s:" % (CACHE_SCHEMA_VERSION, compressed, entry.cached_at, (degraded or "").encode())
+    return entry, header + payload
+
+def _decode_entry(raw: bytes) -> Optional[CachedRecommendation]:
+    if raw[:1] == b"{":
+        return _decode_legacy_entry(raw)
+    version, rest = raw.split(b":", 1)
+    if int(version) != CACHE_SCHEMA_VERSION:
+        return None
+    compressed, cached_at, degraded, payload = rest.split(b":", 3)
+    body = zlib.decompress(payload) if compressed == b"1" else payload
+    return CachedRecommendation(body=body, cached_at=float(cached_at), degraded=degraded.decode() or None)
+
+def _decode_legacy_entry(raw: bytes) -> CachedRecommendation:
+    # 最早的格式 (直接存 JSON、沒有 cached_at)：當作已過 soft TTL，讓它在背景被重算
+    return CachedRecommendation(data=json.loads(raw), cached_at=time.time() - settings.RECOMMEND_CACHE_SOFT_TTL_SECONDS)
+
+# 格式壞掉 (或 zlib 解不開) 都當作 cache miss
+_DECODE_ERRORS = (ValueError, KeyError, zlib.error)
+
+# L1 存的是還沒壓縮的 entry，命中時不用再解壓縮
+def _remember_locally(key: str, entry: CachedRecommendation):
+    ttl = min(settings.L1_CACHE_TTL_SECONDS, negative_ttl(entry.degraded)) if entry.degraded else None
+    recommendation_l1.set(key, entry, size=len(entry.body), ttl_seconds=ttl)
+    L1_CACHE_ENTRIES.set(len(recommendation_l1))
+    L1_CACHE_BYTES.set(recommendation_l1.nbytes)
+
+def _forget_locally(key: str):
+    recommendation_l1.delete(key)
+    L1_CACHE_ENTRIES.set(len(recommendation_l1))
+    L1_CACHE_BYTES.set(recommendation_l1.nbytes)
+
+def _invalidation_message(key: str) -> str:
+    return json.dumps({"key": key, "origin": INSTANCE_ID})
+
+async def get_cached_recommendation(brand: str, model: str) -> Optional[CachedRecommendation]:
+    key = recommendation_key(brand, model)
 
-def get_cached_recommendation(brand: str, model: str):
-    key = f"rec:{brand.lower()}:{model.lower()}"
+    # L1: process 內，不需要網路也不需要解析
+    entry = recommendation_l1.get(key)
+    if entry is not None:
+        RECOMMEND_CACHE_LOOKUPS.labels(tier="l1", result="hit").inc()
+        return entry
+    RECOMMEND_CACHE_LOOKUPS.labels(tier="l1", result="miss").inc()
+
+    # L2: Redis
     try:
-        data = client.get(key)
-        if data:
-            return json.loads(data)
-    except (redis.exceptions.ConnectionError, json.JSONDecodeError) as e:
+        raw = await binary_client.get(key)
+        entry = _decode_entry(raw) if raw else None
+        if entry is not None:
+            RECOMMEND_CACHE_LOOKUPS.labels(tier="l2", result="hit").inc()
+            _remember_locally(key, entry)
+            return entry
+    except (*_FAIL_OPEN_ERRORS, *_DECODE_ERRORS) as e:
         # 當 Redis 掛掉或資料格式錯誤，僅記錄 Log，不中斷主程式
         logging.warning(f"Cache Miss due to Redis error: {e}")
+    RECOMMEND_CACHE_LOOKUPS.labels(tier="l2", result="miss").inc()
     return None
 
-def set_cached_recommendation(brand: str, model: str, data: dict):
-    key = f"rec:{brand.lower()}:{model.lower()}"
+async def set_cached_recommendation(brand: str, model: str, data: dict, cached_at: float = None, degraded: str = None):
+    """cached_at 預設為現在；MongoDB 回填也用現在 (新鮮度由 RECOMMEND_STORE_FRESH_SECONDS 把關，見 _refill_from_store)。
+    degraded 有值時寫成負快取 (見 _set_negative_recommendation)。"""
+    if degraded:
+        await _set_negative_recommendation(brand, model, data, degraded)
+        return
+    key = recommendation_key(brand, model)
+    entry, raw = _new_entry(data, cached_at)
+    _remember_locally(key, entry)
     try:
         # 使用 try 確保即使寫入快取失敗，主流程依然能完成
-        client.setex(key, CACHE_EXPIRE_SECONDS, json.dumps(data))
+        # 同一個 round trip 順便通知其他 replica 丟掉舊的 L1
+        async with binary_client.pipeline(transaction=False) as pipe:
+            pipe.setex(key, CACHE_EXPIRE_SECONDS, raw)
+            pipe.publish(settings.CACHE_INVALIDATION_CHANNEL, _invalidation_message(key))
+            await pipe.execute()
+    except Exception as e:
+        logging.error(f"Failed to save cache for {key}: {e}")
+
+async def _set_negative_recommendation(brand: str, model: str, data: dict, degraded: str):
+    """負快取用 SET NX：已經有完整結果 (例如過期中正在 SWR) 時不覆蓋，只有寫入成功才放進 L1 並廣播。"""
+    key = recommendation_key(brand, model)
+    entry, raw = _new_entry(data, degraded=degraded)
+    try:
+        if not await binary_client.set(key, raw, nx=True, ex=negative_ttl(degraded)):
+            return
+        _remember_locally(key, entry)
+        await binary_client.publish(settings.CACHE_INVALIDATION_CHANNEL, _invalidation_message(key))
+    except Exception as e:
+        # Redis 掛掉時至少讓本 process 在短 TTL 內不要一直重打上游
+        _remember_locally(key, entry)
+        logging.error(f"Failed to save negative cache for {key}: {e}")
+
+async def invalidate_recommendation(brand: str, model: str):
+    """刪除 L1 + L2，並廣播給所有 replica。"""
+    key = recommendation_key(brand, model)
+    _forget_locally(key)
+    try:
+        async with binary_client.pipeline(transaction=False) as pipe:
+            pipe.delete(key)
+            pipe.publish(settings.CACHE_INVALIDATION_CHANNEL, _invalidation_message(key))
+            await pipe.execute()
+    except Exception as e:
+        logging.error(f"Failed to invalidate cache for {key}: {e}")
+
+# --- 批次讀寫 (一次 round trip) ---
+async def get_cached_recommendations(pairs: List[Tuple[str, str]]) -> List[Optional[CachedRecommendation]]:
+    """先查 L1，剩下的用 MGET 一次取回，順序與 pairs 相同，miss 為 None。"""
+    if not pairs:
+        return []
+    keys = [recommendation_key(b, m) for b, m in pairs]
+    results: List[Optional[CachedRecommendation]] = [recommendation_l1.get(k) for k in keys]
+    missing = [i for i, r in enumerate(results) if r is None]
+    RECOMMEND_CACHE_LOOKUPS.labels(tier="l1", result="hit").inc(len(keys) - len(missing))
+    RECOMMEND_CACHE_LOOKUPS.labels(tier="l1", result="miss").inc(len(missing))
+    if not missing:
+        return results
+
+    try:
+        values = await binary_client.mget([keys[i] for i in missing])
+    except _FAIL_OPEN_ERRORS as e:
+        logging.warning(f"Batch cache miss due to Redis error: {e}")
+        values = [None] * len(missing)
+
+    for i, raw in zip(missing, values):
+        try:
+            results[i] = _decode_entry(raw) if raw else None
+        except _DECODE_ERRORS:
+            results[i] = None
+        if results[i] is not None:
+            _remember_locally(keys[i], results[i])
+        RECOMMEND_CACHE_LOOKUPS.labels(tier="l2", result="hit" if results[i] is not None else "miss").inc()
+    return results
+
+async def set_cached_recommendations(items: Dict[Tuple[str, str], dict]):
+    """用 pipeline 一次寫入多筆 SETEX (並廣播 L1 失效)。"""
+    if not items:
+        return
+    try:
+        async with binary_client.pipeline(transaction=False) as pipe:
+            for (brand, model), data in items.items():
+                key = recommendation_key(brand, model)
+                entry, raw = _new_entry(data)
+                _remember_locally(key, entry)
+                pipe.setex(key, CACHE_EXPIRE_SECONDS, raw)
+                pipe.publish(settings.CACHE_INVALIDATION_CHANNEL, _invalidation_message(key))
+            await pipe.execute()
+    except Exception as e:
+        logging.error(f"Failed to save batch cache ({len(items)} keys): {e}")
+
+# --- L1 失效廣播 (Redis pub/sub) ---
+async def listen_for_invalidations():
+    """背景任務：收到其他 replica 的失效通知就丟掉本地 L1。
+    斷線期間可能漏訊息，所以重連時整個 L1 清空。"""
+    while True:
+        pubsub = client.pubsub()
+        try:
+            await pubsub.subscribe(settings.CACHE_INVALIDATION_CHANNEL)
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message is None:
+                    continue
+                payload = json.loads(message["data"])
+                if payload.get("origin") == INSTANCE_ID:
+                    continue
+                CACHE_INVALIDATIONS_RECEIVED.inc()
+                if payload["key"].startswith("user:"):
+                    user_l1.delete(payload["key"])
+                else:
+                    _forget_locally(payload["key"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.warning(f"Cache invalidation listener error, resubscribing: {e}")
+            recommendation_l1.clear()
+            user_l1.clear()
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.aclose()
+
+# --- Spotify 搜尋結果快取 (key = 正規化後的 song query + market) ---
+def track_key(normalized_query: str, market: str) -> str:
+    return f"spotify:{market.lower()}:{normalized_query}"
+
+async def get_cached_track(normalized_query: str, market: str):
+    """回傳 (found, track)。found=True 且 track=None 代表「Spotify 確定查無此歌」的負快取。"""
+    key = track_key(normalized_query, market)
+    try:
+        data = await client.get(key)
+        if data is not None:
+            return True, json.loads(data)
+    except (*_FAIL_OPEN_ERRORS, json.JSONDecodeError) as e:
+        logging.warning(f"Track cache miss due to Redis error: {e}")
+    return False, None
+
+async def set_cached_track(normalized_query: str, market: str, track: Optional[dict]):
+    key = track_key(normalized_query, market)
+    ttl = settings.SPOTIFY_CACHE_TTL_SECONDS if track else settings.SPOTIFY_NEGATIVE_CACHE_TTL_SECONDS
+    try:
+        await client.setex(key, ttl, json.dumps(track))
+    except Exception as e:
+        logging.error(f"Failed to save track cache for {key}: {e}")
+
+# --- 已登入使用者 principal 快取 (key = JWT sub，也就是 email) ---
+def user_principal_key(subject: str) -> str:
+    return f"user:{subject}"
+
+async def get_cached_principal(subject: str) -> Optional[dict]:
+    try:
+        data = await client.get(user_principal_key(subject))
+        if data:
+            return json.loads(data)
+    except (*_FAIL_OPEN_ERRORS, json.JSONDecodeError) as e:
+        logging.warning(f"User cache miss due to Redis error: {e}")
+    return None
+
+async def set_cached_principal(subject: str, principal: dict):
+    try:
+        await client.setex(user_principal_key(subject), settings.USER_CACHE_TTL_SECONDS, json.dumps(principal))
+    except Exception as e:
+        logging.error(f"Failed to save user cache for {subject}: {e}")
+
+async def invalidate_principal(subject: str):
+    """刪除 L1 + L2，並廣播給所有 replica (與推薦快取共用同一個 channel)。"""
+    key = user_principal_key(subject)
+    user_l1.delete(key)
+    try:
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.delete(key)
+            pipe.publish(settings.CACHE_INVALIDATION_CHANNEL, _invalidation_message(key))
+            await pipe.execute()
+    except Exception as e:
+        logging.error(f"Failed to invalidate user cache for {subject}: {e}")
+
+# --- 使用者收藏集合 (key = fav:{user_id}) ---
+# 集合裡一定有 sentinel：沒有 sentinel 代表集合不存在或不完整，要從 MongoDB 重建
+FAVORITE_SET_SENTINEL = "__loaded__"
+
+def favorites_key(user_id: str) -> str:
+    return f"fav:{user_id}"
+
+async def check_cached_favorites(user_id: str, track_ids: List[str]) -> Optional[List[bool]]:
+    """一次 SMISMEMBER 查完；集合還沒建好 (或 Redis 掛掉) 回傳 None。"""
+    try:
+        flags = await client.smismember(favorites_key(user_id), [FAVORITE_SET_SENTINEL, *track_ids])
+    except _FAIL_OPEN_ERRORS as e:
+        logging.warning(f"Favorite set lookup failed for {user_id}: {e}")
+        return None
+    if not flags[0]:
+        return None
+    return [bool(f) for f in flags[1:]]
+
+# 每次移除收藏就 +1；重建前先記下版本，寫入時版本變了代表重建拿到的是舊快照，直接放棄
+def favorites_generation_key(user_id: str) -> str:
+    return f"fav:{user_id}:gen"
+
+async def get_favorites_generation(user_id: str) -> Optional[str]:
+    """重建前 (讀 MongoDB 之前) 呼叫；Redis 掛掉回傳 None，呼叫端就不要重建。"""
+    try:
+        return await client.get(favorites_generation_key(user_id)) or "0"
+    except _FAIL_OPEN_ERRORS as e:
+        logging.warning(f"Favorite generation lookup failed for {user_id}: {e}")
+        return None
+
+async def fill_favorites_set(user_id: str, track_ids: List[str], generation: str):
+    """用 SADD 合併而不是先 DEL：重建期間別的請求加進來的收藏不會被洗掉。
+    移除則靠版本號：重建期間有人移除收藏 (版本變了) 就不寫，避免把剛移除的 track 加回去。"""
+    key, gen_key = favorites_key(user_id), favorites_generation_key(user_id)
+    try:
+        async with client.pipeline(transaction=True) as pipe:
+            await pipe.watch(gen_key)
+            if (await pipe.get(gen_key) or "0") != generation:
+                return
+            pipe.multi()
+            pipe.sadd(key, FAVORITE_SET_SENTINEL, *track_ids)
+            pipe.expire(key, settings.FAVORITE_SET_TTL_SECONDS)
+            await pipe.execute()
+    except redis.exceptions.WatchError:
+        # 寫入前一刻版本才變：同樣放棄，下次查詢再重建
+        return
+    except Exception as e:
+        logging.error(f"Failed to rebuild favorite set for {user_id}: {e}")
+
+async def add_cached_favorite(user_id: str, track_id: str):
+    # 集合不存在時 SADD 會建出一個沒有 sentinel 的集合，下次查詢仍會觸發重建
+    key = favorites_key(user_id)
+    try:
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.sadd(key, track_id)
+            pipe.expire(key, settings.FAVORITE_SET_TTL_SECONDS)
+            await pipe.execute()
+    except Exception as e:
+        logging.error(f"Failed to add {track_id} to favorite set for {user_id}: {e}")
+
+async def remove_cached_favorite(user_id: str, track_id: str):
+    """版本 +1 並整個丟掉集合：進行中的重建會放棄寫入，下次查詢從 MongoDB 乾淨重建。"""
+    gen_key = favorites_generation_key(user_id)
+    try:
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.incr(gen_key)
+            pipe.expire(gen_key, settings.FAVORITE_SET_TTL_SECONDS)
+            pipe.delete(favorites_key(user_id))
+            await pipe.execute()
+    except Exception as e:
+        # 集合可能還留著這首歌，最多錯到 FAVORITE_SET_TTL_SECONDS
+        logging.error(f"Failed to invalidate favorite set for {user_id} after removing {track_id}: {e}")
+
+# --- 耳機 alias index ---
+# alias:headphone:{變體 key}  STRING  fuzzy 比對出來的 canonical key (有 TTL，比錯了也會自己過期)
+# alias:brands                SET     出現過的 canonical 品牌 (長期累積)
+# alias:models:{b}            SET     該品牌出現過的 canonical 型號 (長期累積)
+# 舊版的 alias:headphones HASH 沒有 TTL 也無法單筆過期，已不再讀取
+def headphone_alias_key(variant: str) -> str:
+    return f"alias:headphone:{variant}"
+
+async def get_headphone_alias(variant: str) -> Optional[str]:
+    try:
+        return await client.get(headphone_alias_key(variant))
+    except _FAIL_OPEN_ERRORS as e:
+        logging.warning(f"Alias lookup failed for {variant}: {e}")
+        return None
+
+async def set_headphone_alias(variant: str, canonical: str):
+    try:
+        await client.setex(headphone_alias_key(variant), settings.HEADPHONE_FUZZY_ALIAS_TTL_SECONDS, canonical)
     except Exception as e:
-        logging.error(f"Failed to save cache for {key}: {e}")
\ No newline at end of file
+        logging.error(f"Failed to save alias {variant} -> {canonical}: {e}")
+
+async def delete_headphone_alias(variant: str):
+    """撤銷一筆比錯的 alias (各 replica 的 process 內快取最多再留 HEADPHONE_ALIAS_LOCAL_TTL_SECONDS)。"""
+    try:
+        await client.delete(headphone_alias_key(variant))
+    except Exception as e:
+        logging.error(f"Failed to delete alias {variant}: {e}")
+
+async def get_known_brands() -> set:
+    try:
+        return await client.smembers("alias:brands")
+    except _FAIL_OPEN_ERRORS as e:
+        logging.warning(f"Known brands lookup failed: {e}")
+        return set()
+
+async def get_known_models(brand_key: str) -> set:
+    try:
+        return await client.smembers(f"alias:models:{brand_key}")
+    except _FAIL_OPEN_ERRORS as e:
+        logging.warning(f"Known models lookup failed for {brand_key}: {e}")
+        return set()
+
+async def is_known_model(brand_key: str, model_key: str) -> bool:
+    """SISMEMBER：大部分查詢都是已知型號，不需要把整個集合拉回來。"""
+    try:
+        return bool(await client.sismember(f"alias:models:{brand_key}", model_key))
+    except _FAIL_OPEN_ERRORS as e:
+        logging.warning(f"Known model lookup failed for {brand_key}:{model_key}: {e}")
+        return False
+
+async def register_headphone(brand_key: str, model_key: str):
+    """成功分析過的耳機才登記成 canonical，之後的近似寫法會對到它。"""
+    try:
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.sadd("alias:brands", brand_key)
+            pipe.sadd(f"alias:models:{brand_key}", model_key)
+            await pipe.execute()
+    except Exception as e:
+        logging.error(f"Failed to register headphone {brand_key}:{model_key}: {e}")
+
+# --- 分散式 Lease (跨 replica 的 single-flight) ---
+async def acquire_lock(key: str, ttl_seconds: int):
+    """嘗試取得 lock:{key}，成功回傳 token；被別人持有回傳 None。
+    Redis 掛掉時回傳 "" (fail-open，讓呼叫端自己計算)。"""
+    token = uuid.uuid4().hex
+    try:
+        if await client.set(f"lock:{key}", token, nx=True, ex=ttl_seconds):
+            return token
+        return None
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Lock acquire failed for {key}: {e}")
+        return ""
+
+async def is_locked(key: str) -> bool:
+    try:
+        return bool(await client.exists(f"lock:{key}"))
+    except redis.exceptions.RedisError:
+        return False
+
+async def extend_lock(key: str, token: str, ttl_seconds: int) -> bool:
+    """延長自己持有的 lease；回傳 False 代表 lease 已經不是自己的了。Redis 掛掉時當作還持有。"""
+    if not token:
+        return True
+    try:
+        return bool(await client.eval(_EXTEND_LOCK_SCRIPT, 1, f"lock:{key}", token, ttl_seconds))
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Lock extend failed for {key}: {e}")
+        return True
+
+async def release_lock(key: str, token: str):
+    if not token:
+        return
+    try:
+        await client.eval(_RELEASE_LOCK_SCRIPT, 1, f"lock:{key}", token)
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Lock release failed for {key}: {e}")
+
+# --- Rate limiting (token bucket) ---
+def rate_limit_key(bucket: str, subject: str) -> str:
+    return f"ratelimit:{bucket}:{subject}"
+
+async def take_tokens(key: str, capacity: int, refill_per_second: float, cost: int = 1) -> Optional[Tuple[bool, float, float, float]]:
+    """回傳 (是否放行, 剩餘 token, 幾秒後可重試, 幾秒後補滿)；Redis 掛掉時回傳 None (fail-open)。"""
+    try:
+        allowed, remaining, retry_after, reset = await client.eval(
+            _TOKEN_BUCKET_SCRIPT, 1, key, capacity, refill_per_second, cost
+        )
+        return bool(allowed), float(remaining), float(retry_after), float(reset)
+    except redis.exceptions.RedisError as e:
+        logging.warning(f"Rate limit check failed for {key}: {e}")
+        return None
+
+async def close_redis_connection():
+    await client.aclose()
+    await pool.aclose()
+    await binary_client.aclose()
+    await binary_pool.aclose()
@@ -1,4 +1,5 @@
 import os
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
@@ -7,8 +8,15 @@ from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from prometheus_fastapi_instrumentator import Instrumentator
 
-from src.db.postgres import engine, Base
-from src.db.mongo import connect_to_mongo, close_mongo_connection
+from src.core.config import settings
+from src.core.timing import ServerTimingMiddleware
+from src.db.postgres import engine, async_engine, Base
+from src.db.mongo import connect_to_mongo, close_mongo_connection, log_buffer
+from src.db.redis import close_redis_connection, listen_for_invalidations
+from src.services.music_service import spotify_client
+from src.services.warmup import run_startup_warmup
+from src.services.user_cache import bind_event_loop
+from src.services.hashing import hashing_pool
 from src.routers import auth, recommendation, user
 
 logging.basicConfig(level=logging.INFO)
@@ -36,12 +44,38 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.error(f"❌ MongoDB connection failed: {e}")
 
+    # 事件 log 背景批次寫入
+    log_buffer.start()
+
+    # Spotify HTTP/2 連線池 (整個 app 共用)
+    await spotify_client.start()
+
+    # 同步路由 (threadpool) 改到使用者資料時，user 快取失效要送回這個 loop
+    bind_event_loop(asyncio.get_running_loop())
+
+    # 監聽其他 replica 的 L1 快取失效通知
+    invalidation_task = asyncio.create_task(listen_for_invalidations())
+
+    # 依熱門度預熱快取 (背景執行，不影響啟動時間)
+    warmup_task = asyncio.create_task(run_startup_warmup()) if settings.WARMUP_ON_STARTUP else None
+
     yield  
 
     
     logger.info("🛑 Shutting down Application...")
+    invalidation_task.cancel()
+    if warmup_task:
+        warmup_task.cancel()
+    await spotify_client.close()
+    hashing_pool.shutdown()
+    # 關閉 Mongo 之前先把 buffer 裡的 log 寫完
+    await log_buffer.stop(timeout=settings.LOG_SHUTDOWN_TIMEOUT_SECONDS)
     await close_mongo_connection()
     logger.info("💤 MongoDB Connection Closed.")
+    await close_redis_connection()
+    logger.info("💤 Redis Connection Pool Closed.")
+    await async_engine.dispose()
+    logger.info("💤 PostgreSQL Connection Pool Closed.")
 
 app = FastAPI(
     title="Audiophile Proof API",
@@ -57,6 +91,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 各階段耗時放進 Server-Timing header (除錯用，預設關閉)
+if settings.SERVER_TIMING_ENABLED:
+    app.add_middleware(ServerTimingMiddleware)
+
 Instrumentator().instrument(app).expose(app)
 
 os.makedirs("src/static", exist_ok=True)
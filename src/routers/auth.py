@@ -1,36 +1,68 @@
+import logging
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from src.db.postgres import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.db.postgres import get_async_db
 from src.models.user import User
 from src.schema.schemas import UserCreate, Token 
-from src.services.auth_service import verify_password, get_password_hash, create_access_token, get_current_user
+from src.services.auth_service import create_access_token, get_current_user, get_user_by_email
+from src.services.hashing import HashingPoolBusy, hash_password, verify_and_update_password
+from src.core.metrics import PASSWORD_REHASHES
 
 router = APIRouter()
+logger = logging.getLogger("uvicorn")
+
+# hash pool 滿了代表登入尖峰，請 client 稍後再試，而不是讓請求一直排隊
+def _hashing_busy():
+    return HTTPException(status_code=503, detail="Authentication is busy, please retry", headers={"Retry-After": "1"})
 
 @router.post("/register")
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
     # 檢查 Email 是否重複
-    if db.query(User).filter(User.email == user.email).first():
+    if await get_user_by_email(db, user.email):
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    # 建立新使用者
-    new_user = User(email=user.email, hashed_password=get_password_hash(user.password))
+    # 建立新使用者 (bcrypt 在專用的 hash pool 跑，不佔用 event loop 與 Starlette threadpool)
+    try:
+        hashed_password = await hash_password(user.password)
+    except HashingPoolBusy:
+        raise _hashing_busy()
+    new_user = User(email=user.email, hashed_password=hashed_password)
     db.add(new_user)
-    db.commit()
+    await db.commit()
     return {"msg": "Created successfully"}
 
 @router.post("/token", response_model=Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
     # 驗證帳號密碼
-    user = db.query(User).filter(User.email == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    user = await get_user_by_email(db, form_data.username)
+    if not user:
+        raise HTTPException(status_code=400, detail="Incorrect email or password")
+    try:
+        valid, new_hash = await verify_and_update_password(form_data.password, user.hashed_password)
+    except HashingPoolBusy:
+        raise _hashing_busy()
+    if not valid:
         raise HTTPException(status_code=400, detail="Incorrect email or password")
+
+    # rollback 會讓 ORM 物件過期，先把要用的欄位取出來
+    email = user.email
+
+    # BCRYPT_ROUNDS 改過：趁這次登入換成新成本的 hash
+    if new_hash:
+        try:
+            user.hashed_password = new_hash
+            await db.commit()
+            PASSWORD_REHASHES.inc()
+        except Exception as e:
+            # 寫不回去也不影響這次登入，下次登入會再試
+            await db.rollback()
+            logger.warning(f"Password rehash failed for {email}: {e}")
     
     # 發放 Token
-    access_token = create_access_token(data={"sub": user.email})
+    access_token = create_access_token(data={"sub": email})
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.get("/users/me")
 def read_users_me(current_user: User = Depends(get_current_user)):
-    return {"email": current_user.email, "id": current_user.id}
\ No newline at end of file
+    return {"email": current_user.email, "id": current_user.id}
@@ -1,78 +1,180 @@
-from fastapi import APIRouter, Depends, Request
-from typing import Optional
+import json
+import logging
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from typing import List, Optional
 from src.schema.schemas import HeadphoneRequest, TrackRecommendation
-from src.services.ai_service import analyze_headphone
-from src.services.music_service import search_track
-from src.db.redis import get_cached_recommendation, set_cached_recommendation
+from src.services.recommendation_service import (
+    compute_recommendation, schedule_refresh, stream_recommendation, iter_batch_recommendations
+)
+from src.services.normalizer import resolve_headphone
+from src.services.singleflight import SingleFlightTimeout
+from src.db.redis import get_cached_recommendation
 from src.db.mongo import log_request
 from src.models.user import User
 from jose import jwt
 from src.core.config import settings
-from src.db.postgres import get_db
-from sqlalchemy.orm import Session
+from src.core.responses import CachedJSONResponse
+from src.core.metrics import RECOMMEND_REQUESTS
+from src.core.timing import stage
+from src.db.postgres import get_async_db
+from src.services.user_cache import get_user_principal
+from src.services.rate_limit import RateLimitExceeded, check_request_limit, request_burst, request_subject
+from sqlalchemy.ext.asyncio import AsyncSession
 
 router = APIRouter()
+logger = logging.getLogger("uvicorn")
+
+def _cache_result(cached) -> str:
+    if cached is None:
+        return "miss"
+    if cached.degraded:
+        return "negative"
+    return "stale" if cached.is_stale else "hit"
 
 # 輔助：嘗試取得使用者但不強制
-async def get_optional_user(request: Request, db: Session = Depends(get_db)):
+async def get_optional_user(request: Request, db: AsyncSession = Depends(get_async_db)):
     auth = request.headers.get('Authorization')
     if not auth: 
         return None
     try:
         token = auth.split(" ")[1]
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
-        return db.query(User).filter(User.email == payload.get("sub")).first()
+        user = await get_user_principal(db, payload.get("sub"))
+        return user if user is not None and user.is_active else None
     except Exception: 
         return None
 
+def _too_many_requests(e: RateLimitExceeded) -> HTTPException:
+    return HTTPException(status_code=429, detail=str(e), headers=e.state.headers())
+
+# 依 user id (登入) 或 IP (匿名) 扣一般請求額度，RateLimit-* header 放在 response 上
+async def _enforce_request_limit(request: Request, response: Response, user: Optional[User], cost: int = 1):
+    try:
+        state = await check_request_limit(request_subject(request, user), cost)
+    except RateLimitExceeded as e:
+        raise _too_many_requests(e)
+    if state is not None:
+        response.headers.update(state.headers())
+
+# 單筆推薦端點共用的 dependency
+async def rate_limited_user(request: Request, response: Response, user: Optional[User] = Depends(get_optional_user)):
+    await _enforce_request_limit(request, response, user)
+    return user
+
 @router.post("", response_model=TrackRecommendation) 
-async def get_recommendation(request: HeadphoneRequest, user: Optional[User] = Depends(get_optional_user)):
-    # 1. Cache Check
-    cached = get_cached_recommendation(request.brand, request.model)
+async def get_recommendation(request: HeadphoneRequest, response: Response, user: Optional[User] = Depends(rate_limited_user)):
+    # 1. Cache Check (用正規化後的 canonical key，各種寫法共用同一份快取)
+    with stage("resolve"):
+        key = await resolve_headphone(request.brand, request.model)
+    with stage("cache"):
+        cached = await get_cached_recommendation(key.brand, key.model)
     user_id = str(user.id) if user else None
+    RECOMMEND_REQUESTS.labels(endpoint="recommend", result=_cache_result(cached)).inc()
     
     if cached:
-        await log_request("search_cache_hit", {"brand": request.brand, "model": request.model}, user_id)
-        return TrackRecommendation(**cached)
+        # 過了 soft TTL：先回舊資料，背景重算
+        if cached.is_stale:
+            schedule_refresh(key, request.brand, request.model)
+        headers = {"X-Cache-Status": "STALE" if cached.is_stale else "HIT", "Age": str(int(cached.age))}
+        if cached.degraded:
+            headers["X-Recommendation-Degraded"] = cached.degraded
+        log_request("search_cache_hit", {"brand": request.brand, "model": request.model}, user_id)
+        if settings.RECOMMEND_FAST_RESPONSE:
+            # 快取裡已經是驗證過、序列化好的 JSON，直接回傳 bytes (回傳 Response 物件時要自己帶 header)
+            return CachedJSONResponse(cached.body, headers={**response.headers, **headers})
+        response.headers.update(headers)
+        return TrackRecommendation(**cached.data)
 
-    # 2. AI Analysis
-    ai_data = await analyze_headphone(request.brand, request.model)
-    should_cache = True
-    
-    if not ai_data:
-        should_cache = False
-        ai_data = {"specs": {}, "sound_features": [], "song_query": "Hotel California - Eagles", "detailed_analysis": {}, "summary": "AI Busy"}
-
-    # 3. Spotify Search
-    track = await search_track(ai_data["song_query"])
-    if not track:
-        should_cache = False
-        track = {"name": ai_data["song_query"], "artists": [{"name": "Unknown"}], "album": {"images": [{"url": ""}]}, "external_urls": {"spotify": "#"}, "id": "unknown"}
-
-    # 4. Assembly
-    analysis = ai_data.get("detailed_analysis", {})
-    result = {
-        "form_factor": ai_data.get("specs", {}).get("form_factor", "N/A"),
-        "connection": ai_data.get("specs", {}).get("connection", "N/A"),
-        "release_year": ai_data.get("specs", {}).get("year", "N/A"),
-        "price_range": ai_data.get("specs", {}).get("price", "N/A"),
-        "driver_config": ai_data.get("specs", {}).get("driver", "N/A"),
-        "sound_features": ai_data.get("sound_features", []),
-        "analysis_bass": analysis.get("bass", "N/A"),
-        "analysis_mids": analysis.get("mids", "N/A"),
-        "analysis_highs": analysis.get("highs", "N/A"),
-        "listening_guide": analysis.get("guide", "N/A"),
-        "title": track["name"],
-        "artist": track["artists"][0]["name"],
-        "comment": ai_data.get("summary", ""),
-        "cover_url": track["album"]["images"][0]["url"] if track["album"]["images"] else "",
-        "spotify_url": track["external_urls"]["spotify"],
-        "track_id": track["id"],
-        "preview_url": track.get("preview_url")
-    }
-
-    if should_cache:
-        set_cached_recommendation(request.brand, request.model, result)
-    
-    await log_request("search_headphone", {"brand": request.brand, "model": request.model, "result": result["title"]}, user_id)
-    return TrackRecommendation(**result)
\ No newline at end of file
+    # 2. Cache Miss: AI + Spotify (併發請求會被合併成一次)
+    try:
+        result = await compute_recommendation(key, request.brand, request.model)
+    except RateLimitExceeded as e:
+        raise _too_many_requests(e)
+    except SingleFlightTimeout:
+        # 別的 replica 還在算同一支耳機，稍後再問就會命中快取
+        raise HTTPException(status_code=503, detail="Recommendation is still being computed", headers={"Retry-After": "5"})
+    response.headers["X-Cache-Status"] = "MISS"
+    response.headers["Age"] = "0"
+    if result.get("degraded"):
+        response.headers["X-Recommendation-Degraded"] = result["degraded"]
+
+    log_request("search_headphone", {"brand": request.brand, "model": request.model, "result": result["title"]}, user_id)
+    return TrackRecommendation(**result)
+
+
+def _sse(event: str, payload: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@router.get("/stream")
+async def stream_recommendation_events(brand: str, model: str, response: Response, user: Optional[User] = Depends(rate_limited_user)):
+    """SSE 版本：快取命中只送一個 result 事件；miss 時依序送 specs / sound_features / analysis，最後送 result。
+    result 的格式與 POST /recommend 相同。"""
+    user_id = str(user.id) if user else None
+
+    async def events():
+        with stage("resolve"):
+            key = await resolve_headphone(brand, model)
+        with stage("cache"):
+            cached = await get_cached_recommendation(key.brand, key.model)
+        RECOMMEND_REQUESTS.labels(endpoint="stream", result=_cache_result(cached)).inc()
+        if cached:
+            if cached.is_stale:
+                schedule_refresh(key, brand, model)
+            log_request("search_cache_hit", {"brand": brand, "model": model}, user_id)
+            if settings.RECOMMEND_FAST_RESPONSE:
+                # body 是單行 JSON，可以直接放進 data 欄位
+                yield f"event: result\ndata: {cached.body.decode()}\n\n"
+            else:
+                yield _sse("result", TrackRecommendation(**cached.data).model_dump())
+            return
+
+        try:
+            async for event, payload in stream_recommendation(key, brand, model):
+                if event == "result":
+                    log_request("search_headphone", {"brand": brand, "model": model, "result": payload["title"]}, user_id)
+                    payload = TrackRecommendation(**payload).model_dump()
+                yield _sse(event, payload)
+        # header 已經送出了，改用 error 事件告知 client
+        except RateLimitExceeded as e:
+            yield _sse("error", {"status": 429, "detail": str(e), "retry_after": e.state.headers()["Retry-After"]})
+        except Exception as e:
+            logger.error(f"Recommendation stream failed for {brand} {model}: {e}")
+            yield _sse("error", {"status": 500, "detail": "Recommendation failed"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # 關掉 proxy (nginx) 的 buffering，事件才會即時送出
+        headers={**response.headers, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.post("/batch")
+async def get_recommendations_batch(requests: List[HeadphoneRequest], http_request: Request, response: Response,
+                                    user: Optional[User] = Depends(get_optional_user)):
+    """一次查多支耳機，以 NDJSON 串流回傳：每完成一筆就送出一行。
+    每行包含 index (對應請求順序)、status (ok / error)，成功時帶 recommendation。
+    每一筆都扣一個請求額度，所以一次最多只能查 bucket 容量那麼多筆。"""
+    max_items = settings.RECOMMEND_BATCH_MAX_ITEMS
+    if settings.RATE_LIMIT_ENABLED:
+        max_items = min(max_items, request_burst(request_subject(http_request, user)))
+    if len(requests) > max_items:
+        raise HTTPException(status_code=400, detail=f"At most {max_items} headphones per batch")
+    await _enforce_request_limit(http_request, response, user, cost=max(len(requests), 1))
+    user_id = str(user.id) if user else None
+
+    async def lines():
+        pairs = [(r.brand, r.model) for r in requests]
+        async for item in iter_batch_recommendations(pairs):
+            RECOMMEND_REQUESTS.labels(endpoint="batch", result=item.get("cache", "error").lower()).inc()
+            if item["status"] == "ok":
+                item["recommendation"] = TrackRecommendation(**item["recommendation"]).model_dump()
+                event = "search_cache_hit" if item["cache"] != "MISS" else "search_headphone"
+                log_data = {"brand": item["brand"], "model": item["model"]}
+                if event == "search_headphone":
+                    log_data["result"] = item["recommendation"]["title"]
+                log_request(event, log_data, user_id)
+            yield json.dumps(item, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers=dict(response.headers))
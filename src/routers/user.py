@@ -1,12 +1,51 @@
-from fastapi import APIRouter, Depends, HTTPException
+import json
+import base64
+from fastapi import APIRouter, Depends, HTTPException, Query
 from datetime import datetime
+from typing import List, Optional
+from bson import ObjectId
 from pydantic import BaseModel
+from pymongo.errors import DuplicateKeyError
 from src.models.user import User
 from src.services.auth_service import get_current_user
 from src.db.mongo import get_database
+from src.db.redis import (
+    check_cached_favorites, get_favorites_generation, fill_favorites_set, add_cached_favorite, remove_cached_favorite
+)
+from src.core.config import settings
 
 router = APIRouter()
 
+# --- Keyset 分頁：cursor = 上一頁最後一筆的 (時間, _id)，對 client 來說是不透明字串 ---
+def _encode_cursor(ts: datetime, oid: ObjectId) -> str:
+    raw = json.dumps({"ts": ts.isoformat(), "id": str(oid)}).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        return datetime.fromisoformat(payload["ts"]), ObjectId(payload["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _after(field: str, cursor: Optional[str]) -> dict:
+    """時間倒序時「比 cursor 更舊」的條件；同一時間用 _id 決勝負，不會漏也不會重複。"""
+    if not cursor:
+        return {}
+    ts, oid = _decode_cursor(cursor)
+    return {"$or": [{field: {"$lt": ts}}, {field: ts, "_id": {"$lt": oid}}]}
+
+def _page(docs: list, limit: int, field: str) -> dict:
+    # 多查一筆來判斷還有沒有下一頁
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    next_cursor = _encode_cursor(docs[-1][field], docs[-1]["_id"]) if has_more else None
+    for doc in docs:
+        doc.pop("_id", None)
+        doc.pop(field, None)
+    return {"items": docs, "next_cursor": next_cursor}
+
 class FavoriteRequest(BaseModel):
     track_id: str
     title: str
@@ -14,29 +53,44 @@ class FavoriteRequest(BaseModel):
     cover_url: str
     spotify_url: str
 
+class FavoriteCheckRequest(BaseModel):
+    track_ids: List[str]
+
 @router.post("/favorites")
 async def add_favorite(fav: FavoriteRequest, user: User = Depends(get_current_user), db = Depends(get_database)):
     fav_col = db["favorites"]
-    
-    if await fav_col.find_one({"user_id": str(user.id), "track_id": fav.track_id}):
+    user_id = str(user.id)
+
+    # 單次 upsert：已存在就什麼都不改，靠 (user_id, track_id) unique index 防止重複
+    data = fav.model_dump(exclude={"track_id"})
+    data["added_at"] = datetime.utcnow()
+    try:
+        res = await fav_col.update_one(
+            {"user_id": user_id, "track_id": fav.track_id},
+            {"$setOnInsert": data},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # 同一首歌的兩個請求同時 upsert，晚到的那個會撞到 unique index
         return {"status": "exists"}
-    
-    data = fav.model_dump()
-    data.update({"user_id": str(user.id), "added_at": datetime.utcnow()})
-    
-    await fav_col.insert_one(data)
-    return {"status": "added"}
+    await add_cached_favorite(user_id, fav.track_id)
+    return {"status": "added" if res.upserted_id is not None else "exists"}
+
+# 前端收藏頁實際會用到的欄位 (_id / added_at 只拿來算 cursor)
+_FAVORITE_FIELDS = {"_id": 1, "added_at": 1, "track_id": 1, "title": 1, "artist": 1, "cover_url": 1, "spotify_url": 1}
 
 @router.get("/favorites")
-async def get_favorites(user: User = Depends(get_current_user), db = Depends(get_database)):
+async def get_favorites(
+    limit: int = Query(50, ge=1, le=100),
+    cursor: Optional[str] = None,
+    user: User = Depends(get_current_user),
+    db = Depends(get_database),
+):
+    """最新收藏在前；回傳 {items, next_cursor}，next_cursor 為 null 代表沒有下一頁。"""
     fav_col = db["favorites"]
-    cursor = fav_col.find({"user_id": str(user.id)})
-    favorites = await cursor.to_list(length=100)
-
-    for fav in favorites:
-        if "_id" in fav:
-            fav["_id"] = str(fav["_id"])
-    return favorites
+    query = {"user_id": str(user.id), **_after("added_at", cursor)}
+    docs = await fav_col.find(query, _FAVORITE_FIELDS).sort([("added_at", -1), ("_id", -1)]).limit(limit + 1).to_list(length=limit + 1)
+    return _page(docs, limit, "added_at")
 
 @router.delete("/favorites/{track_id}")
 async def remove_favorite(track_id: str, user: User = Depends(get_current_user), db = Depends(get_database)):
@@ -44,24 +98,59 @@ async def remove_favorite(track_id: str, user: User = Depends(get_current_user),
     res = await fav_col.delete_one({"user_id": str(user.id), "track_id": track_id})
     if res.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Favorite not found")
+    await remove_cached_favorite(str(user.id), track_id)
     return {"status": "removed"}
 
+async def _favorite_flags(user_id: str, track_ids: List[str], db) -> List[bool]:
+    """先查 Redis 的收藏集合；集合不存在就從 MongoDB 撈一次全部 track_id 重建。"""
+    if not track_ids:
+        return []
+    flags = await check_cached_favorites(user_id, track_ids)
+    if flags is not None:
+        return flags
+    # 版本號要在讀 MongoDB 之前拿，重建期間有移除的話 fill_favorites_set 會放棄寫入
+    generation = await get_favorites_generation(user_id)
+    docs = await db["favorites"].find({"user_id": user_id}, {"_id": 0, "track_id": 1}).to_list(length=None)
+    favorited = {doc["track_id"] for doc in docs}
+    if generation is not None:
+        await fill_favorites_set(user_id, list(favorited), generation)
+    return [track_id in favorited for track_id in track_ids]
+
+@router.post("/favorites/check")
+async def check_favs(req: FavoriteCheckRequest, user: User = Depends(get_current_user), db = Depends(get_database)):
+    """一次查多首歌是否已收藏，回傳 {"favorited": {track_id: bool}}。"""
+    if len(req.track_ids) > settings.FAVORITE_CHECK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {settings.FAVORITE_CHECK_MAX_ITEMS} track_ids per check")
+    track_ids = list(dict.fromkeys(req.track_ids))
+    flags = await _favorite_flags(str(user.id), track_ids, db)
+    return {"favorited": dict(zip(track_ids, flags))}
+
 @router.get("/favorites/check/{track_id}")
 async def check_fav(track_id: str, user: User = Depends(get_current_user), db = Depends(get_database)):
-    fav_col = db["favorites"]
-    exists = await fav_col.find_one({"user_id": str(user.id), "track_id": track_id})
-    return {"is_favorited": bool(exists)}
+    flags = await _favorite_flags(str(user.id), [track_id], db)
+    return {"is_favorited": flags[0]}
 
 @router.get("/history")
-async def get_history(user: User = Depends(get_current_user), db = Depends(get_database)):
+async def get_history(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    user: User = Depends(get_current_user),
+    db = Depends(get_database),
+):
+    """最新搜尋在前；回傳 {items, next_cursor}。時間格式化直接在 MongoDB 做。"""
     log_col = db["logs"]
-    cursor = log_col.find({"user_id": str(user.id), "event": "search_headphone"}).sort("timestamp", -1).limit(20)
-    results = []
-    async for doc in cursor:
-        results.append({
-            "brand": doc["data"].get("brand"),
-            "model": doc["data"].get("model"),
-            "result_song": doc["data"].get("result"),
-            "timestamp": doc.get("timestamp", datetime.utcnow()).strftime("%Y-%m-%d %H:%M")
-        })
-    return results
\ No newline at end of file
+    pipeline = [
+        {"$match": {"user_id": str(user.id), "event": "search_headphone", **_after("timestamp", cursor)}},
+        {"$sort": {"timestamp": -1, "_id": -1}},
+        {"$limit": limit + 1},
+        {"$project": {
+            "_id": 1,
+            "ts": "$timestamp",
+            "brand": "$data.brand",
+            "model": "$data.model",
+            "result_song": "$data.result",
+            "timestamp": {"$dateToString": {"format": "%Y-%m-%d %H:%M", "date": "$timestamp"}},
+        }},
+    ]
+    docs = await log_col.aggregate(pipeline).to_list(length=limit + 1)
+    return _page(docs, limit, "ts")
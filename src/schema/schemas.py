@@ -1,5 +1,8 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional
+
+# 降級結果的原因：upstream_error (Gemini / Spotify 失敗) / no_track (Spotify 找不到推薦的歌) / unparseable (AI 輸出無法解析)
+DegradedReason = Literal["upstream_error", "no_track", "unparseable"]
 
 # --- 既有的耳機推薦 Schema ---
 class HeadphoneRequest(BaseModel):
@@ -32,6 +35,9 @@ class TrackRecommendation(BaseModel):
     track_id: str
     preview_url: Optional[str] = None
 
+    # 有值代表這是 fallback 結果 (只會短暫快取，上游恢復後會被正確結果取代)
+    degraded: Optional[DegradedReason] = None
+
 # --- 使用者驗證相關 Schema ---
 
 # 註冊與登入用的 
@@ -1,48 +1,277 @@
 import json
-import time
+import random
+import asyncio
+from typing import Callable, List, Optional, Tuple
 from google import genai
 from google.genai import types
 from src.core.config import settings
+from src.core.metrics import UPSTREAM_ERRORS, UPSTREAM_RETRIES
+from src.core.timing import upstream_call
+from src.services.resilience import UpstreamUnavailable, upstream_guard
 
-client = genai.Client(api_key=settings.GEMINI_API_KEY)
+# prompt 內容有改就要跳版本，MongoDB 裡舊版本的分析會被視為不存在
+PROMPT_VERSION = "v1"
 
-async def analyze_headphone(brand: str, model: str):
-    try:
-        if not settings.GEMINI_API_KEY:
-            print("警告: 未設定 GEMINI_API_KEY")
-            return None
-            
-        client = genai.Client(api_key=settings.GEMINI_API_KEY)
-    except Exception as e:
-        print(f"Gemini Client 初始化失敗: {e}")
-        return None
-    
-    prompt = f"""
-    使用者正在查詢耳機：{brand} {model}。
-    請扮演一位「想推別人入坑的耳機發燒友」，提供深度的聽感分析。
-    請回傳 JSON (不要 Markdown):
-    {{
-        "specs": {{ "form_factor": "...", "connection": "...", "year": "...", "price": "...", "driver": "..." }},
+# 整個 process 共用一個 client，不要每次請求都重建
+client = genai.Client(api_key=settings.GEMINI_API_KEY) if settings.GEMINI_API_KEY else None
+
+# 斷路器 + 自適應併發上限 (最多 GEMINI_MAX_CONCURRENCY)：Gemini 變慢時少送一點，掛掉時直接走 fallback
+gemini_guard = upstream_guard(
+    "gemini",
+    failure_threshold=settings.GEMINI_BREAKER_FAILURE_THRESHOLD,
+    reset_seconds=settings.GEMINI_BREAKER_RESET_SECONDS,
+    min_limit=settings.GEMINI_MIN_CONCURRENCY,
+    max_limit=settings.GEMINI_MAX_CONCURRENCY,
+    latency_target=settings.GEMINI_LATENCY_TARGET_SECONDS,
+    queue_timeout=settings.GEMINI_QUEUE_TIMEOUT_SECONDS,
+)
+
+def _backoff_delay(attempt: int) -> float:
+    # Full jitter: 0 ~ min(cap, base * 2^attempt)
+    cap = min(settings.GEMINI_BACKOFF_MAX_SECONDS, settings.GEMINI_BACKOFF_BASE_SECONDS * (2 ** attempt))
+    return random.uniform(0, cap)
+
+# 單支與批次 prompt 共用的輸出格式
+# 欄位順序很重要：串流時 specs / sound_features 會最先完整出現
+_ANALYSIS_SCHEMA = """{
+        "specs": { "form_factor": "...", "connection": "...", "year": "...", "price": "...", "driver": "..." },
         "sound_features": ["特色1", "特色2"],
-        "detailed_analysis": {{
+        "detailed_analysis": {
             "bass": "低頻描述...", "mids": "中頻描述...", "highs": "高頻描述...", "guide": "試聽指南..."
-        }},
+        },
         "song_query": "Song Name - Artist",
         "summary": "一句話總評這支耳機的特點和不足"
-    }}
+    }"""
+
+def _build_prompt(brand: str, model: str) -> str:
+    return f"""
+    使用者正在查詢耳機：{brand} {model}。
+    請扮演一位「想推別人入坑的耳機發燒友」，提供深度的聽感分析。
+    請回傳 JSON (不要 Markdown):
+    {_ANALYSIS_SCHEMA}
+    """
+
+def _build_batch_prompt(pairs: List[Tuple[str, str]]) -> str:
+    headphones = "\n".join(f"    {i}. {brand} {model}" for i, (brand, model) in enumerate(pairs))
+    return f"""
+    以下是 {len(pairs)} 支耳機 (以 id 編號)：
+{headphones}
+    請扮演一位「想推別人入坑的耳機發燒友」，為每一支耳機分別提供深度的聽感分析。
+    請回傳 JSON 陣列 (不要 Markdown)，每支耳機一個元素，id 必須與上面的編號相同:
+    [
+      {{ "id": 0, "analysis": {_ANALYSIS_SCHEMA} }}
+    ]
     """
+
+def _is_usable(data) -> bool:
+    # 單支分析的最低要求：至少要有可以拿去 Spotify 搜尋的 song_query
+    return isinstance(data, dict) and isinstance(data.get("song_query"), str) and bool(data["song_query"].strip())
+
+async def analyze_headphone_with_reason(brand: str, model: str) -> Tuple[Optional[dict], Optional[str]]:
+    """回傳 (分析結果, 失敗原因)；失敗原因為 upstream_error 或 unparseable (以最後一次嘗試為準)。"""
+    if client is None:
+        print("警告: 未設定 GEMINI_API_KEY")
+        return None, "upstream_error"
     
-    for attempt in range(3):
-        try:
-            # print(f"AI 分析中... (Attempt {attempt+1})")
-            resp = client.models.generate_content(
-                model="gemini-2.5-flash", contents=prompt,
-                config=types.GenerateContentConfig(response_mime_type="application/json")
+    prompt = _build_prompt(brand, model)
+
+    async def generate():
+        with upstream_call("gemini"):
+            return await asyncio.wait_for(
+                client.aio.models.generate_content(
+                    model=settings.GEMINI_MODEL, contents=prompt,
+                    config=types.GenerateContentConfig(response_mime_type="application/json")
+                ),
+                timeout=settings.GEMINI_TIMEOUT_SECONDS,
             )
-            return json.loads(resp.text)
+    
+    reason = "upstream_error"
+    for attempt in range(settings.GEMINI_MAX_RETRIES):
+        try:
+            # 只在真正呼叫時佔用名額，backoff 等待期間不佔
+            resp = await gemini_guard.call(generate)
+            data = json.loads(resp.text)
+            if _is_usable(data):
+                return data, None
+            reason = "unparseable"
+            UPSTREAM_ERRORS.labels(upstream="gemini", type="unusable_output").inc()
+            print(f"Gemini returned unusable analysis for {brand} {model}")
+        except UpstreamUnavailable as e:
+            # 斷路中 / 排不到名額：不再重試，直接讓呼叫端走 fallback
+            print(f"Gemini unavailable, skipping {brand} {model}: {e}")
+            return None, "upstream_error"
+        except json.JSONDecodeError as e:
+            reason = "unparseable"
+            UPSTREAM_ERRORS.labels(upstream="gemini", type="JSONDecodeError").inc()
+            print(f"Gemini returned invalid JSON for {brand} {model}: {e}")
+        except asyncio.TimeoutError:
+            reason = "upstream_error"
+            UPSTREAM_ERRORS.labels(upstream="gemini", type="timeout").inc()
+            print(f"Gemini Timeout ({settings.GEMINI_TIMEOUT_SECONDS}s) for {brand} {model}")
         except Exception as e:
+            reason = "upstream_error"
+            UPSTREAM_ERRORS.labels(upstream="gemini", type=type(e).__name__).inc()
             print(f"Gemini Error: {e}")
-            if attempt == 2: 
-                return None 
-            time.sleep(1)
-    return None
\ No newline at end of file
+        if attempt < settings.GEMINI_MAX_RETRIES - 1:
+            UPSTREAM_RETRIES.labels(upstream="gemini").inc()
+            await asyncio.sleep(_backoff_delay(attempt))
+    return None, reason
+
+async def analyze_headphone(brand: str, model: str):
+    data, _ = await analyze_headphone_with_reason(brand, model)
+    return data
+
+
+# --- 批次模式：一個 prompt 分析多支耳機，省下重複的前言與 round trip ---
+def is_valid_analysis(data) -> bool:
+    """檢查單支耳機的分析結果是否符合 _ANALYSIS_SCHEMA 的基本結構。"""
+    return (
+        isinstance(data, dict)
+        and isinstance(data.get("specs"), dict)
+        and isinstance(data.get("sound_features"), list)
+        and isinstance(data.get("detailed_analysis"), dict)
+        and isinstance(data.get("song_query"), str) and bool(data["song_query"].strip())
+        and isinstance(data.get("summary"), str)
+    )
+
+async def _analyze_chunk(pairs: List[Tuple[str, str]]) -> List[Optional[dict]]:
+    results: List[Optional[dict]] = [None] * len(pairs)
+
+    async def generate():
+        with upstream_call("gemini", "gemini_batch"):
+            return await asyncio.wait_for(
+                client.aio.models.generate_content(
+                    model=settings.GEMINI_MODEL, contents=_build_batch_prompt(pairs),
+                    config=types.GenerateContentConfig(response_mime_type="application/json")
+                ),
+                timeout=settings.GEMINI_BATCH_TIMEOUT_SECONDS,
+            )
+
+    try:
+        # 批次回應本來就比較慢，不拿來調整併發上限
+        resp = await gemini_guard.call(generate, measure_latency=False)
+        items = json.loads(resp.text)
+    except UpstreamUnavailable as e:
+        print(f"Gemini Batch skipped ({len(pairs)} headphones): {e}")
+        return results
+    except Exception as e:
+        error_type = "timeout" if isinstance(e, asyncio.TimeoutError) else type(e).__name__
+        UPSTREAM_ERRORS.labels(upstream="gemini", type=error_type).inc()
+        print(f"Gemini Batch Error ({len(pairs)} headphones): {e}")
+        return results
+
+    if not isinstance(items, list):
+        return results
+    # 逐筆驗證，壞掉的那幾筆留 None 讓呼叫端改用單支分析
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("id"), int):
+            continue
+        index = item["id"]
+        if 0 <= index < len(pairs) and is_valid_analysis(item.get("analysis")):
+            results[index] = item["analysis"]
+    return results
+
+async def analyze_headphones_batch(pairs: List[Tuple[str, str]]) -> List[Optional[dict]]:
+    """批次分析多支耳機，回傳順序與 pairs 相同。
+
+    每 GEMINI_BATCH_SIZE 支打包成一個請求；解析失敗或缺漏的項目退回 analyze_headphone 單支重試。
+    """
+    if client is None:
+        print("警告: 未設定 GEMINI_API_KEY")
+        return [None] * len(pairs)
+
+    size = settings.GEMINI_BATCH_SIZE
+    chunks = [pairs[i:i + size] for i in range(0, len(pairs), size)]
+    chunk_results = await asyncio.gather(*[_analyze_chunk(chunk) for chunk in chunks])
+    results = [r for chunk in chunk_results for r in chunk]
+
+    missing = [i for i, r in enumerate(results) if r is None]
+    if missing:
+        print(f"Gemini Batch: {len(missing)}/{len(pairs)} headphones fell back to single analysis")
+        fallbacks = await asyncio.gather(*[analyze_headphone(*pairs[i]) for i in missing])
+        for i, data in zip(missing, fallbacks):
+            results[i] = data
+    return results
+
+
+# --- 串流模式：一邊接收 Gemini 的 JSON，一邊把已完整的欄位交出去 ---
+_decoder = json.JSONDecoder()
+
+def _skip_ws(text: str, i: int) -> int:
+    while i < len(text) and text[i] in " \t\r\n":
+        i += 1
+    return i
+
+def parse_completed_fields(text: str) -> dict:
+    """從還沒傳完的 JSON 物件文字中，取出已經完整的頂層欄位。
+
+    值後面必須已經出現 ',' 或 '}' 才算完整 (避免數字被截斷，例如 "12" 其實是 "120")。
+    """
+    fields = {}
+    i = text.find("{")
+    if i < 0:
+        return fields
+    i += 1
+    while True:
+        i = _skip_ws(text, i)
+        if i >= len(text) or text[i] == "}":
+            break
+        try:
+            key, i = _decoder.raw_decode(text, i)
+            i = _skip_ws(text, i)
+            if i >= len(text) or text[i] != ":":
+                break
+            value, i = _decoder.raw_decode(text, _skip_ws(text, i + 1))
+        except json.JSONDecodeError:
+            break
+        i = _skip_ws(text, i)
+        if i >= len(text) or text[i] not in ",}":
+            break
+        fields[key] = value
+        i += 1
+    return fields
+
+async def stream_headphone_analysis(brand: str, model: str, on_fields: Callable[[dict], None]):
+    """用 generate_content_stream 分析耳機；每當有新的頂層欄位完整時呼叫 on_fields。
+    回傳完整的 dict，失敗回傳 None (由呼叫端決定要不要改用 analyze_headphone)。"""
+    if client is None:
+        print("警告: 未設定 GEMINI_API_KEY")
+        return None
+
+    text = ""
+    emitted = set()
+
+    async def consume():
+        nonlocal text
+        stream = await client.aio.models.generate_content_stream(
+            model=settings.GEMINI_MODEL, contents=_build_prompt(brand, model),
+            config=types.GenerateContentConfig(response_mime_type="application/json")
+        )
+        async for chunk in stream:
+            text += chunk.text or ""
+            new_fields = {k: v for k, v in parse_completed_fields(text).items() if k not in emitted}
+            if new_fields:
+                emitted.update(new_fields)
+                on_fields(new_fields)
+
+    async def consume_with_timeout():
+        with upstream_call("gemini", "gemini_stream"):
+            await asyncio.wait_for(consume(), timeout=settings.GEMINI_TIMEOUT_SECONDS)
+
+    try:
+        await gemini_guard.call(consume_with_timeout, measure_latency=False)
+        data = json.loads(text)
+        if _is_usable(data):
+            return data
+        # 與非串流路徑一樣的驗證；不合格就回 None，讓呼叫端改用 analyze_headphone_with_reason
+        UPSTREAM_ERRORS.labels(upstream="gemini", type="unusable_output").inc()
+        print(f"Gemini Stream returned unusable output for {brand} {model}")
+    except UpstreamUnavailable as e:
+        print(f"Gemini Stream skipped for {brand} {model}: {e}")
+    except asyncio.TimeoutError:
+        UPSTREAM_ERRORS.labels(upstream="gemini", type="timeout").inc()
+        print(f"Gemini Stream Timeout ({settings.GEMINI_TIMEOUT_SECONDS}s) for {brand} {model}")
+    except Exception as e:
+        UPSTREAM_ERRORS.labels(upstream="gemini", type=type(e).__name__).inc()
+        print(f"Gemini Stream Error: {e}")
+    return None
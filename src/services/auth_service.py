@@ -1,14 +1,15 @@
 from datetime import datetime, timedelta
 from jose import jwt, JWTError
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from src.db.postgres import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from src.db.postgres import get_async_db
 from src.models.user import User
 from src.core.config import settings
+from src.services.user_cache import get_user_principal
+from src.services.hashing import pwd_context
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 def verify_password(plain, hashed): return pwd_context.verify(plain, hashed)
@@ -20,7 +21,11 @@ def create_access_token(data: dict):
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(User).where(User.email == email))
+    return result.scalars().first()
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
     try:
         payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
         email: str = payload.get("sub")
@@ -29,7 +34,8 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     except JWTError: 
         raise HTTPException(status_code=401)
     
-    user = db.query(User).filter(User.email == email).first()
-    if user is None: 
+    # 先查 principal 快取，大部分請求不用碰 PostgreSQL
+    user = await get_user_principal(db, email)
+    if user is None or not user.is_active:
         raise HTTPException(status_code=401)
     return user
\ No newline at end of file
@@ -0,0 +1,77 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple
+from passlib.context import CryptContext
+from src.core.config import settings
+from src.core.metrics import HASH_QUEUE_DEPTH, HASH_REJECTED
+
+# min / max 都設成目前的成本：成本不同的舊 hash 在驗證成功時會被要求更新
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=settings.BCRYPT_ROUNDS,
+)
+
+
+class HashingPoolBusy(Exception):
+    """排隊中的 hash 工作已達 HASH_MAX_PENDING。"""
+
+
+# 丟進 executor 的必須是 module-level function (process pool 要能 pickle)
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+def _verify_and_update(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed)
+
+
+class HashingPool:
+    """bcrypt 專用的 executor：max_workers 限制同時計算的數量，max_pending 限制排隊長度。
+
+    只在 event loop 上呼叫 run()，計數不需要 lock。
+    """
+
+    def __init__(self, kind: str, max_workers: int, max_pending: int):
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor: Optional[Executor] = None
+        self._pending = 0
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    async def run(self, fn, *args):
+        if self._pending >= self.max_pending:
+            HASH_REJECTED.inc()
+            raise HashingPoolBusy()
+        self._pending += 1
+        HASH_QUEUE_DEPTH.set(self._pending)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), fn, *args)
+        finally:
+            self._pending -= 1
+            HASH_QUEUE_DEPTH.set(self._pending)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+hashing_pool = HashingPool(settings.HASH_EXECUTOR, settings.HASH_MAX_WORKERS, settings.HASH_MAX_PENDING)
+
+
+async def hash_password(password: str) -> str:
+    return await hashing_pool.run(_hash, password)
+
+async def verify_and_update_password(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """回傳 (是否正確, 新 hash)；bcrypt 成本跟設定不同時才會有新 hash，否則為 None。"""
+    return await hashing_pool.run(_verify_and_update, password, hashed)
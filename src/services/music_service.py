@@ -1,28 +1,175 @@
-import httpx
+import re
+import time
 import base64
+import asyncio
+import unicodedata
+import httpx
 from src.core.config import settings
+from src.core.metrics import SPOTIFY_CACHE_LOOKUPS, UPSTREAM_ERRORS, UPSTREAM_RETRIES
+from src.core.timing import upstream_call
+from src.services.resilience import UpstreamUnavailable, upstream_guard
+from src.db.redis import get_cached_track, set_cached_track
+
+TOKEN_URL = "https://accounts.spotify.com/api/token"
+SEARCH_URL = "https://api.spotify.com/v1/search"
+
+
+class SpotifyError(Exception):
+    """Spotify 暫時無法使用 (拿不到 token / 非預期的 HTTP 狀態)，結果不可快取。
+    kind 是給 metrics 用的錯誤類型 (token / unauthorized / http_<status>)。"""
+
+    def __init__(self, message: str, kind: str = "error"):
+        super().__init__(message)
+        self.kind = kind
+
+
+class SpotifyClient:
+    """跟著 app lifespan 走的 Spotify client。
+
+    - 共用一個 httpx.AsyncClient (HTTP/2 + keep-alive)，TLS 連線可以重複使用。
+    - client-credentials token 快取到 expires_in 前一點點，併發時只會刷新一次。
+    """
+
+    def __init__(self):
+        self._http: httpx.AsyncClient = None
+        self._token: str = None
+        self._token_expires_at: float = 0.0
+        self._token_lock = asyncio.Lock()
+
+    async def start(self):
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                http2=True,
+                timeout=settings.SPOTIFY_TIMEOUT_SECONDS,
+                limits=httpx.Limits(
+                    max_connections=settings.SPOTIFY_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.SPOTIFY_MAX_KEEPALIVE_CONNECTIONS,
+                ),
+            )
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def _token_valid(self) -> bool:
+        return self._token is not None and time.monotonic() < self._token_expires_at
+
+    async def get_token(self, force_refresh: bool = False):
+        if not force_refresh and self._token_valid():
+            return self._token
+
+        async with self._token_lock:
+            # 拿到鎖之後再檢查一次：可能已經有人刷新好了
+            if not force_refresh and self._token_valid():
+                return self._token
+            await self.start()
+
+            auth_str = f"{settings.SPOTIFY_CLIENT_ID}:{settings.SPOTIFY_CLIENT_SECRET}"
+            b64_auth = base64.b64encode(auth_str.encode()).decode()
+            with upstream_call("spotify", "spotify_token"):
+                resp = await self._http.post(
+                    TOKEN_URL,
+                    headers={"Authorization": f"Basic {b64_auth}"},
+                    data={"grant_type": "client_credentials"}
+                )
+            payload = resp.json()
+            token = payload.get("access_token")
+            if not token:
+                self._token = None
+                return None
+
+            expires_in = payload.get("expires_in", 3600)
+            self._token = token
+            self._token_expires_at = time.monotonic() + max(expires_in - settings.SPOTIFY_TOKEN_REFRESH_MARGIN_SECONDS, 0)
+            return token
+
+    async def search(self, query: str, market: str = None):
+        await self.start()
+        force_refresh = False
+        # token 被 Spotify 提早撤銷 (401) 時，強制刷新後重試一次
+        for _ in range(2):
+            token = await self.get_token(force_refresh=force_refresh)
+            if not token:
+                raise SpotifyError("Failed to obtain Spotify access token", kind="token")
+
+            with upstream_call("spotify"):
+                resp = await self._http.get(
+                    SEARCH_URL,
+                    headers={"Authorization": f"Bearer {token}"},
+                    params={"q": query, "type": "track", "limit": 1, "market": market or settings.SPOTIFY_MARKET}
+                )
+            if resp.status_code == 401:
+                UPSTREAM_RETRIES.labels(upstream="spotify").inc()
+                force_refresh = True
+                continue
+            if resp.status_code != 200:
+                raise SpotifyError(f"Spotify search returned {resp.status_code}", kind=f"http_{resp.status_code}")
+            items = resp.json().get("tracks", {}).get("items", [])
+            return items[0] if items else None
+        raise SpotifyError("Spotify rejected a freshly issued token", kind="unauthorized")
+
+
+spotify_client = SpotifyClient()
+
+# 斷路器 + 自適應併發上限 (最多 SPOTIFY_MAX_CONNECTIONS)，一次 search (含 token 刷新) 算一次呼叫
+spotify_guard = upstream_guard(
+    "spotify",
+    failure_threshold=settings.SPOTIFY_BREAKER_FAILURE_THRESHOLD,
+    reset_seconds=settings.SPOTIFY_BREAKER_RESET_SECONDS,
+    min_limit=settings.SPOTIFY_MIN_CONCURRENCY,
+    max_limit=settings.SPOTIFY_MAX_CONNECTIONS,
+    latency_target=settings.SPOTIFY_LATENCY_TARGET_SECONDS,
+    queue_timeout=settings.SPOTIFY_QUEUE_TIMEOUT_SECONDS,
+)
 
 async def get_spotify_token():
-    auth_str = f"{settings.SPOTIFY_CLIENT_ID}:{settings.SPOTIFY_CLIENT_SECRET}"
-    b64_auth = base64.b64encode(auth_str.encode()).decode()
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            "https://accounts.spotify.com/api/token", 
-            headers={"Authorization": f"Basic {b64_auth}"}, 
-            data={"grant_type": "client_credentials"}
-        )
-        return resp.json().get("access_token")
+    return await spotify_client.get_token()
+
+def normalize_song_query(query: str) -> str:
+    """NFKC + 小寫 + 合併空白，讓 "Hotel California - Eagles" 的各種寫法命中同一個 key。"""
+    query = unicodedata.normalize("NFKC", query).casefold()
+    return re.sub(r"\s+", " ", query).strip()
+
+def _slim_track(track: dict) -> dict:
+    # 只保留組裝推薦時會用到的欄位，快取體積小很多
+    images = track.get("album", {}).get("images", [])
+    return {
+        "id": track["id"],
+        "name": track["name"],
+        "artists": [{"name": a["name"]} for a in track.get("artists", [])[:1]],
+        "album": {"images": images[:1]},
+        "external_urls": {"spotify": track.get("external_urls", {}).get("spotify", "#")},
+        "preview_url": track.get("preview_url"),
+    }
+
+async def lookup_track(query: str):
+    """回傳 (track, 失敗原因)；找不到歌是 no_track，Spotify 出錯 / 斷路是 upstream_error。"""
+    market = settings.SPOTIFY_MARKET
+    normalized = normalize_song_query(query)
+
+    found, track = await get_cached_track(normalized, market)
+    if found:
+        SPOTIFY_CACHE_LOOKUPS.labels(result="hit" if track else "negative_hit").inc()
+        return track, None if track else "no_track"
+    SPOTIFY_CACHE_LOOKUPS.labels(result="miss").inc()
+
+    try:
+        track = await spotify_guard.call(lambda: spotify_client.search(query, market))
+    except UpstreamUnavailable as e:
+        # 斷路中：不打 Spotify 也不寫快取，直接用 fallback 歌曲
+        print(f"Spotify unavailable: {e}")
+        return None, "upstream_error"
+    except (httpx.HTTPError, SpotifyError) as e:
+        # 上游錯誤不寫快取，下次再試
+        UPSTREAM_ERRORS.labels(upstream="spotify", type=getattr(e, "kind", type(e).__name__)).inc()
+        print(f"Spotify Error: {e}")
+        return None, "upstream_error"
+
+    track = _slim_track(track) if track else None
+    await set_cached_track(normalized, market, track)
+    return track, None if track else "no_track"
 
 async def search_track(query: str):
-    token = await get_spotify_token()
-    if not token: 
-        return None
-    
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            "https://api.spotify.com/v1/search",
-            headers={"Authorization": f"Bearer {token}"}, 
-            params={"q": query, "type": "track", "limit": 1, "market": "TW"}
-        )
-        items = resp.json().get("tracks", {}).get("items", [])
-        return items[0] if items else None
\ No newline at end of file
+    track, _ = await lookup_track(query)
+    return track
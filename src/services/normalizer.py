@@ -0,0 +1,149 @@
+"""耳機名稱正規化：讓 "HD800S" / "HD 800 S" / "hd-800s" / "Sennheiser HD800 S " 對到同一個 cache key。
+
+1. 規則正規化：NFKC + casefold + 去除重音符號 + 去掉空白與標點，品牌套用同義詞表。
+2. Alias index (Redis)：記錄「變體 -> canonical key」，以及每個品牌已知的型號。
+3. Fuzzy fallback：新的寫法找不到時，用 difflib 比對同品牌已知型號，命中就寫回 alias index (有 TTL)。
+"""
+import re
+import difflib
+import unicodedata
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+from src.core.config import settings
+from src.core.metrics import HEADPHONE_RESOLUTIONS
+from src.db.local_cache import TTLLRUCache
+from src.db.redis import get_headphone_alias, set_headphone_alias, get_known_brands, get_known_models, is_known_model
+
+# 常見品牌的別名 / 中文名 -> canonical brand (key 與 value 都是正規化後的形式)
+BRAND_SYNONYMS = {
+    "sennheiser": "sennheiser", "senn": "sennheiser", "森海塞爾": "sennheiser", "森海塞尔": "sennheiser", "森海": "sennheiser",
+    "sony": "sony", "索尼": "sony",
+    "audiotechnica": "audiotechnica", "at": "audiotechnica", "鐵三角": "audiotechnica", "铁三角": "audiotechnica",
+    "beyerdynamic": "beyerdynamic", "beyer": "beyerdynamic", "拜亞動力": "beyerdynamic", "拜亚动力": "beyerdynamic",
+    "akg": "akg", "愛科技": "akg", "爱科技": "akg",
+    "shure": "shure", "舒爾": "shure", "舒尔": "shure",
+    "bose": "bose", "博士": "bose",
+    "apple": "apple", "蘋果": "apple", "苹果": "apple",
+    "focal": "focal", "hifiman": "hifiman", "audeze": "audeze", "grado": "grado",
+    "moondrop": "moondrop", "水月雨": "moondrop",
+    "fiio": "fiio", "飛傲": "fiio", "飞傲": "fiio",
+    "philips": "philips", "飛利浦": "philips", "飞利浦": "philips",
+    "bangolufsen": "bangolufsen", "bo": "bangolufsen",
+    "bowerswilkins": "bowerswilkins", "bw": "bowerswilkins",
+    "samsung": "samsung", "三星": "samsung",
+    "jbl": "jbl", "beats": "beats", "koss": "koss", "stax": "stax",
+}
+
+
+@dataclass(frozen=True)
+class HeadphoneKey:
+    """正規化後的耳機識別 (cache / MongoDB 都用這個當 key)。"""
+    brand: str
+    model: str
+
+    @property
+    def id(self) -> str:
+        return f"{self.brand}:{self.model}"
+
+
+def fold(text: str) -> str:
+    """NFKC + casefold + 去掉重音符號，只留下字母與數字 (任何語系)。"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = "".join(ch for ch in unicodedata.normalize("NFKD", text) if not unicodedata.combining(ch))
+    return "".join(ch for ch in text if ch.isalnum())
+
+
+def normalize_brand(brand: str) -> str:
+    folded = fold(brand)
+    return BRAND_SYNONYMS.get(folded, folded)
+
+
+def normalize_model(model: str, brand_key: str) -> str:
+    # 使用者常把品牌也打進型號欄位 ("Sennheiser HD800 S")：開頭 1~3 個字組成品牌名就去掉
+    # 以「字」為單位比對，避免 "ATH-M50x" 被當成 "at" + "hm50x"
+    words = [w for w in re.split(r"[\W_]+", unicodedata.normalize("NFKC", model)) if w]
+    for n in range(min(3, len(words) - 1), 0, -1):
+        if normalize_brand(" ".join(words[:n])) == brand_key:
+            words = words[n:]
+            break
+    return fold(" ".join(words))
+
+
+def normalize(brand: str, model: str) -> HeadphoneKey:
+    """純規則的正規化 (不查 alias index)。"""
+    brand_key = normalize_brand(brand)
+    return HeadphoneKey(brand_key, normalize_model(model, brand_key))
+
+
+def _digits(text: str) -> str:
+    return "".join(ch for ch in text if ch.isdigit())
+
+
+def _split_series(model_key: str):
+    """拆成 (系列字母 + 第一組數字, 後綴)，例如 wh1000xm4 -> ("wh1000", "xm4")；沒有數字時整串都是系列。"""
+    match = re.match(r"(\D*\d+)(.*)", model_key)
+    return match.groups() if match else (model_key, "")
+
+
+def closest_brand(brand_key: str, known: Iterable[str]) -> Optional[str]:
+    matches = difflib.get_close_matches(brand_key, list(known), n=1, cutoff=settings.HEADPHONE_FUZZY_BRAND_CUTOFF)
+    return matches[0] if matches else None
+
+
+def closest_model(model_key: str, known: Iterable[str]) -> Optional[str]:
+    """型號只接受後綴上的小錯字：系列字母 + 第一組數字要完全相同 (WF1000XM4 不能併成 WH1000XM4)，
+    數字、長度也要相同 (避免把 HD800 併成 HD800S)。後綴只有一個字時通常是不同版本 (HD58X / HD58S)，不做近似。"""
+    series, suffix = _split_series(model_key)
+    if len(suffix) < 2:
+        return None
+    candidates = [
+        m for m in known
+        if len(m) == len(model_key) and _digits(m) == _digits(model_key) and _split_series(m)[0] == series
+    ]
+    matches = difflib.get_close_matches(model_key, candidates, n=1, cutoff=settings.HEADPHONE_FUZZY_MODEL_CUTOFF)
+    return matches[0] if matches else None
+
+
+# 解析結果在 process 內快取，熱門耳機不需要每次都查 Redis
+_resolved = TTLLRUCache(max_entries=4096, max_bytes=4096 * 128, ttl_seconds=settings.HEADPHONE_ALIAS_LOCAL_TTL_SECONDS)
+
+
+async def resolve_headphone(brand: str, model: str) -> HeadphoneKey:
+    """使用者輸入 -> canonical HeadphoneKey (規則正規化 + alias index + fuzzy fallback)。"""
+    key = normalize(brand, model)
+    resolved = _resolved.get(key.id)
+    if resolved is not None:
+        HEADPHONE_RESOLUTIONS.labels(result="local").inc()
+        return resolved
+
+    resolved = await _resolve_uncached(key)
+    _resolved.set(key.id, resolved, size=len(key.id) + len(resolved.id))
+    return resolved
+
+
+async def _resolve_uncached(key: HeadphoneKey) -> HeadphoneKey:
+    alias = await get_headphone_alias(key.id)
+    if alias:
+        HEADPHONE_RESOLUTIONS.labels(result="alias").inc()
+        brand, _, model = alias.partition(":")
+        return HeadphoneKey(brand, model)
+
+    brand = key.brand
+    if settings.HEADPHONE_FUZZY_MATCH_ENABLED and brand not in BRAND_SYNONYMS.values():
+        known_brands = set(BRAND_SYNONYMS.values()) | await get_known_brands()
+        if brand not in known_brands:
+            brand = closest_brand(brand, known_brands) or brand
+
+    # 先用 SISMEMBER 確認是不是已知型號，真的要近似比對時才 SMEMBERS 整個品牌
+    model = key.model
+    if settings.HEADPHONE_FUZZY_MATCH_ENABLED and not await is_known_model(brand, key.model):
+        model = closest_model(key.model, await get_known_models(brand)) or key.model
+
+    resolved = HeadphoneKey(brand, model)
+    if resolved != key:
+        HEADPHONE_RESOLUTIONS.labels(result="fuzzy").inc()
+        await set_headphone_alias(key.id, resolved.id)
+    else:
+        HEADPHONE_RESOLUTIONS.labels(result="exact").inc()
+    return resolved
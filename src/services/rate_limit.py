@@ -0,0 +1,90 @@
+import math
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Dict, Optional
+from fastapi import Request
+from src.core.config import settings
+from src.core.metrics import RATE_LIMIT_DECISIONS
+from src.db.redis import rate_limit_key, take_tokens
+
+# 目前這個請求是誰 ("user:<id>" 或 "ip:<address>")；Gemini 額度在真的 cache miss 時才用它扣
+_subject: ContextVar[Optional[str]] = ContextVar("rate_limit_subject", default=None)
+
+
+@dataclass(frozen=True)
+class RateLimitState:
+    allowed: bool
+    limit: int
+    remaining: float
+    retry_after: float
+    reset: float
+
+    def headers(self) -> Dict[str, str]:
+        """IETF RateLimit header fields (draft)；被擋下時再加 Retry-After。"""
+        headers = {
+            "RateLimit-Limit": str(self.limit),
+            "RateLimit-Remaining": str(int(self.remaining)),
+            "RateLimit-Reset": str(math.ceil(self.reset)),
+        }
+        if not self.allowed:
+            headers["Retry-After"] = str(max(1, math.ceil(self.retry_after)))
+        return headers
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, bucket: str, state: RateLimitState):
+        super().__init__(f"Rate limit exceeded ({bucket}), retry in {max(1, math.ceil(state.retry_after))}s")
+        self.bucket = bucket
+        self.state = state
+
+
+def client_ip(request: Request) -> str:
+    if settings.RATE_LIMIT_TRUST_FORWARDED_FOR:
+        forwarded = request.headers.get("X-Forwarded-For")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+def request_subject(request: Request, user=None) -> str:
+    return f"user:{user.id}" if user is not None else f"ip:{client_ip(request)}"
+
+
+async def _take(bucket: str, subject: str, capacity: int, refill_per_second: float, cost: int = 1) -> Optional[RateLimitState]:
+    taken = await take_tokens(rate_limit_key(bucket, subject), capacity, refill_per_second, cost)
+    if taken is None:
+        RATE_LIMIT_DECISIONS.labels(bucket=bucket, result="error").inc()
+        return None
+    allowed, remaining, retry_after, reset = taken
+    RATE_LIMIT_DECISIONS.labels(bucket=bucket, result="allowed" if allowed else "limited").inc()
+    state = RateLimitState(allowed, capacity, remaining, retry_after, reset)
+    if not allowed:
+        raise RateLimitExceeded(bucket, state)
+    return state
+
+
+def request_burst(subject: str) -> int:
+    """一般請求的 bucket 容量，也是單次請求最多能扣的 token 數。"""
+    return settings.RATE_LIMIT_USER_BURST if subject.startswith("user:") else settings.RATE_LIMIT_ANON_BURST
+
+
+async def check_request_limit(subject: str, cost: int = 1) -> Optional[RateLimitState]:
+    """一般請求的額度 (批次請求依筆數扣 cost)；超過時丟 RateLimitExceeded，Redis 掛掉時回傳 None (不擋)。
+    同時記住 subject，讓後面的 cache miss 扣 Gemini 額度。"""
+    _subject.set(subject)
+    if not settings.RATE_LIMIT_ENABLED:
+        return None
+    per_minute = settings.RATE_LIMIT_USER_PER_MINUTE if subject.startswith("user:") else settings.RATE_LIMIT_ANON_PER_MINUTE
+    return await _take("requests", subject, request_burst(subject), per_minute / 60, cost)
+
+
+async def charge_gemini_quota():
+    """快取與 MongoDB 都 miss、真的要問 Gemini 前呼叫；沒有經過 check_request_limit 的呼叫端不扣額度。
+    背景工作 (SWR / 預熱) 不走 compute_recommendation，也不會扣到觸發它的使用者。"""
+    subject = _subject.get()
+    if subject is None or not settings.RATE_LIMIT_ENABLED:
+        return
+    if subject.startswith("user:"):
+        await _take("gemini", subject, settings.GEMINI_QUOTA_USER_BURST, settings.GEMINI_QUOTA_USER_PER_HOUR / 3600)
+    else:
+        await _take("gemini", subject, settings.GEMINI_QUOTA_ANON_BURST, settings.GEMINI_QUOTA_ANON_PER_HOUR / 3600)
@@ -0,0 +1,282 @@
+import time
+import asyncio
+import logging
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+from src.core.config import settings
+from src.core.metrics import RECOMMEND_CACHE_LOOKUPS, RECOMMEND_DEGRADED
+from src.core.timing import stage
+from src.schema.schemas import TrackRecommendation
+from src.services.ai_service import (
+    analyze_headphone_with_reason, analyze_headphones_batch, stream_headphone_analysis, PROMPT_VERSION
+)
+from src.services.music_service import lookup_track
+from src.services.rate_limit import charge_gemini_quota
+from src.services.singleflight import hold_lease, recommendation_flight
+from src.services.normalizer import HeadphoneKey, resolve_headphone
+from src.db.redis import (
+    get_cached_recommendation, get_cached_recommendations, set_cached_recommendation, set_cached_recommendations,
+    recommendation_key, acquire_lock, register_headphone
+)
+from src.db.mongo import get_stored_recommendation, save_recommendation
+
+logger = logging.getLogger("uvicorn")
+
+FALLBACK_SONG_QUERY = "Hotel California - Eagles"
+
+# 正在背景重算的 key，以及背景 task 的 reference (避免還沒跑完就被 GC)
+_refreshing = set()
+_background_tasks = set()
+
+
+def _spec_fields(ai_data: dict) -> dict:
+    specs = ai_data.get("specs", {})
+    return {
+        "form_factor": specs.get("form_factor", "N/A"),
+        "connection": specs.get("connection", "N/A"),
+        "release_year": specs.get("year", "N/A"),
+        "price_range": specs.get("price", "N/A"),
+        "driver_config": specs.get("driver", "N/A"),
+    }
+
+
+def _analysis_fields(ai_data: dict) -> dict:
+    analysis = ai_data.get("detailed_analysis", {})
+    return {
+        "analysis_bass": analysis.get("bass", "N/A"),
+        "analysis_mids": analysis.get("mids", "N/A"),
+        "analysis_highs": analysis.get("highs", "N/A"),
+        "listening_guide": analysis.get("guide", "N/A"),
+    }
+
+
+def _partial_events(on_partial: Callable[[str, dict], None]) -> Callable[[dict], None]:
+    """把 Gemini 串流出來的頂層欄位轉成對外的 SSE 事件 (欄位名稱與 TrackRecommendation 相同)。"""
+    def on_fields(fields: dict):
+        if "specs" in fields:
+            on_partial("specs", _spec_fields(fields))
+        if "sound_features" in fields:
+            on_partial("sound_features", {"sound_features": fields["sound_features"]})
+        if "detailed_analysis" in fields:
+            on_partial("analysis", _analysis_fields(fields))
+    return on_fields
+
+
+async def build_recommendation(
+    brand: str, model: str,
+    on_partial: Optional[Callable[[str, dict], None]] = None,
+    ai_data: Optional[dict] = None,
+):
+    """跑完整條 AI -> Spotify -> 組裝流程，回傳 (result, degraded)。
+    degraded 為 None 代表完整結果；否則是 fallback 的原因 (upstream_error / no_track / unparseable)，
+    同樣會寫在 result["degraded"]。
+    有 on_partial 時改用串流分析，並在欄位解析完成時就先送出；
+    已經有 ai_data (例如批次分析的結果) 時直接跳過 AI 這一步。"""
+    # 1. AI Analysis
+    degraded = None
+    if not ai_data and on_partial is not None:
+        ai_data = await stream_headphone_analysis(brand, model, _partial_events(on_partial))
+    if not ai_data:
+        ai_data, degraded = await analyze_headphone_with_reason(brand, model)
+
+    if not ai_data:
+        ai_data = {"specs": {}, "sound_features": [], "song_query": FALLBACK_SONG_QUERY, "detailed_analysis": {}, "summary": "AI Busy"}
+
+    # 2. Spotify Search
+    track, track_failure = await lookup_track(ai_data["song_query"])
+    if not track:
+        # AI 已經失敗的話，以 AI 的原因為準
+        degraded = degraded or track_failure or "no_track"
+        track = {"name": ai_data["song_query"], "artists": [{"name": "Unknown"}], "album": {"images": [{"url": ""}]}, "external_urls": {"spotify": "#"}, "id": "unknown"}
+
+    # 3. Assembly
+    result = {
+        **_spec_fields(ai_data),
+        "sound_features": ai_data.get("sound_features", []),
+        **_analysis_fields(ai_data),
+        "title": track["name"],
+        "artist": track["artists"][0]["name"],
+        "comment": ai_data.get("summary", ""),
+        "cover_url": track["album"]["images"][0]["url"] if track["album"]["images"] else "",
+        "spotify_url": track["external_urls"]["spotify"],
+        "track_id": track["id"],
+        "preview_url": track.get("preview_url"),
+        "degraded": degraded,
+    }
+    if degraded:
+        RECOMMEND_DEGRADED.labels(reason=degraded).inc()
+    # 只在 miss 時驗證一次；寫進快取的就是 API 的最終格式，命中時可以直接回傳序列化好的 bytes
+    return TrackRecommendation(**result).model_dump(), degraded
+
+
+async def _store(key: HeadphoneKey, brand: str, model: str, result: dict):
+    with stage("cache_write"):
+        await set_cached_recommendation(key.brand, key.model, result)
+        await save_recommendation(key.brand, key.model, result, PROMPT_VERSION, brand=brand, model=model)
+        await register_headphone(key.brand, key.model)
+
+
+async def _build_and_store(key: HeadphoneKey, brand: str, model: str, on_partial=None, store_degraded: bool = True):
+    """store_degraded=False 用在背景重算：失敗時保留原本 (過期但正確) 的快取，不要蓋掉。"""
+    # 快取與 MongoDB 用 canonical key；Gemini 則使用使用者原本輸入的名稱
+    result, degraded = await build_recommendation(brand, model, on_partial)
+    if not degraded:
+        await _store(key, brand, model, result)
+    elif store_degraded:
+        # 負快取：只進 Redis (短 TTL，依失敗原因而定)，不寫 MongoDB 也不登記 alias
+        with stage("cache_write"):
+            await set_cached_recommendation(key.brand, key.model, result, degraded=degraded)
+    return result
+
+
+async def _refill_from_store(key: HeadphoneKey) -> Optional[dict]:
+    """MongoDB (L3) 裡同一個 prompt 版本、還在 RECOMMEND_STORE_FRESH_SECONDS 內的分析就回填 Redis 並回傳。
+    回填時以現在當 cached_at：否則超過 soft TTL 的分析一回填就是 stale，下一次命中又會去打 Gemini。"""
+    with stage("mongo"):
+        stored = await get_stored_recommendation(key.brand, key.model, PROMPT_VERSION)
+    if stored is None or time.time() - stored[1] >= settings.RECOMMEND_STORE_FRESH_SECONDS:
+        RECOMMEND_CACHE_LOOKUPS.labels(tier="l3", result="miss").inc()
+        return None
+    RECOMMEND_CACHE_LOOKUPS.labels(tier="l3", result="hit").inc()
+    await set_cached_recommendation(key.brand, key.model, stored[0])
+    return stored[0]
+
+
+async def compute_recommendation(key: HeadphoneKey, brand: str, model: str, on_partial=None):
+    """Cache miss 的路徑：同一支耳機的併發請求只會有一個真的去打上游。
+    on_partial 只有在自己是 leader 且真的呼叫 Gemini 時才會被觸發。
+
+    Gemini 額度只在 L3 也 miss、真的要問 Gemini 時扣 leader 的額度；等別人結果的請求不扣。
+    leader 額度不夠時只有他拿到 429，一起等的其他人會改由自己當 leader 重來 (見 SingleFlight.leader_errors)。"""
+
+    async def compute():
+        # L3: MongoDB 裡分析過的結果，回填 Redis 就好，不用再問 AI
+        stored = await _refill_from_store(key)
+        if stored is not None:
+            return stored
+        await charge_gemini_quota()
+        return await _build_and_store(key, brand, model, on_partial)
+
+    async def fetch_cached():
+        entry = await get_cached_recommendation(key.brand, key.model)
+        return entry.data if entry else None
+
+    return await recommendation_flight.do(recommendation_key(key.brand, key.model), compute, fetch_cached)
+
+
+async def stream_recommendation(key: HeadphoneKey, brand: str, model: str) -> AsyncIterator[Tuple[str, dict]]:
+    """Cache miss 的串流版本：依序產生 (event, payload)，最後一個一定是 ("result", 完整推薦)。"""
+    queue: asyncio.Queue = asyncio.Queue()
+    task = asyncio.create_task(
+        compute_recommendation(key, brand, model, on_partial=lambda event, payload: queue.put_nowait((event, payload)))
+    )
+    next_event = None
+    try:
+        while not task.done():
+            next_event = asyncio.ensure_future(queue.get())
+            await asyncio.wait({next_event, task}, return_when=asyncio.FIRST_COMPLETED)
+            if next_event.done():
+                yield next_event.result()
+            else:
+                next_event.cancel()
+        while not queue.empty():
+            yield queue.get_nowait()
+        yield "result", task.result()
+    finally:
+        # 在 asyncio.wait 裡被取消時 queue.get() 還掛著，要一起收掉
+        if next_event is not None and not next_event.done():
+            next_event.cancel()
+        # client 中途斷線也讓計算跑完，結果仍會寫進快取
+        if not task.done():
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+
+
+async def iter_batch_recommendations(pairs: List[Tuple[str, str]]) -> AsyncIterator[dict]:
+    """一次處理多支耳機，完成一筆就 yield 一筆 (順序不保證，用 index 對應)。
+
+    - 快取命中：一次 MGET 全部取回，立刻回傳。
+    - miss：以 RECOMMEND_BATCH_CONCURRENCY 為上限並行計算；單筆失敗只影響那一筆。
+    """
+    with stage("resolve"):
+        keys = await asyncio.gather(*[resolve_headphone(brand, model) for brand, model in pairs])
+    with stage("cache"):
+        entries = await get_cached_recommendations([(k.brand, k.model) for k in keys])
+    misses = []
+    for index, ((brand, model), entry) in enumerate(zip(pairs, entries)):
+        if entry is None:
+            misses.append(index)
+            continue
+        if entry.is_stale:
+            schedule_refresh(keys[index], brand, model)
+        status = "NEGATIVE" if entry.degraded else "STALE" if entry.is_stale else "HIT"
+        yield {"index": index, "brand": brand, "model": model, "status": "ok",
+               "cache": status, "recommendation": entry.data}
+
+    slots = asyncio.Semaphore(settings.RECOMMEND_BATCH_CONCURRENCY)
+
+    async def run(index: int):
+        brand, model = pairs[index]
+        try:
+            async with slots:
+                result = await compute_recommendation(keys[index], brand, model)
+            return {"index": index, "brand": brand, "model": model, "status": "ok", "cache": "MISS", "recommendation": result}
+        except Exception as e:
+            logger.error(f"Batch recommendation failed for {brand} {model}: {e}")
+            return {"index": index, "brand": brand, "model": model, "status": "error", "error": str(e)}
+
+    tasks = [asyncio.create_task(run(i)) for i in misses]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def precompute_recommendations(pairs: List[Tuple[str, str]]) -> int:
+    """大量預先計算 (warm-up / 批次工作用)：Gemini 用批次 prompt，結果一次寫回 Redis 與 MongoDB。
+    回傳成功寫入快取的筆數。"""
+    keys = await asyncio.gather(*[resolve_headphone(brand, model) for brand, model in pairs])
+    analyses = await analyze_headphones_batch(pairs)
+    slots = asyncio.Semaphore(settings.RECOMMEND_BATCH_CONCURRENCY)
+
+    async def assemble(pair: Tuple[str, str], ai_data: Optional[dict]):
+        async with slots:
+            return await build_recommendation(*pair, ai_data=ai_data)
+
+    built = await asyncio.gather(*[assemble(pair, ai_data) for pair, ai_data in zip(pairs, analyses)])
+    # 預熱只寫完整結果，降級的留給使用者請求時再算
+    ready = [(key, pair, result) for key, pair, (result, degraded) in zip(keys, pairs, built) if not degraded]
+    await set_cached_recommendations({(key.brand, key.model): result for key, _, result in ready})
+    for key, (brand, model), result in ready:
+        await save_recommendation(key.brand, key.model, result, PROMPT_VERSION, brand=brand, model=model)
+        await register_headphone(key.brand, key.model)
+    return len(ready)
+
+
+# --- Stale-while-revalidate: 過了 soft TTL 的資料在背景重算 ---
+
+def schedule_refresh(key: HeadphoneKey, brand: str, model: str):
+    """排一個背景重算；同一個 key 在同一個 process 只會有一個。"""
+    if key in _refreshing:
+        return
+    _refreshing.add(key)
+    task = asyncio.create_task(_refresh(key, brand, model))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _refresh(key: HeadphoneKey, brand: str, model: str):
+    lock_key = recommendation_key(key.brand, key.model)
+    try:
+        # 與 single-flight 共用同一把 lease：別的 replica 正在算就不重複算
+        token = await acquire_lock(lock_key, settings.RECOMMEND_LOCK_TTL_SECONDS)
+        if token is None:
+            return
+        async with hold_lease(lock_key, token, settings.RECOMMEND_LOCK_TTL_SECONDS):
+            # MongoDB 的分析還在新鮮期內就直接回填 (例如 Redis 的 soft TTL 比 L3 短)；過期了才問上游
+            if await _refill_from_store(key) is None:
+                await _build_and_store(key, brand, model, store_degraded=False)
+    except Exception as e:
+        logger.error(f"Background refresh failed for {lock_key}: {e}")
+    finally:
+        _refreshing.discard(key)
@@ -0,0 +1,177 @@
+import time
+import asyncio
+from typing import Awaitable, Callable, TypeVar
+from src.core.metrics import CIRCUIT_STATE, CIRCUIT_TRANSITIONS, UPSTREAM_REJECTED, UPSTREAM_CONCURRENCY_LIMIT
+
+T = TypeVar("T")
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class UpstreamUnavailable(Exception):
+    """沒有真的呼叫上游就放棄了 (斷路中或等不到併發名額)，呼叫端應直接走 fallback。"""
+
+class CircuitOpenError(UpstreamUnavailable):
+    pass
+
+class UpstreamOverloaded(UpstreamUnavailable):
+    pass
+
+
+class CircuitBreaker:
+    """連續失敗 failure_threshold 次就 open；reset_seconds 後進入 half-open，
+    只放 half_open_max_calls 個探測請求，成功就 closed，失敗就再 open 一輪。"""
+
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float,
+                 half_open_max_calls: int = 1, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.half_open_max_calls = half_open_max_calls
+        self._clock = clock
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self.state = CLOSED
+        CIRCUIT_STATE.labels(upstream=name).set(_STATE_VALUES[CLOSED])
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        self.state = state
+        CIRCUIT_STATE.labels(upstream=self.name).set(_STATE_VALUES[state])
+        CIRCUIT_TRANSITIONS.labels(upstream=self.name, state=state).inc()
+        if state == OPEN:
+            self._opened_at = self._clock()
+        self._probes = 0
+
+    def allow(self) -> bool:
+        if self.state == OPEN:
+            if self._clock() - self._opened_at < self.reset_seconds:
+                return False
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probes >= self.half_open_max_calls:
+                return False
+            self._probes += 1
+        return True
+
+    def release(self):
+        """拿到許可但最後沒有真的呼叫 (例如被取消)，把探測名額還回去。"""
+        if self.state == HALF_OPEN and self._probes > 0:
+            self._probes -= 1
+
+    def record_success(self):
+        self._failures = 0
+        self._transition(CLOSED)
+
+    def record_failure(self):
+        if self.state == HALF_OPEN:
+            self._transition(OPEN)
+            return
+        self._failures += 1
+        if self._failures >= self.failure_threshold:
+            self._transition(OPEN)
+
+
+class AdaptiveLimiter:
+    """AIMD 併發上限：延遲在 latency_target 內就每輪 +1 (每個成功請求 +1/limit)，
+    變慢或失敗就乘上 backoff；一個 latency_target 內最多減一次，避免同一波慢請求把上限一路砍到底。"""
+
+    def __init__(self, name: str, min_limit: int, max_limit: int, latency_target: float,
+                 queue_timeout: float, backoff: float = 0.5, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.queue_timeout = queue_timeout
+        self.backoff = backoff
+        self._clock = clock
+        self.limit = float(max_limit)
+        self._in_flight = 0
+        self._last_decrease = float("-inf")
+        self._cond = asyncio.Condition()
+        UPSTREAM_CONCURRENCY_LIMIT.labels(upstream=name).set(self.limit)
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def acquire(self):
+        async with self._cond:
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self._in_flight < int(self.limit)),
+                    timeout=self.queue_timeout,
+                )
+            except asyncio.TimeoutError:
+                raise UpstreamOverloaded(f"{self.name}: no concurrency slot within {self.queue_timeout}s")
+            self._in_flight += 1
+
+    async def release(self):
+        async with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def on_sample(self, latency: float, ok: bool):
+        if ok and latency <= self.latency_target:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        else:
+            now = self._clock()
+            if now - self._last_decrease < self.latency_target:
+                return
+            self._last_decrease = now
+            self.limit = max(self.min_limit, self.limit * self.backoff)
+        UPSTREAM_CONCURRENCY_LIMIT.labels(upstream=self.name).set(self.limit)
+
+
+class UpstreamGuard:
+    """斷路器 + 自適應併發上限，包住單一次上游呼叫。
+
+    fn 丟出的例外都算失敗 (會往外拋)；斷路或排不到名額時丟 UpstreamUnavailable。
+    measure_latency=False 的呼叫 (批次 / 串流，本來就比較久) 只回報成敗，不拿來調整上限。
+    """
+
+    def __init__(self, breaker: CircuitBreaker, limiter: AdaptiveLimiter):
+        self.name = breaker.name
+        self.breaker = breaker
+        self.limiter = limiter
+
+    async def call(self, fn: Callable[[], Awaitable[T]], measure_latency: bool = True) -> T:
+        if not self.breaker.allow():
+            UPSTREAM_REJECTED.labels(upstream=self.name, reason="circuit_open").inc()
+            raise CircuitOpenError(f"{self.name}: circuit open")
+        try:
+            await self.limiter.acquire()
+        except BaseException as e:
+            self.breaker.release()
+            if isinstance(e, UpstreamOverloaded):
+                UPSTREAM_REJECTED.labels(upstream=self.name, reason="overloaded").inc()
+            raise
+
+        start = time.monotonic()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            self.breaker.release()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            self.limiter.on_sample(time.monotonic() - start, ok=False)
+            raise
+        else:
+            self.breaker.record_success()
+            if measure_latency:
+                self.limiter.on_sample(time.monotonic() - start, ok=True)
+            return result
+        finally:
+            await self.limiter.release()
+
+
+def upstream_guard(name: str, failure_threshold: int, reset_seconds: float, min_limit: int,
+                   max_limit: int, latency_target: float, queue_timeout: float) -> UpstreamGuard:
+    return UpstreamGuard(
+        CircuitBreaker(name, failure_threshold, reset_seconds),
+        AdaptiveLimiter(name, min_limit, max_limit, latency_target, queue_timeout),
+    )
@@ -0,0 +1,125 @@
+import asyncio
+import functools
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Type
+
+from src.core.config import settings
+from src.core.metrics import SINGLEFLIGHT_CALLS, SINGLEFLIGHT_WAIT_TIMEOUTS
+from src.db import redis as cache
+from src.services.rate_limit import RateLimitExceeded
+
+logger = logging.getLogger("uvicorn")
+
+
+class SingleFlightTimeout(Exception):
+    """等別的 replica 算等太久 (對方仍持有 lease)。"""
+
+
+@asynccontextmanager
+async def hold_lease(key: str, token: str, ttl: int):
+    """持有 lock:{key} 期間每 ttl/3 續約一次，離開時釋放。
+    lease 只在 leader 掛掉時才會過期，計算本身再久都不會被別的 replica 重複算。"""
+    renewal = asyncio.create_task(_renew_lease(key, token, ttl)) if token else None
+    try:
+        yield
+    finally:
+        if renewal is not None:
+            renewal.cancel()
+        await cache.release_lock(key, token)
+
+
+async def _renew_lease(key: str, token: str, ttl: int):
+    while True:
+        await asyncio.sleep(ttl / 3)
+        if not await cache.extend_lock(key, token, ttl):
+            logger.warning(f"Lost single-flight lease for {key}")
+            return
+
+
+class SingleFlight:
+    """合併同一個 key 的併發計算。
+
+    - 同一個 process: 第一個呼叫者建立計算用的 task，其他人 (包括 leader 自己) 都 shield 後 await 它；
+      leader 的請求被取消 (client 斷線) 時計算照常跑完，不會連帶取消其他人。
+    - 跨 replica: leader 先在 Redis 拿 lease (lock:{key})，計算期間持續續約；拿不到就輪詢快取，
+      等持有 lease 的 replica 把結果寫進去。lease 消失才自己算，等超過 wait_timeout 丟 SingleFlightTimeout。
+    - leader_errors: 只屬於 leader 那個呼叫者的錯誤 (例如他的額度用完)，其他人收到時改成自己重來。
+    """
+
+    def __init__(self, lease_ttl: int, wait_timeout: float, poll_interval: float,
+                 leader_errors: Tuple[Type[BaseException], ...] = ()):
+        self.lease_ttl = lease_ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.leader_errors = leader_errors
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    async def do(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[Any]],
+        fetch_cached: Callable[[], Awaitable[Optional[Any]]],
+    ):
+        while True:
+            inflight = self._inflight.get(key)
+            if inflight is None or inflight.done():
+                break
+            SINGLEFLIGHT_CALLS.labels(role="local").inc()
+            try:
+                return await asyncio.shield(inflight)
+            except self.leader_errors:
+                continue
+
+        # create_task 會複製目前的 context，compute 裡看到的仍是 leader 請求的 contextvar
+        task = asyncio.create_task(self._run_leader(key, compute, fetch_cached))
+        self._inflight[key] = task
+        task.add_done_callback(functools.partial(self._finished, key))
+        return await asyncio.shield(task)
+
+    def _finished(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 沒有人在等的話，避免 "Task exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+    async def _run_leader(self, key, compute, fetch_cached):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_timeout
+        token = await cache.acquire_lock(key, self.lease_ttl)
+        while token is None:
+            result = await self._wait_for_remote(key, fetch_cached, deadline)
+            if result is not None:
+                SINGLEFLIGHT_CALLS.labels(role="remote").inc()
+                return result
+            # 對方放掉了 lease 卻沒寫快取 (例如 AI 失敗)，由我們接手；被別人搶先就繼續等
+            token = await cache.acquire_lock(key, self.lease_ttl)
+            if token is None and loop.time() >= deadline:
+                SINGLEFLIGHT_WAIT_TIMEOUTS.inc()
+                logger.warning(f"Single-flight wait timed out for {key}")
+                raise SingleFlightTimeout(f"{key}: still computed by another replica after {self.wait_timeout}s")
+
+        SINGLEFLIGHT_CALLS.labels(role="leader").inc()
+        async with hold_lease(key, token, self.lease_ttl):
+            return await compute()
+
+    async def _wait_for_remote(self, key, fetch_cached, deadline: float):
+        """輪詢到拿到結果 (回傳結果)、lease 消失或超過 deadline (回傳 None)。"""
+        loop = asyncio.get_running_loop()
+        while loop.time() < deadline:
+            await asyncio.sleep(self.poll_interval)
+            result = await fetch_cached()
+            if result is not None:
+                return result
+            if not await cache.is_locked(key):
+                return None
+        return None
+
+
+recommendation_flight = SingleFlight(
+    lease_ttl=settings.RECOMMEND_LOCK_TTL_SECONDS,
+    wait_timeout=settings.RECOMMEND_LOCK_WAIT,
+    poll_interval=settings.RECOMMEND_LOCK_POLL_SECONDS,
+    leader_errors=(RateLimitExceeded,),
+)
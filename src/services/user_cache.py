@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+from typing import Optional
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from src.core.metrics import USER_CACHE_LOOKUPS, USER_CACHE_INVALIDATIONS
+from src.core.timing import stage
+from src.db.local_cache import user_l1
+from src.db.redis import get_cached_principal, set_cached_principal, invalidate_principal, user_principal_key
+from src.models.user import User
+
+logger = logging.getLogger("uvicorn")
+
+# 只快取驗證身分需要的欄位；hashed_password 不離開 PostgreSQL
+_PRINCIPAL_FIELDS = ("id", "email", "is_active", "is_superuser")
+
+# 同步 session (threadpool) 裡觸發的失效要丟回主 event loop 執行
+_main_loop: Optional[asyncio.AbstractEventLoop] = None
+_background_tasks = set()
+
+
+def _to_principal(user: User) -> dict:
+    return {field: getattr(user, field) for field in _PRINCIPAL_FIELDS}
+
+
+def _to_user(principal: dict) -> User:
+    # transient 物件：不屬於任何 session，只拿來讀 id / email
+    return User(**principal)
+
+
+def _remember_locally(email: str, principal: dict):
+    user_l1.set(user_principal_key(email), principal, size=len(json.dumps(principal)))
+
+
+async def get_user_principal(db: AsyncSession, email: str) -> Optional[User]:
+    """依 JWT sub 取得使用者：L1 -> Redis -> PostgreSQL，查到就回填兩層快取。"""
+    with stage("user"):
+        return await _lookup_principal(db, email)
+
+
+async def _lookup_principal(db: AsyncSession, email: str) -> Optional[User]:
+    principal = user_l1.get(user_principal_key(email))
+    if principal is not None:
+        USER_CACHE_LOOKUPS.labels(tier="l1", result="hit").inc()
+        return _to_user(principal)
+    USER_CACHE_LOOKUPS.labels(tier="l1", result="miss").inc()
+
+    principal = await get_cached_principal(email)
+    if principal is not None:
+        USER_CACHE_LOOKUPS.labels(tier="l2", result="hit").inc()
+        _remember_locally(email, principal)
+        return _to_user(principal)
+    USER_CACHE_LOOKUPS.labels(tier="l2", result="miss").inc()
+
+    with stage("user_db"):
+        result = await db.execute(select(User).where(User.email == email))
+    user = result.scalars().first()
+    if user is None:
+        return None
+    principal = _to_principal(user)
+    _remember_locally(email, principal)
+    await set_cached_principal(email, principal)
+    return user
+
+
+def bind_event_loop(loop: asyncio.AbstractEventLoop):
+    """啟動時記住主 event loop，讓同步路由觸發的失效也能送進 Redis。"""
+    global _main_loop
+    _main_loop = loop
+
+
+def invalidate_user(email: str):
+    """使用者停用 / 改密碼後呼叫：本 process 的 L1 立刻失效，Redis 與其他 replica 非同步處理。"""
+    USER_CACHE_INVALIDATIONS.inc()
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+
+    if loop is not None:
+        user_l1.delete(user_principal_key(email))
+        task = loop.create_task(invalidate_principal(email))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    elif _main_loop is not None and _main_loop.is_running():
+        # L1 不是 thread-safe，整個失效都交給主 loop 做
+        asyncio.run_coroutine_threadsafe(invalidate_principal(email), _main_loop)
+    else:
+        logger.warning(f"No event loop to invalidate user cache for {email}; relying on TTL")
+
+
+# 會影響驗證結果的欄位
+_AUTH_FIELDS = ("hashed_password", "is_active", "is_superuser", "email")
+# flush 時先記下要失效的 email，等 commit 之後才真的失效：
+# 若在 flush 時就失效，commit 前另一個請求仍會讀到舊的 row 並把它寫回快取
+_PENDING_KEY = "user_cache_invalidations"
+
+
+def _changed(target: User, field: str) -> bool:
+    return inspect(target).attrs[field].history.has_changes()
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_changed_users(session: Session, flush_context):
+    pending = session.info.setdefault(_PENDING_KEY, set())
+    for target in session.dirty:
+        if isinstance(target, User) and any(_changed(target, field) for field in _AUTH_FIELDS):
+            # email 也改了的話，舊 email 的 token 不能再對到快取
+            pending.update(email for email in (target.email, *inspect(target).attrs.email.history.deleted) if email)
+    for target in session.deleted:
+        if isinstance(target, User) and target.email:
+            pending.add(target.email)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session: Session):
+    for email in session.info.pop(_PENDING_KEY, ()):
+        invalidate_user(email)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session: Session):
+    session.info.pop(_PENDING_KEY, None)
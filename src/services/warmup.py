@@ -0,0 +1,125 @@
+"""快取預熱：從 MongoDB logs 找出最近最熱門的耳機，在快取過期前先算好。
+
+背景執行 (app 啟動時，見 main.py) 或手動執行：
+    python -m src.services.warmup --top 50 --days 7
+"""
+import asyncio
+import argparse
+import logging
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+from src.core.config import settings
+from src.core.metrics import WARMUP_HEADPHONES
+from src.db import mongo
+from src.db.redis import get_cached_recommendations, acquire_lock, release_lock
+from src.services.normalizer import resolve_headphone
+from src.services.recommendation_service import _refill_from_store, precompute_recommendations
+
+logger = logging.getLogger("uvicorn")
+
+WARMUP_LOCK_KEY = "warmup"
+
+
+async def top_headphones(limit: int, window_days: int) -> List[Tuple[str, str]]:
+    """統計最近 window_days 天內被查詢最多次的耳機 (含 cache hit)。"""
+    db = mongo.get_database()
+    if db is None:
+        return []
+    since = datetime.utcnow() - timedelta(days=window_days)
+    pipeline = [
+        {"$match": {"event": {"$in": ["search_headphone", "search_cache_hit"]}, "timestamp": {"$gte": since}}},
+        {"$group": {
+            "_id": {"brand": {"$toLower": "$data.brand"}, "model": {"$toLower": "$data.model"}},
+            "brand": {"$first": "$data.brand"},
+            "model": {"$first": "$data.model"},
+            "count": {"$sum": 1},
+        }},
+        {"$sort": {"count": -1}},
+        {"$limit": limit},
+    ]
+    docs = await db.logs.aggregate(pipeline).to_list(length=limit)
+    # 不同寫法可能對到同一個 canonical key，只保留最熱門的那一個寫法
+    seen, popular = set(), []
+    for d in docs:
+        if not d.get("brand") or not d.get("model"):
+            continue
+        key = await resolve_headphone(d["brand"], d["model"])
+        if key not in seen:
+            seen.add(key)
+            popular.append((d["brand"], d["model"]))
+    return popular
+
+
+async def warm_cache(limit: int = None, window_days: int = None) -> dict:
+    """預熱熱門耳機：已經新鮮的略過，MongoDB 有夠新的分析就回填 (缺的與 stale 的都一樣)，剩下的才用批次 Gemini 計算。
+    Gemini 的部分依 WARMUP_MAX_PER_MINUTE 限速，避免吃掉線上流量的 quota。"""
+    limit = limit or settings.WARMUP_TOP_N
+    window_days = window_days or settings.WARMUP_WINDOW_DAYS
+    stats = {"fresh": 0, "mongo": 0, "gemini": 0, "failed": 0}
+
+    popular = await top_headphones(limit, window_days)
+    keys = [await resolve_headphone(brand, model) for brand, model in popular]
+    entries = await get_cached_recommendations([(k.brand, k.model) for k in keys])
+
+    to_compute = []
+    for (brand, model), key, entry in zip(popular, keys, entries):
+        if entry is not None and not entry.is_stale:
+            stats["fresh"] += 1
+            continue
+        # 和線上 cache miss / SWR 同一套 L3 規則：RECOMMEND_STORE_FRESH_SECONDS 內的分析以現在當 cached_at 回填
+        if await _refill_from_store(key) is not None:
+            stats["mongo"] += 1
+            continue
+        to_compute.append((brand, model))
+
+    size = settings.GEMINI_BATCH_SIZE
+    for i in range(0, len(to_compute), size):
+        chunk = to_compute[i:i + size]
+        cached = await precompute_recommendations(chunk)
+        stats["gemini"] += cached
+        stats["failed"] += len(chunk) - cached
+        if i + size < len(to_compute):
+            await asyncio.sleep(len(chunk) * 60 / settings.WARMUP_MAX_PER_MINUTE)
+
+    for source, count in stats.items():
+        WARMUP_HEADPHONES.labels(result=source).inc(count)
+    logger.info(f"🔥 Cache warm-up finished: {stats}")
+    return stats
+
+
+async def run_startup_warmup():
+    """app 啟動時的背景預熱；多個 replica 只會有一個真的執行。"""
+    await asyncio.sleep(settings.WARMUP_STARTUP_DELAY_SECONDS)
+    token = await acquire_lock(WARMUP_LOCK_KEY, settings.WARMUP_LOCK_TTL_SECONDS)
+    if token is None:
+        logger.info("🔥 Cache warm-up already running on another replica, skipping.")
+        return
+    try:
+        await warm_cache()
+    except Exception as e:
+        logger.error(f"❌ Cache warm-up failed: {e}")
+    finally:
+        await release_lock(WARMUP_LOCK_KEY, token)
+
+
+async def _main(args):
+    from src.db.redis import close_redis_connection
+    from src.services.music_service import spotify_client
+
+    await mongo.connect_to_mongo()
+    await spotify_client.start()
+    try:
+        print(await warm_cache(args.top, args.days))
+    finally:
+        await spotify_client.close()
+        await mongo.close_mongo_connection()
+        await close_redis_connection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute recommendations for the most searched headphones.")
+    parser.add_argument("--top", type=int, default=settings.WARMUP_TOP_N, help="how many headphones to warm")
+    parser.add_argument("--days", type=int, default=settings.WARMUP_WINDOW_DAYS, help="popularity window in days")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(parser.parse_args()))
@@ -1,5 +1,10 @@
+import os
 import pytest
-from src.db.postgres import engine, Base
+
+# TestClient 每個請求可能在不同的 event loop，asyncpg 連線不能跨 loop 共用
+os.environ.setdefault("DB_ASYNC_NULL_POOL", "true")
+
+from src.db.postgres import engine, Base  # noqa: E402
 
 @pytest.fixture(scope="session", autouse=True)
 def setup_database():
@@ -0,0 +1,115 @@
+import asyncio
+import json
+from types import SimpleNamespace
+import pytest
+from src.services import ai_service
+from src.services.resilience import OPEN, upstream_guard
+
+
+def fake_client(generate_content):
+    return SimpleNamespace(aio=SimpleNamespace(models=SimpleNamespace(generate_content=generate_content)))
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(ai_service, "_backoff_delay", lambda attempt: 0)
+    monkeypatch.setattr(ai_service.settings, "GEMINI_TIMEOUT_SECONDS", 0.05)
+    # 每個測試用新的斷路器，失敗次數不會累積到下一個測試
+    monkeypatch.setattr(ai_service, "gemini_guard", upstream_guard(
+        "gemini", failure_threshold=5, reset_seconds=30, min_limit=1, max_limit=8, latency_target=10, queue_timeout=1,
+    ))
+
+
+@pytest.mark.asyncio
+async def test_retries_after_timeout_without_blocking(monkeypatch):
+    calls = 0
+
+    async def generate_content(**kwargs):
+        nonlocal calls
+        calls += 1
+        if calls == 1:
+            await asyncio.sleep(1)
+        return SimpleNamespace(text=json.dumps({"song_query": "Hotel California - Eagles"}))
+
+    monkeypatch.setattr(ai_service, "client", fake_client(generate_content))
+
+    result = await ai_service.analyze_headphone("Sennheiser", "HD800S")
+    assert result == {"song_query": "Hotel California - Eagles"}
+    assert calls == 2
+
+
+@pytest.mark.asyncio
+async def test_gives_up_after_max_retries(monkeypatch):
+    calls = 0
+
+    async def generate_content(**kwargs):
+        nonlocal calls
+        calls += 1
+        raise RuntimeError("503 UNAVAILABLE")
+
+    monkeypatch.setattr(ai_service, "client", fake_client(generate_content))
+
+    assert await ai_service.analyze_headphone("Sennheiser", "HD800S") is None
+    assert calls == ai_service.settings.GEMINI_MAX_RETRIES
+
+
+@pytest.mark.asyncio
+async def test_open_circuit_fails_fast_without_calling_gemini(monkeypatch):
+    calls = 0
+
+    async def generate_content(**kwargs):
+        nonlocal calls
+        calls += 1
+        raise RuntimeError("503 UNAVAILABLE")
+
+    monkeypatch.setattr(ai_service, "client", fake_client(generate_content))
+    monkeypatch.setattr(ai_service.gemini_guard.breaker, "failure_threshold", 2)
+
+    # 第二次失敗就斷路，剩下的重試直接放棄
+    assert await ai_service.analyze_headphone("Sennheiser", "HD800S") is None
+    assert calls == 2 and ai_service.gemini_guard.breaker.state == OPEN
+
+    assert await ai_service.analyze_headphone("Sony", "MDR-Z1R") is None
+    assert calls == 2
+
+
+def test_parse_completed_fields_only_returns_finished_values():
+    text = '{"specs": {"year": "2016"}, "sound_features": ["Wide"], "detailed_analysis": {"bass": "Ti'
+    assert ai_service.parse_completed_fields(text) == {"specs": {"year": "2016"}, "sound_features": ["Wide"]}
+    assert ai_service.parse_completed_fields('{"price": 12') == {}
+    assert ai_service.parse_completed_fields('{"price": 120}') == {"price": 120}
+
+
+@pytest.mark.asyncio
+async def test_batch_analysis_falls_back_for_invalid_items(monkeypatch):
+    good = {"specs": {}, "sound_features": [], "detailed_analysis": {}, "song_query": "Hotel California - Eagles", "summary": "ok"}
+    prompts = []
+
+    async def generate_content(model, contents, config):
+        prompts.append(contents)
+        if "以下是" in contents:
+            return SimpleNamespace(text=json.dumps([{"id": 0, "analysis": good}, {"id": 1, "analysis": {"specs": "broken"}}]))
+        return SimpleNamespace(text=json.dumps({**good, "summary": "single"}))
+
+    monkeypatch.setattr(ai_service, "client", fake_client(generate_content))
+
+    results = await ai_service.analyze_headphones_batch([("Sennheiser", "HD800S"), ("Sony", "MDR-Z1R"), ("Focal", "Utopia")])
+
+    assert results[0] == good
+    assert results[1]["summary"] == "single"
+    assert results[2]["summary"] == "single"
+    assert len(prompts) == 3
+
+
+@pytest.mark.asyncio
+async def test_stream_rejects_output_without_song_query(monkeypatch):
+    for text in ('{"specs": {"year": "2016"}, "summary": "ok"}', '["not", "an", "object"]'):
+        async def generate_content_stream(**kwargs):
+            async def chunks():
+                yield SimpleNamespace(text=text)
+            return chunks()
+
+        monkeypatch.setattr(ai_service, "client", SimpleNamespace(
+            aio=SimpleNamespace(models=SimpleNamespace(generate_content_stream=generate_content_stream))
+        ))
+        assert await ai_service.stream_headphone_analysis("Sennheiser", "HD800S", lambda fields: None) is None
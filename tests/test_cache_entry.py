@@ -0,0 +1,70 @@
+import json
+import orjson
+import pytest
+from src.core.responses import CachedJSONResponse
+from src.db import redis as redis_db
+
+REC = {"title": "Song", "comment": "低頻" * 1000, "preview_url": None}
+
+
+def test_entry_round_trip_with_and_without_compression(monkeypatch):
+    for compress in (True, False):
+        monkeypatch.setattr(redis_db.settings, "RECOMMEND_CACHE_COMPRESSION", compress)
+        entry, raw = redis_db._new_entry(REC, cached_at=1000.0)
+        assert (len(raw) < len(entry.body)) == compress
+        decoded = redis_db._decode_entry(raw)
+        assert decoded.cached_at == 1000.0
+        assert decoded.body == orjson.dumps(REC)
+        assert decoded.data == REC
+
+
+def test_other_schema_versions_and_legacy_json():
+    _, raw = redis_db._new_entry(REC)
+    outdated = raw.replace(b"%d:" % redis_db.CACHE_SCHEMA_VERSION, b"1:", 1)
+    assert redis_db._decode_entry(outdated) is None
+
+    legacy = redis_db._decode_entry(json.dumps(REC).encode())
+    assert legacy.data == REC and legacy.is_stale
+
+
+def test_cached_body_is_sent_verbatim():
+    body = orjson.dumps(REC)
+    assert CachedJSONResponse(body).body == body
+    assert orjson.loads(CachedJSONResponse({"a": 1}).body) == {"a": 1}
+
+
+def test_degraded_entries_round_trip_and_never_go_stale():
+    _, raw = redis_db._new_entry(REC, cached_at=1.0, degraded="no_track")
+    decoded = redis_db._decode_entry(raw)
+    assert decoded.degraded == "no_track" and decoded.data == REC
+    assert not decoded.is_stale
+    assert redis_db._decode_entry(redis_db._new_entry(REC)[1]).degraded is None
+
+
+@pytest.mark.asyncio
+async def test_negative_entry_does_not_clobber_a_good_one(monkeypatch):
+    store = {}
+
+    class FakeBinaryClient:
+        async def set(self, key, value, nx=False, ex=None):
+            if nx and key in store:
+                return None
+            store[key] = (value, ex)
+            return True
+
+        async def publish(self, channel, message):
+            pass
+
+    monkeypatch.setattr(redis_db, "binary_client", FakeBinaryClient())
+    key = redis_db.recommendation_key("sony", "mdrz1r")
+    redis_db._forget_locally(key)
+
+    await redis_db.set_cached_recommendation("sony", "mdrz1r", REC, degraded="upstream_error")
+    assert store[key][1] == redis_db.settings.NEGATIVE_CACHE_UPSTREAM_ERROR_TTL_SECONDS
+    assert redis_db.recommendation_l1.get(key).degraded == "upstream_error"
+
+    store[key] = (redis_db._new_entry(REC)[1], None)
+    redis_db._forget_locally(key)
+    await redis_db.set_cached_recommendation("sony", "mdrz1r", REC, degraded="no_track")
+    assert redis_db._decode_entry(store[key][0]).degraded is None
+    assert redis_db.recommendation_l1.get(key) is None
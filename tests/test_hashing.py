@@ -0,0 +1,47 @@
+import asyncio
+import threading
+import pytest
+from passlib.context import CryptContext
+from src.services import hashing
+from src.services.hashing import HashingPool, HashingPoolBusy
+
+
+@pytest.mark.asyncio
+async def test_old_cost_hash_is_upgraded_on_verify(monkeypatch):
+    monkeypatch.setattr(hashing, "pwd_context", CryptContext(
+        schemes=["bcrypt"], deprecated="auto",
+        bcrypt__default_rounds=5, bcrypt__min_rounds=5, bcrypt__max_rounds=5,
+    ))
+    old_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("secret")
+
+    valid, new_hash = await hashing.verify_and_update_password("secret", old_hash)
+    assert valid and new_hash.startswith("$2b$05$")
+    assert await hashing.verify_and_update_password("secret", new_hash) == (True, None)
+    assert (await hashing.verify_and_update_password("wrong", new_hash))[0] is False
+
+
+@pytest.mark.asyncio
+async def test_pool_rejects_when_queue_is_full():
+    pool = HashingPool("thread", max_workers=1, max_pending=2)
+    release = threading.Event()
+    try:
+        running = [asyncio.create_task(pool.run(release.wait)) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(HashingPoolBusy):
+            await pool.run(release.wait)
+        release.set()
+        assert await asyncio.gather(*running) == [True, True]
+        assert await pool.run(len, "ok") == 2
+    finally:
+        release.set()
+        pool.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_process_pool_hashes_off_process():
+    pool = HashingPool("process", max_workers=1, max_pending=4)
+    try:
+        hashed = await pool.run(hashing._hash, "secret")
+        assert await pool.run(hashing._verify_and_update, "secret", hashed) == (True, None)
+    finally:
+        pool.shutdown()
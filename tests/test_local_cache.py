@@ -0,0 +1,37 @@
+import time
+from src.db.local_cache import TTLLRUCache
+
+
+def test_lru_eviction_by_entries():
+    cache = TTLLRUCache(max_entries=2, max_bytes=1000, ttl_seconds=60)
+    cache.set("a", 1, size=1)
+    cache.set("b", 2, size=1)
+    cache.get("a")
+    cache.set("c", 3, size=1)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+
+def test_eviction_by_bytes():
+    cache = TTLLRUCache(max_entries=10, max_bytes=10, ttl_seconds=60)
+    cache.set("a", "x", size=6)
+    cache.set("b", "y", size=6)
+
+    assert cache.get("a") is None
+    assert cache.nbytes == 6
+
+    cache.set("huge", "z", size=11)
+    assert cache.get("huge") is None
+
+
+def test_ttl_expiry(monkeypatch):
+    cache = TTLLRUCache(max_entries=10, max_bytes=100, ttl_seconds=5)
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now)
+    cache.set("a", 1, size=1)
+
+    monkeypatch.setattr(time, "monotonic", lambda: now + 6)
+    assert cache.get("a") is None
+    assert len(cache) == 0 and cache.nbytes == 0
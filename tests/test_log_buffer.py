@@ -0,0 +1,46 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+from src.db import mongo
+from src.db.mongo import LogBuffer
+
+
+class FakeLogs:
+    def __init__(self, delay=0):
+        self.batches = []
+        self.delay = delay
+
+    async def insert_many(self, docs, ordered=True):
+        assert ordered is False
+        await asyncio.sleep(self.delay)
+        self.batches.append(list(docs))
+
+
+@pytest.mark.asyncio
+async def test_flushes_by_batch_size_and_on_stop(monkeypatch):
+    logs = FakeLogs()
+    monkeypatch.setattr(mongo, "db", SimpleNamespace(logs=logs))
+    buffer = LogBuffer(max_size=100, batch_size=3, flush_interval=60)
+    buffer.start()
+
+    for i in range(3):
+        buffer.enqueue({"event": "search_headphone", "i": i})
+    await asyncio.sleep(0.01)
+    assert [len(b) for b in logs.batches] == [3]
+
+    buffer.enqueue({"event": "search_headphone", "i": 3})
+    await asyncio.sleep(0.01)
+    assert [len(b) for b in logs.batches] == [3]
+
+    await buffer.stop(timeout=1)
+    assert [len(b) for b in logs.batches] == [3, 1]
+
+
+@pytest.mark.asyncio
+async def test_drops_when_queue_is_full(monkeypatch):
+    monkeypatch.setattr(mongo, "db", SimpleNamespace(logs=FakeLogs()))
+    buffer = LogBuffer(max_size=2, batch_size=10, flush_interval=60)
+
+    assert buffer.enqueue({"i": 1}) and buffer.enqueue({"i": 2})
+    assert not buffer.enqueue({"i": 3})
+    assert len(buffer) == 2
@@ -0,0 +1,100 @@
+import asyncio
+import httpx
+import pytest
+from src.services import music_service
+from src.services.music_service import SpotifyClient
+
+
+def mock_spotify(counter):
+    async def handler(request: httpx.Request):
+        if request.url.host == "accounts.spotify.com":
+            counter["token"] += 1
+            await asyncio.sleep(0.01)
+            return httpx.Response(200, json={"access_token": f"token-{counter['token']}", "expires_in": 3600})
+        counter["search"] += 1
+        return httpx.Response(200, json={"tracks": {"items": [{"id": "1", "name": request.url.params["q"]}]}})
+    return handler
+
+
+@pytest.mark.asyncio
+async def test_token_is_fetched_once_under_concurrency():
+    counter = {"token": 0, "search": 0}
+    spotify = SpotifyClient()
+    spotify._http = httpx.AsyncClient(transport=httpx.MockTransport(mock_spotify(counter)))
+
+    results = await asyncio.gather(*[spotify.search("Hotel California - Eagles") for _ in range(20)])
+    await spotify.close()
+
+    assert counter == {"token": 1, "search": 20}
+    assert all(r["name"] == "Hotel California - Eagles" for r in results)
+
+
+@pytest.mark.asyncio
+async def test_revoked_token_is_refreshed():
+    counter = {"token": 0, "search": 0}
+    handler = mock_spotify(counter)
+
+    async def revoke_first_token(request: httpx.Request):
+        if request.headers.get("Authorization") == "Bearer token-1":
+            return httpx.Response(401, json={"error": {"status": 401}})
+        return await handler(request)
+
+    spotify = SpotifyClient()
+    spotify._http = httpx.AsyncClient(transport=httpx.MockTransport(revoke_first_token))
+
+    track = await spotify.search("Hotel California - Eagles")
+    await spotify.close()
+
+    assert track["id"] == "1"
+    assert counter["token"] == 2
+
+
+@pytest.fixture
+def fake_track_cache(monkeypatch):
+    store = {}
+
+    async def get_cached_track(query, market):
+        return ((True, store[(query, market)]) if (query, market) in store else (False, None))
+
+    async def set_cached_track(query, market, track):
+        store[(query, market)] = track
+
+    monkeypatch.setattr(music_service, "get_cached_track", get_cached_track)
+    monkeypatch.setattr(music_service, "set_cached_track", set_cached_track)
+    return store
+
+
+@pytest.mark.asyncio
+async def test_search_track_is_cached_by_normalized_query(monkeypatch, fake_track_cache):
+    calls = []
+
+    async def search(query, market=None):
+        calls.append(query)
+        return {"id": "1", "name": "Hotel California", "artists": [{"name": "Eagles", "id": "x"}],
+                "album": {"images": [{"url": "a"}, {"url": "b"}]}, "external_urls": {"spotify": "s"}}
+
+    monkeypatch.setattr(music_service.spotify_client, "search", search)
+
+    first = await music_service.search_track("Hotel California - Eagles")
+    second = await music_service.search_track("  hotel   california - EAGLES ")
+
+    assert calls == ["Hotel California - Eagles"]
+    assert first == second
+    assert first["album"]["images"] == [{"url": "a"}]
+
+
+@pytest.mark.asyncio
+async def test_search_track_negative_cache_and_errors(monkeypatch, fake_track_cache):
+    async def no_result(query, market=None):
+        return None
+
+    async def unavailable(query, market=None):
+        raise music_service.SpotifyError("503")
+
+    monkeypatch.setattr(music_service.spotify_client, "search", unavailable)
+    assert await music_service.search_track("Unknown Song") is None
+    assert fake_track_cache == {}
+
+    monkeypatch.setattr(music_service.spotify_client, "search", no_result)
+    assert await music_service.search_track("Unknown Song") is None
+    assert fake_track_cache == {("unknown song", music_service.settings.SPOTIFY_MARKET): None}
@@ -0,0 +1,73 @@
+import pytest
+from src.services import normalizer
+from src.services.normalizer import HeadphoneKey, normalize, closest_model
+
+
+@pytest.mark.parametrize("brand, model", [
+    ("Sennheiser", "HD800S"),
+    ("sennheiser", "HD 800 S"),
+    ("SENNHEISER", "hd-800s"),
+    ("Sennheiser ", "Sennheiser HD800 S "),
+    ("Senn", "HD800S"),
+    ("森海塞爾", "ＨＤ８００Ｓ"),
+])
+def test_spelling_variants_share_one_key(brand, model):
+    assert normalize(brand, model) == HeadphoneKey("sennheiser", "hd800s")
+
+
+def test_brand_prefix_is_only_stripped_on_word_boundaries():
+    assert normalize("Audio-Technica", "ATH-M50x") == HeadphoneKey("audiotechnica", "athm50x")
+    assert normalize("Audio Technica", "Audio-Technica ATH-M50x") == HeadphoneKey("audiotechnica", "athm50x")
+
+
+def test_fuzzy_model_requires_same_digits():
+    known = {"hd800s", "hd800", "wh1000xm4"}
+    assert closest_model("wh1000xn4", known) == "wh1000xm4"
+    assert closest_model("hd660s", known) is None
+
+
+def test_fuzzy_model_only_fixes_suffix_typos():
+    # 不同系列 (耳道式 WF vs 耳罩式 WH) 不能合併
+    assert closest_model("wf1000xm4", {"wh1000xm4"}) is None
+    # 單一字母的後綴是不同版本，不是錯字
+    assert closest_model("hd58s", {"hd58x"}) is None
+    assert closest_model("utopai", {"utopia"}) is None
+
+
+@pytest.mark.asyncio
+async def test_resolve_uses_fuzzy_match_and_records_alias(monkeypatch):
+    aliases = {}
+
+    async def get_headphone_alias(variant):
+        return aliases.get(variant)
+
+    async def set_headphone_alias(variant, canonical):
+        aliases[variant] = canonical
+
+    async def get_known_brands():
+        return set()
+
+    known = {"sony": {"wh1000xm4"}}
+    listed = []
+
+    async def is_known_model(brand_key, model_key):
+        return model_key in known.get(brand_key, set())
+
+    async def get_known_models(brand_key):
+        listed.append(brand_key)
+        return known.get(brand_key, set())
+
+    monkeypatch.setattr(normalizer, "get_headphone_alias", get_headphone_alias)
+    monkeypatch.setattr(normalizer, "set_headphone_alias", set_headphone_alias)
+    monkeypatch.setattr(normalizer, "get_known_brands", get_known_brands)
+    monkeypatch.setattr(normalizer, "get_known_models", get_known_models)
+    monkeypatch.setattr(normalizer, "is_known_model", is_known_model)
+    normalizer._resolved.clear()
+
+    # 已知型號只用 SISMEMBER 確認，不會把整個品牌的型號拉回來
+    assert await normalizer.resolve_headphone("Sony", "WH-1000XM4") == HeadphoneKey("sony", "wh1000xm4")
+    assert listed == [] and aliases == {}
+
+    assert await normalizer.resolve_headphone("Sonny", "WH-1000XN4") == HeadphoneKey("sony", "wh1000xm4")
+    assert aliases == {"sonny:wh1000xn4": "sony:wh1000xm4"}
+    assert listed == ["sony"]
@@ -0,0 +1,160 @@
+import asyncio
+import time
+import pytest
+from types import SimpleNamespace
+from fastapi import HTTPException, Response
+from starlette.requests import Request
+from src.routers.recommendation import get_recommendations_batch, rate_limited_user
+from src.schema.schemas import HeadphoneRequest
+from src.services import rate_limit
+
+
+@pytest.fixture
+def buckets(monkeypatch):
+    """用 dict 模擬 Redis token bucket (不會補充)，記錄每個 key 扣了幾次。"""
+    taken = {}
+
+    async def take_tokens(key, capacity, refill_per_second, cost=1):
+        used = taken.get(key, 0)
+        if used + cost > capacity:
+            return False, 0.0, 1 / refill_per_second, capacity / refill_per_second
+        taken[key] = used + cost
+        return True, float(capacity - used - cost), 0.0, (used + cost) / refill_per_second
+
+    monkeypatch.setattr(rate_limit, "take_tokens", take_tokens)
+    monkeypatch.setattr(rate_limit.settings, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(rate_limit.settings, "RATE_LIMIT_ANON_BURST", 2)
+    monkeypatch.setattr(rate_limit.settings, "RATE_LIMIT_USER_BURST", 5)
+    monkeypatch.setattr(rate_limit.settings, "GEMINI_QUOTA_ANON_BURST", 1)
+    return taken
+
+
+def _request(ip: str) -> Request:
+    return Request({"type": "http", "method": "POST", "path": "/recommend", "headers": [], "client": (ip, 1234)})
+
+
+@pytest.mark.asyncio
+async def test_anonymous_ips_and_users_have_separate_buckets(buckets):
+    response = Response()
+    await rate_limited_user(_request("10.0.0.1"), response, user=None)
+    assert response.headers["RateLimit-Limit"] == "2" and response.headers["RateLimit-Remaining"] == "1"
+    await rate_limited_user(_request("10.0.0.1"), Response(), user=None)
+
+    with pytest.raises(HTTPException) as exc:
+        await rate_limited_user(_request("10.0.0.1"), Response(), user=None)
+    assert exc.value.status_code == 429
+    assert exc.value.headers["Retry-After"] == "6" and exc.value.headers["RateLimit-Remaining"] == "0"
+
+    # 同一個 IP 登入後改用 user id 的額度，其他 IP 不受影響
+    user = SimpleNamespace(id=7)
+    await rate_limited_user(_request("10.0.0.1"), Response(), user=user)
+    await rate_limited_user(_request("10.0.0.2"), Response(), user=None)
+    assert buckets == {"ratelimit:requests:ip:10.0.0.1": 2, "ratelimit:requests:user:7": 1,
+                       "ratelimit:requests:ip:10.0.0.2": 1}
+
+
+@pytest.mark.asyncio
+async def test_batch_is_charged_one_token_per_item(buckets):
+    two = [HeadphoneRequest(brand="Sony", model="MDR-Z1R"), HeadphoneRequest(brand="Focal", model="Utopia")]
+    with pytest.raises(HTTPException) as exc:
+        await get_recommendations_batch(two * 2, _request("10.0.0.5"), Response(), user=None)
+    assert exc.value.status_code == 400 and "At most 2" in exc.value.detail
+
+    await get_recommendations_batch(two, _request("10.0.0.5"), Response(), user=None)
+    assert buckets == {"ratelimit:requests:ip:10.0.0.5": 2}
+    with pytest.raises(HTTPException) as exc:
+        await get_recommendations_batch(two[:1], _request("10.0.0.5"), Response(), user=None)
+    assert exc.value.status_code == 429
+
+
+@pytest.mark.asyncio
+async def test_gemini_quota_is_charged_only_for_the_request_subject(buckets):
+    # 沒有經過 check_request_limit (背景工作) 不扣
+    await asyncio.create_task(rate_limit.charge_gemini_quota())
+    assert buckets == {}
+
+    async def request_that_misses():
+        await rate_limit.check_request_limit("ip:10.0.0.3")
+        await rate_limit.charge_gemini_quota()
+
+    await asyncio.create_task(request_that_misses())
+    with pytest.raises(rate_limit.RateLimitExceeded) as exc:
+        await asyncio.create_task(request_that_misses())
+    assert exc.value.bucket == "gemini"
+    assert buckets["ratelimit:gemini:ip:10.0.0.3"] == 1
+
+
+@pytest.mark.asyncio
+async def test_redis_errors_fail_open(monkeypatch):
+    async def take_tokens(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(rate_limit, "take_tokens", take_tokens)
+    monkeypatch.setattr(rate_limit.settings, "RATE_LIMIT_ENABLED", True)
+    assert await rate_limit.check_request_limit("ip:10.0.0.4") is None
+
+
+@pytest.fixture
+def miss_path(monkeypatch):
+    """compute_recommendation 的上游都換成假的；回傳 (L3 內容, 實際 build 的紀錄)。"""
+    from src.services import recommendation_service
+
+    stored, builds = {}, []
+
+    async def get_stored_recommendation(brand_key, model_key, prompt_version):
+        return stored.get((brand_key, model_key))
+
+    async def set_cached_recommendation(*args, **kwargs):
+        pass
+
+    async def build_and_store(key, brand, model, on_partial=None):
+        builds.append(model)
+        await asyncio.sleep(0.01)
+        return {"title": "Fresh"}
+
+    monkeypatch.setattr(recommendation_service, "get_stored_recommendation", get_stored_recommendation)
+    monkeypatch.setattr(recommendation_service, "set_cached_recommendation", set_cached_recommendation)
+    monkeypatch.setattr(recommendation_service, "_build_and_store", build_and_store)
+    monkeypatch.setattr(recommendation_service.recommendation_flight, "_run_leader",
+                        lambda key, compute, fetch_cached: compute())
+    return stored, builds
+
+
+async def _ask(subject: str, model: str):
+    from src.services import recommendation_service
+    from src.services.normalizer import HeadphoneKey
+
+    await rate_limit.check_request_limit(subject)
+    return await recommendation_service.compute_recommendation(HeadphoneKey("sony", model.lower()), "Sony", model)
+
+
+@pytest.mark.asyncio
+async def test_gemini_quota_is_not_charged_for_mongo_refills(buckets, miss_path, monkeypatch):
+    stored, builds = miss_path
+    monkeypatch.setattr(rate_limit.settings, "RATE_LIMIT_ANON_BURST", 10)
+    for model in ("mdrz1r", "mdrz7", "wh1000xm5", "wf1000xm5"):
+        stored[("sony", model)] = {"title": model}, time.time()
+
+    # 匿名 Gemini 額度只有 1，但全部由 MongoDB 回答
+    for model in ("MDRZ1R", "MDRZ7", "WH1000XM5", "WF1000XM5"):
+        assert (await asyncio.create_task(_ask("ip:10.0.0.6", model)))["title"] == model.lower()
+    assert builds == []
+    assert "ratelimit:gemini:ip:10.0.0.6" not in buckets
+
+
+@pytest.mark.asyncio
+async def test_exhausted_leader_does_not_fail_coalesced_followers(buckets, miss_path, monkeypatch):
+    _, builds = miss_path
+    monkeypatch.setattr(rate_limit.settings, "GEMINI_QUOTA_USER_BURST", 1)
+    buckets["ratelimit:gemini:user:1"] = 1  # user:1 的 Gemini 額度已經用完
+
+    exhausted, fresh = await asyncio.gather(
+        asyncio.create_task(_ask("user:1", "WF-1000XM5")), asyncio.create_task(_ask("user:2", "WF-1000XM5")),
+        return_exceptions=True,
+    )
+
+    # user:1 是 leader 所以只有他拿到 429；user:2 改當 leader，用自己的額度
+    assert isinstance(exhausted, rate_limit.RateLimitExceeded) and exhausted.bucket == "gemini"
+    assert fresh == {"title": "Fresh"}
+    assert builds == ["WF-1000XM5"]
+    assert buckets["ratelimit:gemini:user:2"] == 1
@@ -0,0 +1,218 @@
+import asyncio
+import time
+import pytest
+from src.db.redis import CachedRecommendation
+from src.services import recommendation_service, singleflight
+from src.services.normalizer import HeadphoneKey, normalize
+
+HD800S = HeadphoneKey("sennheiser", "hd800s")
+
+
+async def resolve_without_alias_index(brand, model):
+    return normalize(brand, model)
+
+
+def test_cached_entry_staleness():
+    soft_ttl = recommendation_service.settings.RECOMMEND_CACHE_SOFT_TTL_SECONDS
+    assert not CachedRecommendation(data={}, cached_at=time.time()).is_stale
+    assert CachedRecommendation(data={}, cached_at=time.time() - soft_ttl - 1).is_stale
+
+
+@pytest.mark.asyncio
+async def test_stale_refresh_runs_once_per_key(monkeypatch):
+    builds, saved = [], {}
+
+    async def build_recommendation(brand, model, on_partial=None):
+        builds.append((brand, model))
+        await asyncio.sleep(0.01)
+        return {"title": "Fresh"}, None
+
+    async def set_cached_recommendation(brand, model, data):
+        saved[(brand, model)] = data
+
+    async def acquire_lock(key, ttl):
+        return "token"
+
+    async def release_lock(key, token):
+        pass
+
+    async def save_recommendation(brand_key, model_key, data, prompt_version, brand=None, model=None):
+        pass
+
+    async def register_headphone(brand_key, model_key):
+        pass
+
+    monkeypatch.setattr(recommendation_service, "build_recommendation", build_recommendation)
+    monkeypatch.setattr(recommendation_service, "set_cached_recommendation", set_cached_recommendation)
+    monkeypatch.setattr(recommendation_service, "acquire_lock", acquire_lock)
+    monkeypatch.setattr(singleflight.cache, "release_lock", release_lock)
+    monkeypatch.setattr(recommendation_service, "save_recommendation", save_recommendation)
+    monkeypatch.setattr(recommendation_service, "register_headphone", register_headphone)
+
+    for _ in range(5):
+        recommendation_service.schedule_refresh(HD800S, "Sennheiser", "HD 800 S")
+    await asyncio.gather(*recommendation_service._background_tasks)
+
+    assert builds == [("Sennheiser", "HD 800 S")]
+    assert saved == {("sennheiser", "hd800s"): {"title": "Fresh"}}
+
+
+@pytest.mark.asyncio
+async def test_cold_cache_is_refilled_from_mongo(monkeypatch):
+    refilled, builds = {}, []
+    settings = recommendation_service.settings
+    # 比 soft TTL 舊、但還在 L3 新鮮期內的分析
+    analyzed_at = time.time() - settings.RECOMMEND_CACHE_SOFT_TTL_SECONDS * 2
+
+    async def get_stored_recommendation(brand, model, prompt_version):
+        return {"title": "Stored"}, analyzed_at
+
+    async def set_cached_recommendation(brand, model, data, cached_at=None):
+        refilled[(brand, model)] = (data, cached_at)
+
+    async def build_and_store(key, brand, model, on_partial=None, store_degraded=True):
+        builds.append(model)
+        return {"title": "Fresh"}
+
+    monkeypatch.setattr(recommendation_service, "get_stored_recommendation", get_stored_recommendation)
+    monkeypatch.setattr(recommendation_service, "set_cached_recommendation", set_cached_recommendation)
+    monkeypatch.setattr(recommendation_service, "_build_and_store", build_and_store)
+    monkeypatch.setattr(recommendation_service.recommendation_flight, "_run_leader",
+                        lambda key, compute, fetch_cached: compute())
+
+    result = await recommendation_service.compute_recommendation(HD800S, "Sennheiser", "HD800S")
+
+    # 回填的 entry 以現在為 cached_at，不會一進 Redis 就是 stale
+    assert result == {"title": "Stored"} and builds == []
+    assert refilled == {("sennheiser", "hd800s"): ({"title": "Stored"}, None)}
+
+    # 超過 L3 新鮮期才重新分析
+    analyzed_at = time.time() - settings.RECOMMEND_STORE_FRESH_SECONDS - 1
+    assert await recommendation_service.compute_recommendation(HD800S, "Sennheiser", "HD800S") == {"title": "Fresh"}
+    assert builds == ["HD800S"]
+
+
+@pytest.mark.asyncio
+async def test_stream_emits_partials_before_result(monkeypatch):
+    async def stream_headphone_analysis(brand, model, on_fields):
+        on_fields({"specs": {"form_factor": "Over-ear", "year": "2016"}})
+        await asyncio.sleep(0)
+        on_fields({"sound_features": ["Wide soundstage"], "detailed_analysis": {"bass": "Tight"}})
+        return {"specs": {"form_factor": "Over-ear", "year": "2016"}, "sound_features": ["Wide soundstage"],
+                "detailed_analysis": {"bass": "Tight"}, "song_query": "Hotel California - Eagles", "summary": "Great"}
+
+    async def lookup_track(query):
+        return {"name": "Hotel California", "artists": [{"name": "Eagles"}], "album": {"images": []},
+                "external_urls": {"spotify": "s"}, "id": "1"}, None
+
+    async def get_stored_recommendation(*args):
+        return None
+
+    async def noop(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(recommendation_service, "stream_headphone_analysis", stream_headphone_analysis)
+    monkeypatch.setattr(recommendation_service, "lookup_track", lookup_track)
+    monkeypatch.setattr(recommendation_service, "get_stored_recommendation", get_stored_recommendation)
+    monkeypatch.setattr(recommendation_service, "set_cached_recommendation", noop)
+    monkeypatch.setattr(recommendation_service, "save_recommendation", noop)
+    monkeypatch.setattr(recommendation_service, "register_headphone", noop)
+    monkeypatch.setattr(recommendation_service.recommendation_flight, "_run_leader",
+                        lambda key, compute, fetch_cached: compute())
+
+    events = [e async for e in recommendation_service.stream_recommendation(HD800S, "Sennheiser", "HD800S")]
+
+    assert [name for name, _ in events] == ["specs", "sound_features", "analysis", "result"]
+    assert events[0][1]["release_year"] == "2016"
+    assert events[-1][1]["title"] == "Hotel California"
+    assert events[-1][1]["analysis_bass"] == "Tight"
+    assert events[-1][1]["degraded"] is None
+
+
+@pytest.mark.asyncio
+async def test_aborted_stream_does_not_leave_pending_queue_get(monkeypatch):
+    finish = asyncio.Event()
+
+    async def compute_recommendation(key, brand, model, on_partial=None):
+        await finish.wait()
+        return {"title": "Fresh"}
+
+    monkeypatch.setattr(recommendation_service, "compute_recommendation", compute_recommendation)
+
+    async def consume():
+        async for _ in recommendation_service.stream_recommendation(HD800S, "Sennheiser", "HD800S"):
+            pass
+
+    consumer = asyncio.create_task(consume())
+    await asyncio.sleep(0.01)
+    consumer.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await consumer
+    await asyncio.sleep(0)
+
+    # 只剩下背景繼續跑的計算，沒有掛著的 queue.get()
+    pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+    assert [t.get_coro().__name__ for t in pending] == ["compute_recommendation"]
+    finish.set()
+    await asyncio.gather(*pending)
+
+
+@pytest.mark.asyncio
+async def test_degraded_result_is_negative_cached_but_not_persisted(monkeypatch):
+    cached, persisted = {}, []
+
+    async def analyze_headphone_with_reason(brand, model):
+        return {"specs": {}, "sound_features": [], "song_query": "Obscure B-side", "detailed_analysis": {}, "summary": "ok"}, None
+
+    async def lookup_track(query):
+        return None, "no_track"
+
+    async def get_stored_recommendation(*args):
+        return None
+
+    async def set_cached_recommendation(brand, model, data, cached_at=None, degraded=None):
+        cached[(brand, model)] = degraded
+
+    async def save_recommendation(*args, **kwargs):
+        persisted.append(args)
+
+    monkeypatch.setattr(recommendation_service, "analyze_headphone_with_reason", analyze_headphone_with_reason)
+    monkeypatch.setattr(recommendation_service, "lookup_track", lookup_track)
+    monkeypatch.setattr(recommendation_service, "get_stored_recommendation", get_stored_recommendation)
+    monkeypatch.setattr(recommendation_service, "set_cached_recommendation", set_cached_recommendation)
+    monkeypatch.setattr(recommendation_service, "save_recommendation", save_recommendation)
+    monkeypatch.setattr(recommendation_service.recommendation_flight, "_run_leader",
+                        lambda key, compute, fetch_cached: compute())
+
+    result = await recommendation_service.compute_recommendation(HD800S, "Sennheiser", "HD800S")
+
+    assert result["degraded"] == "no_track" and result["title"] == "Obscure B-side"
+    assert cached == {("sennheiser", "hd800s"): "no_track"}
+    assert persisted == []
+
+    # 背景重算失敗時不寫任何東西，保留原本的完整結果
+    cached.clear()
+    await recommendation_service._build_and_store(HD800S, "Sennheiser", "HD800S", store_degraded=False)
+    assert cached == {}
+
+
+@pytest.mark.asyncio
+async def test_batch_reports_per_item_errors(monkeypatch):
+    async def get_cached_recommendations(pairs):
+        return [CachedRecommendation(data={"title": "Cached"}, cached_at=time.time()), None, None]
+
+    async def compute_recommendation(key, brand, model):
+        if model == "broken":
+            raise RuntimeError("upstream exploded")
+        return {"title": model}
+
+    monkeypatch.setattr(recommendation_service, "get_cached_recommendations", get_cached_recommendations)
+    monkeypatch.setattr(recommendation_service, "compute_recommendation", compute_recommendation)
+    monkeypatch.setattr(recommendation_service, "resolve_headphone", resolve_without_alias_index)
+
+    pairs = [("Sennheiser", "HD800S"), ("Sony", "broken"), ("Sony", "MDR-Z1R")]
+    items = {i["index"]: i async for i in recommendation_service.iter_batch_recommendations(pairs)}
+
+    assert items[0]["cache"] == "HIT" and items[0]["recommendation"] == {"title": "Cached"}
+    assert items[1]["status"] == "error" and "exploded" in items[1]["error"]
+    assert items[2]["cache"] == "MISS" and items[2]["recommendation"] == {"title": "MDR-Z1R"}
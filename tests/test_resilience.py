@@ -0,0 +1,80 @@
+import asyncio
+import pytest
+from src.services.resilience import (
+    CLOSED, HALF_OPEN, OPEN, AdaptiveLimiter, CircuitBreaker, CircuitOpenError, UpstreamGuard, UpstreamOverloaded,
+)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_breaker_opens_then_probes_after_reset():
+    clock = FakeClock()
+    breaker = CircuitBreaker("test", failure_threshold=2, reset_seconds=10, clock=clock)
+
+    breaker.record_failure()
+    assert breaker.allow() and breaker.state == CLOSED
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow()
+
+    # reset 之後只放一個探測請求
+    clock.now = 10
+    assert breaker.allow() and breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN and not breaker.allow()
+
+    clock.now = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker.allow()
+
+
+def test_limiter_is_additive_increase_multiplicative_decrease():
+    clock = FakeClock()
+    limiter = AdaptiveLimiter("test", min_limit=1, max_limit=8, latency_target=1.0, queue_timeout=1, clock=clock)
+
+    limiter.on_sample(5.0, ok=True)
+    assert limiter.limit == 4
+    # 同一個 latency_target 內的其他慢請求不會再砍一次
+    limiter.on_sample(5.0, ok=False)
+    assert limiter.limit == 4
+
+    clock.now = 2
+    limiter.on_sample(0.1, ok=False)
+    assert limiter.limit == 2
+    for _ in range(10):
+        limiter.on_sample(0.1, ok=True)
+    assert 2 < limiter.limit <= 8
+
+
+@pytest.mark.asyncio
+async def test_guard_rejects_when_open_or_saturated():
+    breaker = CircuitBreaker("test", failure_threshold=1, reset_seconds=60)
+    limiter = AdaptiveLimiter("test", min_limit=1, max_limit=1, latency_target=1.0, queue_timeout=0.01)
+    guard = UpstreamGuard(breaker, limiter)
+    release = asyncio.Event()
+
+    async def slow():
+        await release.wait()
+        return "ok"
+
+    holder = asyncio.create_task(guard.call(slow))
+    await asyncio.sleep(0)
+    with pytest.raises(UpstreamOverloaded):
+        await guard.call(slow)
+    release.set()
+    assert await holder == "ok" and limiter.in_flight == 0
+
+    async def broken():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        await guard.call(broken)
+    with pytest.raises(CircuitOpenError):
+        await guard.call(slow)
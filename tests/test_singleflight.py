@@ -0,0 +1,139 @@
+import asyncio
+import pytest
+from src.services import singleflight
+from src.services.singleflight import SingleFlight
+
+
+@pytest.fixture
+def fake_lock(monkeypatch):
+    # 用 dict 模擬 Redis 的 lock:{key}
+    locks = {}
+
+    async def acquire(key, ttl):
+        if key in locks:
+            return None
+        locks[key] = "token"
+        return "token"
+
+    monkeypatch.setattr(singleflight.cache, "acquire_lock", acquire)
+    async def release(key, token):
+        locks.pop(key, None)
+
+    async def is_locked(key):
+        return key in locks
+
+    monkeypatch.setattr(singleflight.cache, "release_lock", release)
+    monkeypatch.setattr(singleflight.cache, "is_locked", is_locked)
+    return locks
+
+
+@pytest.mark.asyncio
+async def test_concurrent_misses_are_coalesced(fake_lock):
+    flight = SingleFlight(lease_ttl=30, wait_timeout=1, poll_interval=0.01)
+    calls = 0
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.05)
+        return {"title": "Hotel California"}
+
+    async def fetch_cached():
+        return None
+
+    results = await asyncio.gather(*[flight.do("rec:a:b", compute, fetch_cached) for _ in range(10)])
+
+    assert calls == 1
+    assert all(r == {"title": "Hotel California"} for r in results)
+    assert fake_lock == {}
+
+
+@pytest.mark.asyncio
+async def test_waits_for_remote_leader(fake_lock):
+    flight = SingleFlight(lease_ttl=30, wait_timeout=1, poll_interval=0.01)
+    fake_lock["rec:a:b"] = "other-replica"
+    cached = {}
+
+    async def compute():
+        raise AssertionError("should reuse the remote result")
+
+    async def fetch_cached():
+        return cached.get("value")
+
+    async def remote_leader():
+        await asyncio.sleep(0.05)
+        cached["value"] = {"title": "Remote"}
+
+    result, _ = await asyncio.gather(flight.do("rec:a:b", compute, fetch_cached), remote_leader())
+    assert result == {"title": "Remote"}
+
+
+@pytest.mark.asyncio
+async def test_computes_when_remote_leader_gives_up(fake_lock):
+    flight = SingleFlight(lease_ttl=30, wait_timeout=1, poll_interval=0.01)
+    fake_lock["rec:a:b"] = "other-replica"
+
+    async def compute():
+        return {"title": "Local"}
+
+    async def fetch_cached():
+        fake_lock.pop("rec:a:b", None)
+        return None
+
+    assert await flight.do("rec:a:b", compute, fetch_cached) == {"title": "Local"}
+
+
+@pytest.mark.asyncio
+async def test_cancelled_leader_does_not_cancel_followers(fake_lock):
+    flight = SingleFlight(lease_ttl=30, wait_timeout=1, poll_interval=0.01)
+
+    async def compute():
+        await asyncio.sleep(0.05)
+        return {"title": "Shared"}
+
+    async def fetch_cached():
+        return None
+
+    leader = asyncio.create_task(flight.do("rec:a:b", compute, fetch_cached))
+    await asyncio.sleep(0)
+    follower = asyncio.create_task(flight.do("rec:a:b", compute, fetch_cached))
+    await asyncio.sleep(0.01)
+    leader.cancel()  # 例如 leader 的 client 斷線
+
+    assert await follower == {"title": "Shared"}
+    assert leader.cancelled()
+    assert fake_lock == {}
+
+
+@pytest.mark.asyncio
+async def test_lease_is_renewed_and_waiters_never_compute_without_it(fake_lock, monkeypatch):
+    renewals = []
+
+    async def extend_lock(key, token, ttl):
+        renewals.append(key)
+        return fake_lock.get(key) == token
+
+    monkeypatch.setattr(singleflight.cache, "extend_lock", extend_lock)
+
+    # leader 算得比 lease TTL 還久：續約讓 lease 一直在
+    leader = SingleFlight(lease_ttl=0.03, wait_timeout=1, poll_interval=0.01)
+
+    async def slow_compute():
+        await asyncio.sleep(0.1)
+        return {"title": "Slow"}
+
+    async def fetch_cached():
+        return None
+
+    assert await leader.do("rec:a:b", slow_compute, fetch_cached) == {"title": "Slow"}
+    assert len(renewals) >= 2
+
+    # 另一個 replica 持有 lease 而且一直沒寫快取：等到 deadline 就放棄，不會自己算
+    fake_lock["rec:a:b"] = "other-replica"
+    waiter = SingleFlight(lease_ttl=30, wait_timeout=0.05, poll_interval=0.01)
+
+    async def compute():
+        raise AssertionError("must not compute without the lease")
+
+    with pytest.raises(singleflight.SingleFlightTimeout):
+        await waiter.do("rec:a:b", compute, fetch_cached)
@@ -0,0 +1,38 @@
+import asyncio
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+from src.core.timing import ServerTimingMiddleware, stage, upstream_call
+
+
+def _observations(name: str) -> float:
+    return REGISTRY.get_sample_value("audiophile_stage_duration_seconds_count", {"stage": name}) or 0.0
+
+
+def test_server_timing_header_lists_stages():
+    app = FastAPI()
+    app.add_middleware(ServerTimingMiddleware)
+
+    @app.get("/work")
+    async def work():
+        with stage("cache"):
+            await asyncio.sleep(0.001)
+        with upstream_call("gemini"):
+            await asyncio.sleep(0.001)
+        with upstream_call("gemini"):
+            pass
+        return {"ok": True}
+
+    before = _observations("gemini")
+    header = TestClient(app).get("/work").headers["server-timing"]
+    entries = dict(part.split(";dur=") for part in header.split(", "))
+    assert set(entries) == {"cache", "gemini", "total"}
+    assert float(entries["total"]) >= float(entries["gemini"]) > 0
+    assert _observations("gemini") == before + 2
+
+
+def test_stage_without_request_only_records_metric():
+    before = _observations("mongo_log")
+    with stage("mongo_log"):
+        pass
+    assert _observations("mongo_log") == before + 1
@@ -0,0 +1,105 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from src.db.local_cache import user_l1
+from src.models.user import User
+from src.services import user_cache
+
+
+class FakeResult:
+    def __init__(self, user):
+        self.user = user
+
+    def scalars(self):
+        return self
+
+    def first(self):
+        return self.user
+
+
+class FakeSession:
+    def __init__(self, user):
+        self.user = user
+        self.queries = 0
+
+    async def execute(self, statement):
+        self.queries += 1
+        return FakeResult(self.user)
+
+
+@pytest.mark.asyncio
+async def test_principal_is_cached_after_first_lookup(monkeypatch):
+    user_l1.clear()
+    redis_store = {}
+
+    async def get_cached_principal(email):
+        return redis_store.get(email)
+
+    async def set_cached_principal(email, principal):
+        redis_store[email] = principal
+
+    monkeypatch.setattr(user_cache, "get_cached_principal", get_cached_principal)
+    monkeypatch.setattr(user_cache, "set_cached_principal", set_cached_principal)
+
+    db = FakeSession(User(id=7, email="a@b.c", hashed_password="x", is_active=True, is_superuser=False))
+    first = await user_cache.get_user_principal(db, "a@b.c")
+    second = await user_cache.get_user_principal(db, "a@b.c")
+    assert db.queries == 1
+    assert (second.id, second.email, second.is_active) == (first.id, first.email, True)
+    assert "hashed_password" not in redis_store["a@b.c"]
+
+    # 另一個 replica (L1 是空的) 從 Redis 拿，一樣不查 PostgreSQL
+    user_l1.clear()
+    third = await user_cache.get_user_principal(db, "a@b.c")
+    assert db.queries == 1 and third.id == 7
+
+
+def test_password_change_invalidates_cached_principal(monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(user_cache, "invalidate_user", invalidated.append)
+
+    engine = create_engine("sqlite://")
+    User.__table__.create(engine)
+    with Session(engine) as db:
+        user = User(email="a@b.c", hashed_password="old")
+        db.add(user)
+        db.commit()
+        assert invalidated == []
+
+        user.hashed_password = "new"
+        db.commit()
+        assert invalidated == ["a@b.c"]
+
+        user.is_active = False
+        db.commit()
+        assert invalidated == ["a@b.c", "a@b.c"]
+
+
+def test_invalidation_waits_for_commit(monkeypatch):
+    invalidated = []
+    monkeypatch.setattr(user_cache, "invalidate_user", invalidated.append)
+
+    engine = create_engine("sqlite://")
+    User.__table__.create(engine)
+    with Session(engine) as db:
+        user = User(email="a@b.c", hashed_password="x", is_active=True)
+        db.add(user)
+        db.commit()
+
+        # flush 之後還沒 commit：別的連線仍然看得到舊資料，這時候失效會被舊資料回填
+        user.is_active = False
+        db.flush()
+        assert invalidated == []
+        db.commit()
+        assert invalidated == ["a@b.c"]
+
+        # rollback 的變更不失效
+        user.hashed_password = "y"
+        db.flush()
+        db.rollback()
+        db.commit()
+        assert invalidated == ["a@b.c"]
+
+        db.delete(user)
+        db.commit()
+        assert invalidated == ["a@b.c", "a@b.c"]
@@ -0,0 +1,204 @@
+import pytest
+from datetime import datetime
+from types import SimpleNamespace
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+from src.models.user import User
+from src.routers import user as user_router
+from src.routers.user import (
+    FavoriteCheckRequest, FavoriteRequest, add_favorite, check_favs, get_favorites, remove_favorite,
+    _decode_cursor, _encode_cursor,
+)
+
+
+@pytest.fixture
+def favorite_sets(monkeypatch):
+    """用 dict 模擬 Redis 的 fav:{user_id} 集合 (含 sentinel 語意)。"""
+    sets = {}
+
+    async def check_cached_favorites(user_id, track_ids):
+        if user_id not in sets or "__loaded__" not in sets[user_id]:
+            return None
+        return [t in sets[user_id] for t in track_ids]
+
+    async def get_favorites_generation(user_id):
+        return str(generations.get(user_id, 0))
+
+    async def fill_favorites_set(user_id, track_ids, generation):
+        if generation == str(generations.get(user_id, 0)):
+            sets.setdefault(user_id, set()).update({"__loaded__", *track_ids})
+
+    async def add_cached_favorite(user_id, track_id):
+        sets.setdefault(user_id, set()).add(track_id)
+
+    async def remove_cached_favorite(user_id, track_id):
+        generations[user_id] = generations.get(user_id, 0) + 1
+        sets.pop(user_id, None)
+
+    generations = {}
+    for fn in (check_cached_favorites, get_favorites_generation, fill_favorites_set, add_cached_favorite,
+               remove_cached_favorite):
+        monkeypatch.setattr(user_router, fn.__name__, fn)
+    return sets
+
+
+class FakeFavorites:
+    """模擬 favorites collection 的 upsert + unique index。"""
+
+    def __init__(self):
+        self.docs = {}
+        self.race = False
+
+    def find(self, query, projection):
+        docs = [{"track_id": t} for (u, t) in self.docs if u == query["user_id"]]
+        return FakeCursor(docs)
+
+    async def delete_one(self, query):
+        removed = self.docs.pop((query["user_id"], query["track_id"]), None)
+        return SimpleNamespace(deleted_count=1 if removed else 0)
+
+    async def update_one(self, query, update, upsert=False):
+        key = (query["user_id"], query["track_id"])
+        if self.race:
+            raise DuplicateKeyError("E11000 duplicate key")
+        if key in self.docs:
+            return SimpleNamespace(upserted_id=None)
+        self.docs[key] = {**query, **update["$setOnInsert"]}
+        return SimpleNamespace(upserted_id=len(self.docs))
+
+
+FAV = FavoriteRequest(track_id="t1", title="Song", artist="Artist", cover_url="", spotify_url="#")
+
+
+@pytest.mark.asyncio
+async def test_add_favorite_is_idempotent(favorite_sets):
+    favorites = FakeFavorites()
+    db = {"favorites": favorites}
+    user = User(id=1, email="a@b.c")
+
+    assert await add_favorite(FAV, user, db) == {"status": "added"}
+    assert await add_favorite(FAV, user, db) == {"status": "exists"}
+    assert list(favorites.docs) == [("1", "t1")]
+    assert favorites.docs[("1", "t1")]["title"] == "Song"
+
+    # 併發 upsert 撞到 unique index 也視為已存在
+    favorites.race = True
+    assert await add_favorite(FAV, user, db) == {"status": "exists"}
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+        self.max = None
+
+    def sort(self, keys):
+        return self
+
+    def limit(self, n):
+        self.max = n
+        return self
+
+    async def to_list(self, length):
+        return [dict(d) for d in self.docs[:self.max]]
+
+
+class FakeFavoritePages:
+    """依 (added_at, _id) 倒序，套用 keyset 條件。"""
+
+    def __init__(self, docs):
+        self.docs = sorted(docs, key=lambda d: (d["added_at"], d["_id"]), reverse=True)
+        self.projections = []
+
+    def find(self, query, projection):
+        self.projections.append(projection)
+        docs = [d for d in self.docs if d["user_id"] == query["user_id"]]
+        if "$or" in query:
+            older, same_time = query["$or"]
+            ts, oid = older["added_at"]["$lt"], same_time["_id"]["$lt"]
+            docs = [d for d in docs if d["added_at"] < ts or (d["added_at"] == ts and d["_id"] < oid)]
+        return FakeCursor(docs)
+
+
+def test_cursor_round_trip_and_rejects_garbage():
+    ts, oid = datetime(2024, 5, 1, 12, 30), ObjectId()
+    assert _decode_cursor(_encode_cursor(ts, oid)) == (ts, oid)
+    with pytest.raises(HTTPException) as exc:
+        _decode_cursor("not-a-cursor")
+    assert exc.value.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_favorites_pages_walk_every_item_once():
+    same_time = datetime(2024, 1, 1)
+    docs = [
+        {"_id": ObjectId(), "user_id": "1", "track_id": f"t{i}", "title": f"Song {i}", "added_at": same_time if i < 3 else datetime(2024, 1, 1 + i)}
+        for i in range(5)
+    ]
+    favorites = FakeFavoritePages(docs)
+    db = {"favorites": favorites}
+    user = User(id=1, email="a@b.c")
+
+    seen, cursor = [], None
+    while True:
+        page = await get_favorites(limit=2, cursor=cursor, user=user, db=db)
+        assert len(page["items"]) <= 2
+        assert all("_id" not in item and "added_at" not in item for item in page["items"])
+        seen += [item["track_id"] for item in page["items"]]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    assert seen == ["t4", "t3", "t2", "t1", "t0"]
+    assert "user_id" not in favorites.projections[0]
+
+
+@pytest.mark.asyncio
+async def test_bulk_check_rebuilds_set_once_then_tracks_writes(favorite_sets):
+    favorites = FakeFavorites()
+    favorites.docs[("1", "t1")] = {"title": "Song"}
+    db = {"favorites": favorites}
+    user = User(id=1, email="a@b.c")
+    check = FavoriteCheckRequest(track_ids=["t1", "t2", "t1"])
+
+    # 集合不存在：從 MongoDB 重建
+    assert await check_favs(check, user, db) == {"favorited": {"t1": True, "t2": False}}
+    assert favorite_sets["1"] == {"__loaded__", "t1"}
+
+    # 新增直接合併進集合，之後只靠 Redis 回答
+    await add_favorite(FAV.model_copy(update={"track_id": "t2"}), user, db)
+    assert favorite_sets["1"] == {"__loaded__", "t1", "t2"}
+
+    # 移除會整個丟掉集合，下次查詢從 MongoDB 乾淨重建
+    await remove_favorite("t1", user, db)
+    assert "1" not in favorite_sets
+    assert await check_favs(check, user, db) == {"favorited": {"t1": False, "t2": True}}
+
+
+@pytest.mark.asyncio
+async def test_rebuild_racing_a_removal_is_discarded(favorite_sets, monkeypatch):
+    favorites = FakeFavorites()
+    favorites.docs[("1", "t1")] = {"title": "Song"}
+    db = {"favorites": favorites}
+    user = User(id=1, email="a@b.c")
+
+    # 重建讀完 MongoDB 之後、寫回 Redis 之前，使用者移除了 t1
+    find = favorites.find
+
+    def find_then_remove(query, projection):
+        cursor = find(query, projection)
+        to_list = cursor.to_list
+
+        async def racing_to_list(length=None):
+            docs = await to_list(length=length)
+            await remove_favorite("t1", user, db)
+            return docs
+
+        cursor.to_list = racing_to_list
+        return cursor
+
+    monkeypatch.setattr(favorites, "find", find_then_remove)
+    await check_favs(FavoriteCheckRequest(track_ids=["t1"]), user, db)
+    assert "1" not in favorite_sets  # 舊快照沒有被寫回
+
+    monkeypatch.setattr(favorites, "find", find)
+    assert await check_favs(FavoriteCheckRequest(track_ids=["t1"]), user, db) == {"favorited": {"t1": False}}
@@ -0,0 +1,54 @@
+import time
+import pytest
+from src.db.redis import CachedRecommendation
+from src.services import recommendation_service, warmup
+from src.services.normalizer import normalize
+
+
+@pytest.mark.asyncio
+async def test_warm_cache_skips_fresh_and_refills_from_mongo(monkeypatch):
+    popular = [("Sennheiser", "HD800S"), ("Sony", "MDR-Z1R"), ("Sony", "MDR-Z7"), ("Focal", "Utopia"),
+               ("Focal", "Clear")]
+    refilled, computed = [], []
+    now = time.time()
+    stale = now - warmup.settings.RECOMMEND_CACHE_SOFT_TTL_SECONDS - 1
+    stored = {
+        "mdrz1r": ({"title": "Stored"}, stale),  # 超過 soft TTL 但還在 RECOMMEND_STORE_FRESH_SECONDS 內
+        "mdrz7": ({"title": "Stored"}, now - 3600),
+        "clear": ({"title": "Too old"}, now - warmup.settings.RECOMMEND_STORE_FRESH_SECONDS - 1),
+    }
+
+    async def top_headphones(limit, window_days):
+        return popular
+
+    async def get_cached_recommendations(pairs):
+        # HD800S 新鮮、MDR-Z1R 沒有、MDR-Z7 已經 stale、Utopia / Clear 沒有
+        return [CachedRecommendation(data={}, cached_at=now), None, CachedRecommendation(data={}, cached_at=stale),
+                None, None]
+
+    async def get_stored_recommendation(brand_key, model_key, prompt_version):
+        return stored.get(model_key)
+
+    async def set_cached_recommendation(brand_key, model_key, data, cached_at=None):
+        refilled.append((brand_key, model_key, cached_at))
+
+    async def resolve_headphone(brand, model):
+        return normalize(brand, model)
+
+    async def precompute_recommendations(pairs):
+        computed.extend(pairs)
+        return len(pairs)
+
+    monkeypatch.setattr(warmup, "top_headphones", top_headphones)
+    monkeypatch.setattr(warmup, "get_cached_recommendations", get_cached_recommendations)
+    monkeypatch.setattr(recommendation_service, "get_stored_recommendation", get_stored_recommendation)
+    monkeypatch.setattr(recommendation_service, "set_cached_recommendation", set_cached_recommendation)
+    monkeypatch.setattr(warmup, "precompute_recommendations", precompute_recommendations)
+    monkeypatch.setattr(warmup, "resolve_headphone", resolve_headphone)
+
+    stats = await warmup.warm_cache(limit=5, window_days=7)
+
+    # stale 的也從 MongoDB 回填；回填以現在當 cached_at，超過 RECOMMEND_STORE_FRESH_SECONDS 的才問 Gemini
+    assert stats == {"fresh": 1, "mongo": 2, "gemini": 2, "failed": 0}
+    assert refilled == [("sony", "mdrz1r", None), ("sony", "mdrz7", None)]
+    assert computed == [("Focal", "Utopia"), ("Focal", "Clear")]